@@ -24,29 +24,41 @@
 #######################################################################
 
 
+import argparse
+import asyncio
+import bisect
+import concurrent.futures
 import zlib
 import base64
+import codecs
+import copy
+import csv
+import hashlib
+import heapq
+import re
 import json
+import sys
 import tkinter as tk
 import tkinter.filedialog
 import time
-from itertools import count
+from array import array
+from collections import OrderedDict, deque
+from itertools import chain, count
 import logging
+import queue
+import random
+import threading
+import operator
 from functools import partial
 from ctypes import c_int32
+from http import HTTPStatus
+from types import MappingProxyType
 
 VERSION = '0.0'
 
-ORDER = ["signal-{}".format(n) for n in range(10)] + ["signal-{}".format(chr(n)) for n in range(65, 91)] +\
-        ["signal-red", "signal-green", "signal-blue", "signal-yellow", "signal-pink", "signal-cyan", "signal-white",
-         "signal-grey", "signal-black", "signal-check", "signal-info", "signal-dot"]
-
-
-def sig_sort(signal):
-    """Helper function to order the signals"""
-    if signal not in ORDER:
-        ORDER.append(signal)
-    return ORDER.index(signal)
+ORDER = tuple(["signal-{}".format(n) for n in range(10)] + ["signal-{}".format(chr(n)) for n in range(65, 91)] +
+              ["signal-red", "signal-green", "signal-blue", "signal-yellow", "signal-pink", "signal-cyan",
+               "signal-white", "signal-grey", "signal-black", "signal-check", "signal-info", "signal-dot"])
 
 
 def int32(val):
@@ -56,26 +68,189 @@ def int32(val):
     return c_int32(val).value
 
 
-def open_blueprint(filename=None):
-    """Open a blueprint by filename or prompting the user for one.
+CHUNK_SIZE = 1 << 16
 
-    Return a dictionary of the blueprint contents
+_JSON_TOKEN = re.compile(r'\s*(?:"((?:[^"\\]|\\.)*)"|([{}\[\]:,])|([^\s"{}\[\]:,]+))', re.S)
+
+
+def choose_blueprint_file():
+    """Prompt the user for a blueprint file."""
+    root = tk.Tk()
+    root.withdraw()
+    filename = tkinter.filedialog.askopenfilename()
+    print("opening: {} from filedialog".format(filename), file=sys.stderr)
+    root.destroy()
+    return filename
+
+
+def read_blueprint_chunks(filename=None, data=None):
+    """Yield the blueprint string in chunks.
+
+    The blueprint comes from data (a str, bytes or a file object) if given, from stdin if filename
+    is '-', or from the file filename. With neither the user is prompted for a file.
     """
-    if not filename:
-        root = tk.Tk()
-        root.withdraw()
-        filename = tkinter.filedialog.askopenfilename()
-        print("opening: {} from filedialog".format(filename))
-        root.destroy()
+    if data is not None:
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data).decode('ascii')
+        if isinstance(data, str):
+            for start in range(0, len(data), CHUNK_SIZE):
+                yield data[start:start + CHUNK_SIZE]
+            return
+        file = data
+    elif filename == '-':
+        file = sys.stdin
     else:
-        print("opening: {}".format(filename))
-    file = open(filename, encoding='utf-8')
-    jsonstring64 = file.read()[1:]
-    jsonstringdata = base64.b64decode(jsonstring64)
-    jsonstring = zlib.decompress(jsonstringdata)
-    bpdict = json.loads(jsonstring)
-    file.close()
-    return bpdict
+        if not filename:
+            filename = choose_blueprint_file()
+        else:
+            # not on stdout, where --frames - and --batch write their output
+            print("opening: {}".format(filename), file=sys.stderr)
+        with open(filename, encoding='utf-8') as file:
+            yield from iter(partial(file.read, CHUNK_SIZE), '')
+        return
+    for chunk in iter(partial(file.read, CHUNK_SIZE), type(file.read(0))()):
+        yield chunk.decode('ascii') if isinstance(chunk, bytes) else chunk
+
+
+def decode_blueprint_chunks(chunks):
+    """Turn chunks of a blueprint string into chunks of its json text.
+
+    The version byte is dropped, then the rest is base64 decoded and decompressed piece by piece,
+    so the whole string is never held in memory in any of its forms.
+    """
+    decompressor = zlib.decompressobj()
+    text = codecs.getincrementaldecoder('utf-8')()
+    pending = ''
+    version = None
+    for chunk in chunks:
+        chunk = ''.join(chunk.split())
+        if version is None and chunk:
+            version, chunk = chunk[0], chunk[1:]
+        pending += chunk
+        usable = len(pending) - len(pending) % 4
+        if usable:
+            yield text.decode(decompressor.decompress(base64.b64decode(pending[:usable])))
+            pending = pending[usable:]
+    if pending:
+        yield text.decode(decompressor.decompress(base64.b64decode(pending)))
+    yield text.decode(decompressor.flush(), final=True)
+
+
+def iter_json_array(chunks, path):
+    """Yield the items of the json array found under the object keys in path, as they are parsed.
+
+    chunks is an iterable of json text. Only the array items are decoded into python objects, the
+    rest of the document is scanned and skipped.
+    """
+    return (item for _, item in iter_json_arrays(chunks, [path]))
+
+
+def iter_json_arrays(chunks, paths):
+    """Like iter_json_array for several arrays, yield (path, item) with path as a tuple of keys."""
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    paths = [tuple(path) for path in paths]
+    buf = ''
+    pos = 0
+    eof = False
+    stack = []   # [bracket, key] for each open object or array
+    key = None   # last string seen, it is a key if followed by ':'
+    in_target = None   # path of the array being read
+    remaining = set(paths)
+
+    def more():
+        nonlocal buf, pos, eof
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+        else:
+            buf = buf[pos:] + chunk
+            pos = 0
+
+    while True:
+        if in_target:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buf):
+                if eof:
+                    raise ValueError('Unexpected end of the blueprint json')
+                more()
+                continue
+            if buf[pos] == ']':
+                remaining.discard(in_target)
+                if not remaining:
+                    return
+                stack.pop()
+                pos += 1
+                in_target = None
+                continue
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                more()
+                continue
+            # a number could continue in the next chunk
+            if end == len(buf) and not eof:
+                more()
+                continue
+            pos = end
+            yield in_target, item
+            continue
+
+        match = _JSON_TOKEN.match(buf, pos)
+        if not match or (match.end() == len(buf) and not eof):
+            if eof:
+                return
+            more()
+            continue
+        pos = match.end()
+        string, punctuation, _ = match.groups()
+        if string is not None:
+            key = string
+        elif punctuation is None:
+            continue    # number, true, false or null
+        elif punctuation == ':':
+            stack[-1][1] = json.loads('"{}"'.format(key))
+        elif punctuation in '{[':
+            stack.append([punctuation, None])
+            keys = tuple(entry[1] for entry in stack[:-1])
+            in_target = keys if punctuation == '[' and keys in paths else None
+        elif punctuation in '}]':
+            stack.pop()
+        elif punctuation == ',' and stack and stack[-1][0] == '{':
+            stack[-1][1] = None
+
+
+def iter_blueprint_entities(filename=None, data=None):
+    """Yield the entity dictionaries of a blueprint one by one while it is being decoded."""
+    return iter_json_array(decode_blueprint_chunks(read_blueprint_chunks(filename, data)), ('blueprint', 'entities'))
+
+
+def iter_blueprint_items(filename=None, data=None):
+    """Yield ('entities', entity) and ('wires', wire) pairs while a blueprint is being decoded.
+
+    Wires are the [entity, connector, entity, connector] lists of Factorio 2.0 blueprints, older
+    blueprints keep their wires in the 'connections' of each entity.
+    """
+    chunks = decode_blueprint_chunks(read_blueprint_chunks(filename, data))
+    for path, item in iter_json_arrays(chunks, [('blueprint', 'entities'), ('blueprint', 'wires')]):
+        yield path[-1], item
+
+
+def open_blueprint(filename=None, data=None):
+    """Open a blueprint by filename, from stdin (filename '-'), from data or prompting the user for one.
+
+    Return a dictionary of the blueprint contents
+    """
+    jsonstring = ''.join(decode_blueprint_chunks(read_blueprint_chunks(filename, data)))
+    return json.loads(jsonstring)
+
+
+def encode_blueprint(blueprint):
+    """Blueprint string of a blueprint dictionary, as Factorio exports it."""
+    return '0' + base64.b64encode(zlib.compress(json.dumps(blueprint).encode('utf-8'))).decode('ascii')
 
 
 class Signal():
@@ -98,16 +273,404 @@ class Signal():
             return False
 
 
+class SignalSet():
+    """Immutable set of signals, as output by an entity or carried by a network.
+
+    A SignalSet is never modified once created, so when an output does not change from one
+    tick to the next the previous object is kept and "did it change?" becomes an identity
+    check. The hash is computed once and cached.
+    Iterating over it yields Signal objects, counts are looked up by signal name.
+    """
+
+    __slots__ = ('_counts', '_kinds', '_hash')
+
+    def __init__(self, signals=()):
+        counts = {}
+        kinds = {}
+        for s in signals:
+            if s.name in counts:
+                counts[s.name] = int32(counts[s.name] + s.count)
+            else:
+                counts[s.name] = s.count
+                if s.kind != 'virtual':
+                    kinds[s.name] = s.kind
+        self._counts = counts
+        self._kinds = kinds
+        self._hash = None
+
+    @classmethod
+    def from_counts(cls, counts, kinds=None):
+        """Build a SignalSet from a {name: count} dictionary, signals are 'virtual' unless in kinds."""
+        signalset = cls.__new__(cls)
+        signalset._counts = dict(counts)
+        signalset._kinds = dict(kinds) if kinds else {}
+        signalset._hash = None
+        return signalset
+
+    @classmethod
+    def total(cls, signalsets):
+        """Sum several SignalSets as a wire would, keeping signals that add up to 0.
+
+        If only one of them is non empty it is returned as is, so unchanged sums are shared.
+        """
+        signalsets = [s for s in signalsets if s]
+        if not signalsets:
+            return EMPTY_SIGNALS
+        if len(signalsets) == 1:
+            return signalsets[0]
+        counts = {}
+        kinds = {}
+        for signalset in signalsets:
+            for name, c in signalset._counts.items():
+                if name in counts:
+                    counts[name] = int32(counts[name] + c)
+                else:
+                    counts[name] = c
+            for name, kind in signalset._kinds.items():
+                kinds.setdefault(name, kind)
+        return cls.from_counts(counts, kinds)
+
+    def get(self, name, default=0):
+        return self._counts.get(name, default)
+
+    def kind(self, name):
+        return self._kinds.get(name, 'virtual')
+
+    def with_count(self, name, count, kind=None):
+        """A copy with the count of name changed, a count of 0 removes it. If kind is None the kind
+        of the signal already in the set is kept, or guessed from the name for a new one."""
+        if kind is None:
+            kind = self.kind(name) if name in self._counts else 'virtual' if name.startswith('signal-') else 'item'
+        counts = dict(self._counts)
+        kinds = dict(self._kinds)
+        kinds.pop(name, None)
+        if count:
+            counts[name] = int32(count)
+            if kind != 'virtual':
+                kinds[name] = kind
+        else:
+            counts.pop(name, None)
+        if not counts:
+            return EMPTY_SIGNALS
+        return SignalSet.from_counts(counts, kinds)
+
+    def items(self):
+        """(name, count) pairs of the signals in the set."""
+        return self._counts.items()
+
+    def names(self):
+        return self._counts.keys()
+
+    def values(self):
+        return self._counts.values()
+
+    def __iter__(self):
+        for name, c in self._counts.items():
+            yield Signal({'signal': {'name': name, 'type': self.kind(name)}, 'count': c})
+
+    def __len__(self):
+        return len(self._counts)
+
+    def __contains__(self, name):
+        return name in self._counts
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash((frozenset(self._counts.items()), frozenset(self._kinds.items())))
+        return self._hash
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, SignalSet) or hash(self) != hash(other):
+            return False
+        return self._counts == other._counts and self._kinds == other._kinds
+
+    def __str__(self):
+        return ', '.join(str(s) for s in self)
+
+    def __repr__(self):
+        return 'SignalSet({})'.format(self._counts)
+
+
+EMPTY_SIGNALS = SignalSet()
+
+# Lamp outputs are shared between ticks too, so they are read-only mappings.
+LAMP_ON = MappingProxyType({'light': 'ON', 'color': 'white'})
+LAMP_OFF = MappingProxyType({'light': 'OFF', 'color': 'white'})
+LAMP_UNSET = MappingProxyType({})
+# colours a lamp with use_colors takes from the first positive colour signal, in this order
+LAMP_SIGNAL_COLORS = ('red', 'green', 'blue', 'yellow', 'pink', 'cyan', 'white', 'grey', 'black')
+LAMP_LIT = {c: LAMP_ON if c == 'white' else MappingProxyType({'light': 'ON', 'color': c})
+            for c in LAMP_SIGNAL_COLORS}
+
+COMPARATORS = {'=': '==', '≥': '>=', '≤': '<=', '≠': '!='}
+OPERATIONS = {'^': '**', 'AND': '&', 'OR': '|', 'XOR': '^'}
+
+
+def _divide(a, b):
+    # integer division rounding towards zero, as in Factorio, where dividing by 0 gives 0
+    if b == 0:
+        return 0
+    quotient = abs(a) // abs(b)
+    return quotient if (a < 0) == (b < 0) else -quotient
+
+
+def _modulo(a, b):
+    # remainder of the truncating division, so it takes the sign of a: -7 % 2 is -1
+    return a - b * _divide(a, b) if b else 0
+
+
+def _power(a, b):
+    # only the low 32 bits are kept, so huge exponents are cheap
+    return pow(a, b, 1 << 32) if b >= 0 else 0
+
+
+# python operator of an arithmetic combinator -> function of the two terms. Shifts only use the
+# low 5 bits of the second term, as 32 bit integers do.
+ARITHMETIC = {'*': operator.mul, '/': _divide, '+': operator.add, '-': operator.sub, '%': _modulo,
+              '**': _power, '<<': lambda a, b: a << (b & 31), '>>': lambda a, b: a >> (b & 31),
+              '&': operator.and_, '|': operator.or_, '^': operator.xor}
+
+# Shared by all the entities without wires on a side, read only.
+NO_CONNECTIONS = MappingProxyType({'red': (), 'green': ()})
+# connector of a Factorio 2.0 wire -> (color, circuit_id)
+WIRE_CONNECTORS = {1: ('red', 1), 2: ('green', 1), 3: ('red', 2), 4: ('green', 2)}
+
+
+def _checked(value, known, what):
+    """value if it is None or one of known, else a ValueError: blueprints come from anywhere."""
+    if value is not None and value not in known:
+        raise ValueError('Unknown {} {!r}'.format(what, value))
+    return value
+
+
+def _checked_int(value, what):
+    if value is not None and not isinstance(value, int):
+        raise ValueError('{} must be an integer'.format(what))
+    return value
+
+
+def signal_name(signal):
+    """Get the (interned) name of a signal dictionary from a blueprint, None if not set."""
+    if signal and signal.get('name'):
+        return sys.intern(signal.get('name'))
+    return None
+
+
+class Config():
+    """Parsed configuration of an entity, immutable and compared by value.
+
+    Identical configurations are interned by the simulation (see Factsimcmd.intern_config), so
+    every entity with the same setup shares one instance.
+    """
+
+    __slots__ = ()
+    OPERATIONS = tuple(ARITHMETIC)  # accepted by replace
+
+    def __init__(self, **fields):
+        for field in self.__slots__:
+            object.__setattr__(self, field, fields.get(field))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("{} is immutable".format(type(self).__name__))
+
+    def key(self):
+        return (type(self),) + tuple(getattr(self, field) for field in self.__slots__)
+
+    def replace(self, **changes):
+        """A copy with some fields changed, e.g. config.replace(constant=10). Comparators can be
+        given as in Factorio ('≥') or as in python, operations as in python (so '^' is xor, as
+        stored in the configuration, and '**' power) or with the names AND, OR and XOR."""
+        unknown = set(changes) - set(self.__slots__)
+        if unknown:
+            raise ValueError('{} has no field {}'.format(type(self).__name__, ', '.join(sorted(unknown))))
+        if 'comparator' in changes:
+            changes['comparator'] = COMPARATORS.get(changes['comparator'], changes['comparator'])
+            if changes['comparator'] not in ('<', '>', '==', '>=', '<=', '!='):
+                raise ValueError('Unknown comparator {}'.format(changes['comparator']))
+        if 'operation' in changes:
+            if changes['operation'] != '^':
+                changes['operation'] = OPERATIONS.get(changes['operation'], changes['operation'])
+            if changes['operation'] not in self.OPERATIONS:
+                raise ValueError('Unknown operation {}'.format(changes['operation']))
+        for field in ('constant', 'second_constant'):
+            _checked_int(changes.get(field), field)
+        fields = {field: getattr(self, field) for field in self.__slots__}
+        fields.update(changes)
+        return type(self)(**fields)
+
+    def __eq__(self, other):
+        return isinstance(other, Config) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__,
+                               ', '.join('{}={!r}'.format(f, getattr(self, f)) for f in self.__slots__))
+
+
+class ConditionConfig(Config):
+    """Circuit condition of a lamp: first_signal comparator (constant or second_signal)."""
+
+    __slots__ = ('first_signal', 'comparator', 'constant', 'second_signal')
+
+    @classmethod
+    def from_dict(cls, condition):
+        comparator = condition.get('comparator')
+        return cls(first_signal=signal_name(condition.get('first_signal')),
+                   comparator=_checked(COMPARATORS.get(comparator, comparator), COMPARISONS, 'comparator'),
+                   constant=_checked_int(condition.get('constant'), 'constant'),
+                   second_signal=signal_name(condition.get('second_signal')))
+
+
+class DeciderConfig(Config):
+    """Decider conditions: a circuit condition plus the output signal and the copy count flag."""
+
+    __slots__ = ('first_signal', 'comparator', 'constant', 'second_signal', 'output_signal', 'copy_count')
+
+    @classmethod
+    def from_dict(cls, condition):
+        comparator = condition.get('comparator')
+        return cls(first_signal=signal_name(condition.get('first_signal')),
+                   comparator=_checked(COMPARATORS.get(comparator, comparator), COMPARISONS, 'comparator'),
+                   constant=_checked_int(condition.get('constant'), 'constant'),
+                   second_signal=signal_name(condition.get('second_signal')),
+                   output_signal=signal_name(condition.get('output_signal')),
+                   copy_count=condition.get('copy_count_from_input'))
+
+
+def legacy_decider_conditions(conditions):
+    """The decider_conditions of a blueprint in the layout of Factorio 1.x, which DeciderConfig reads.
+
+    The 2.0 layout, lists of conditions and outputs, is translated when it has one condition and one
+    output, reading and sending both wires with the count 1 or the input count. Return None for the
+    other 2.0 setups, which are not simulated.
+    """
+    if 'conditions' not in conditions and 'outputs' not in conditions:
+        return conditions
+    if len(conditions.get('conditions', [])) != 1 or len(conditions.get('outputs', [])) != 1:
+        return None
+    condition, output = conditions['conditions'][0], conditions['outputs'][0]
+    networks = [condition.get(key) for key in ('first_signal_networks', 'second_signal_networks')] + \
+        [output.get('networks')]
+    if any(nw and not (nw.get('red', True) and nw.get('green', True)) for nw in networks) or \
+            output.get('constant', 1) != 1:
+        return None
+    # 2.0 leaves the defaults out: comparator '<', constant 0 without a second signal, count copied
+    legacy = {'first_signal': condition.get('first_signal'), 'comparator': condition.get('comparator', '<'),
+              'second_signal': condition.get('second_signal')}
+    legacy['constant'] = condition.get('constant', None if legacy['second_signal'] else 0)
+    legacy.update(output_signal=output.get('signal'), copy_count_from_input=output.get('copy_count_from_input', True))
+    return legacy
+
+
+class ArithmeticConfig(Config):
+    """Arithmetic conditions, the operation is translated to its python operator."""
+
+    __slots__ = ('first_signal', 'operation', 'second_constant', 'second_signal', 'output_signal')
+
+    @classmethod
+    def from_dict(cls, condition):
+        operation = condition.get('operation')
+        return cls(first_signal=signal_name(condition.get('first_signal')),
+                   operation=_checked(OPERATIONS.get(operation, operation), ARITHMETIC, 'operation'),
+                   second_constant=_checked_int(condition.get('second_constant'), 'second_constant'),
+                   second_signal=signal_name(condition.get('second_signal')),
+                   output_signal=signal_name(condition.get('output_signal')))
+
+
+class History():
+    """Per tick record of an entity (its inputs or outputs) indexed by tick, keeping only the last ticks.
+
+    Works like the plain lists used by default but drops the oldest ticks once more than limit are
+    stored, so long runs use constant memory. Reading a dropped tick raises IndexError.
+    """
+
+    __slots__ = ('_items', '_end')
+
+    def __init__(self, items=(), limit=2):
+        # entities read the tick before the one being computed
+        self._items = deque(items, maxlen=max(limit, 2))
+        self._end = len(items)
+
+    @property
+    def limit(self):
+        return self._items.maxlen
+
+    def _index(self, tick):
+        if tick < 0:
+            tick += self._end
+        index = tick - self._end + len(self._items)
+        if index < 0 or tick >= self._end:
+            raise IndexError('tick {} is not in the kept history (ticks {} to {})'.format(
+                tick, self.first_tick, self._end - 1))
+        return index
+
+    def __len__(self):
+        return self._end
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __getitem__(self, tick):
+        return self._items[self._index(tick)]
+
+    def __setitem__(self, tick, value):
+        self._items[self._index(tick)] = value
+
+    def __iadd__(self, items):
+        self._items.extend(items)
+        self._end += len(items)
+        return self
+
+    def append(self, item):
+        self._items.append(item)
+        self._end += 1
+
+    def set_limit(self, limit):
+        self._items = deque(self._items, maxlen=max(limit, 2))
+
+    @property
+    def first_tick(self):
+        """Oldest tick still kept."""
+        return self._end - len(self._items)
+
+
+class Unchanging():
+    """History of an entity whose value never changes: every tick reads the same object and
+    nothing is stored. It looks long enough for any tick, so nothing is ever computed for it."""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __getitem__(self, tick):
+        return self.value
+
+    def __len__(self):
+        return sys.maxsize
+
+    def __iter__(self):
+        yield self.value
+
+
 class Network():
     """abstraction for the connections"""
-    _ids = count(1)
 
-    def __init__(self, upstream=None, downstream=None, poles=None, color=None):
-        self.nw_N = next(self._ids)
+    def __init__(self, nw_N, upstream=None, downstream=None, poles=None, color=None):
+        self.nw_N = nw_N
         self.upstream = upstream or []
         self.downstream = downstream or []
         self.poles = poles or []
         self.color = color
+        self.points = []    # circuit connection points (entity_N, circuit_id) joined by its wires
+        self._sources = None
+        self._value = EMPTY_SIGNALS
+        self._injection_ticks = []  # signals injected by stimuli, from each tick on
+        self._injections = []
 
     @property
     def members(self):
@@ -121,6 +684,36 @@ class Network():
         if entitynr not in self.downstream:
             self.downstream += [entitynr]
 
+    def injected(self, tick):
+        """Signals injected by stimuli in tick."""
+        n = bisect.bisect_right(self._injection_ticks, tick)
+        return self._injections[n - 1] if n else EMPTY_SIGNALS
+
+    def inject(self, tick, name, count, kind=None):
+        """Change the count of an injected signal from tick on, see Stimulus."""
+        signals = self.injected(tick).with_count(name, count, kind)
+        if self._injection_ticks and self._injection_ticks[-1] == tick:
+            self._injections[-1] = signals
+        elif self._injection_ticks and self._injection_ticks[-1] > tick:
+            raise ValueError('Network {} has injections after tick {}'.format(self.nw_N, tick))
+        else:
+            self._injection_ticks += [tick]
+            self._injections += [signals]
+
+    def value(self, simulation, tick):
+        """Get the signals on the network in desired tick, the sum of the upstream outputs.
+
+        The last sum is reused if all the upstream outputs are the same objects as last time"""
+        sources = [simulation.get_entity(up).get_output(tick) for up in self.upstream]
+        if self._injections:
+            sources += [self.injected(tick)]
+        if self._sources is not None and len(sources) == len(self._sources) and \
+                all(new is old for new, old in zip(sources, self._sources)):
+            return self._value
+        self._value = SignalSet.total(sources)
+        self._sources = sources
+        return self._value
+
     def __str__(self):
         return "{} - Network {}\n" \
                "    upstream:   {}\n" \
@@ -129,6 +722,144 @@ class Network():
                    self.color.capitalize(), self.nw_N, self.upstream, self.downstream, self.poles)
 
 
+class CircuitIndex():
+    """Who feeds whom in a simulation, kept up to date as networks are added or removed and as
+    entities are configured, so queries never walk all the networks.
+
+    For every entity it keeps the networks its output goes to and the ones it reads (or relays, for
+    poles), and for every signal name the entities whose configuration outputs it. Entities that
+    pass their input signals through (each, everything or anything outputs, selectors) are relays:
+    they can output whatever reaches them. Entity numbers are returned in sets.
+    """
+
+    def __init__(self):
+        self.writes = {}     # entity_N -> {network: None} its output goes to, in the order added
+        self.reads = {}      # entity_N -> {network: None} it reads or relays
+        self.points = {}     # (color, entity_N, circuit_id) -> network
+        self.produced = {}   # entity_N -> frozenset of signal names, or None for relays
+        self.producers = {}  # signal name -> set of entity_N
+        self.relays = set()
+
+    def add_network(self, nw):
+        for n in nw.upstream:
+            self.writes.setdefault(n, {})[nw] = None
+        for n in nw.downstream + nw.poles:
+            self.reads.setdefault(n, {})[nw] = None
+        for point in nw.points:
+            self.points[(nw.color,) + point] = nw
+
+    def remove_network(self, nw):
+        for n in nw.upstream:
+            self.writes[n].pop(nw, None)
+        for n in nw.downstream + nw.poles:
+            self.reads[n].pop(nw, None)
+        for point in nw.points:
+            if self.points.get((nw.color,) + point) is nw:
+                del self.points[(nw.color,) + point]
+
+    def update_entity(self, entity):
+        """Index the signals entity outputs now, after it was created or configured."""
+        n = entity.entity_N
+        old = self.produced.get(n, frozenset())
+        if old is None:
+            self.relays.discard(n)
+        else:
+            for name in old:
+                self.producers[name].discard(n)
+        new = self.produced[n] = entity.produced_signals()
+        if new is None:
+            self.relays.add(n)
+        else:
+            for name in new:
+                self.producers.setdefault(name, set()).add(n)
+
+    def network_at(self, color, entity_N, circuit_id=1):
+        """The network of a color joined at a connection point, or None."""
+        return self.points.get((color, entity_N, circuit_id))
+
+    def networks_fed_by(self, entity_N):
+        """Networks the output of an entity goes to."""
+        return list(self.writes.get(entity_N, ()))
+
+    def networks_read_by(self, entity_N):
+        """Networks an entity reads, or relays if it is a pole."""
+        return list(self.reads.get(entity_N, ()))
+
+    def consumers(self, entity_N):
+        """Entities reading a network the output of entity_N goes to."""
+        return {n for nw in self.writes.get(entity_N, ()) for n in nw.downstream + nw.poles}
+
+    def producers_of(self, entity_N):
+        """Entities whose output goes to a network entity_N reads."""
+        return {n for nw in self.reads.get(entity_N, ()) for n in nw.upstream}
+
+    def _cone(self, entity_N, step):
+        cone = set()
+        stack = [entity_N]
+        while stack:
+            for n in step(stack.pop()):
+                if n not in cone:
+                    cone.add(n)
+                    stack.append(n)
+        return cone
+
+    def downstream_cone(self, entity_N):
+        """Entities whose inputs depend on the output of entity_N, directly or through other
+        entities. It includes entity_N only if it is in a loop."""
+        return self._cone(entity_N, self.consumers)
+
+    def upstream_cone(self, entity_N):
+        """Entities the inputs of entity_N depend on, directly or through other entities. It
+        includes entity_N only if it is in a loop."""
+        return self._cone(entity_N, self.producers_of)
+
+    def signal_producers(self, name, entity_N=None):
+        """Entities that can output the signal name: the ones configured to, and the relays it can
+        reach from them. With entity_N, only those whose output goes to a network entity_N reads."""
+        able = set(self.producers.get(name, ()))
+        stack = list(able)
+        while stack:
+            for n in self.consumers(stack.pop()):
+                if n in self.relays and n not in able:
+                    able.add(n)
+                    stack.append(n)
+        if entity_N is not None:
+            able &= self.producers_of(entity_N)
+        return able
+
+
+ENTITY_TYPES = {}     # blueprint entity name -> entity class
+ENTITY_FAMILIES = []  # (match(name), entity class) for the names not in ENTITY_TYPES
+
+
+def register_entity(*names, match=None):
+    """Class decorator to build the blueprint entities called names, or whose name passes match,
+    with the decorated class.
+
+    An entity class parses its blueprint dictionary in __init__(dictionary, simulation), declares
+    its circuit connection points in SIDES as {circuit_id: roles}, with the roles 'in' (it reads the
+    network), 'out' (its output is added to the network) and 'pole' (it only joins wires), and
+    computes one tick in advance(). Combinator subclasses only need evaluate(input_count), the pure
+    kernel from the inputs in a tick to the output in the next one. Entity types that are not
+    registered are built as PassiveEntity.
+    """
+    def register(cls):
+        for name in names:
+            ENTITY_TYPES[name] = cls
+        if match is not None:
+            ENTITY_FAMILIES.append((match, cls))
+        return cls
+    return register
+
+
+def entity_class(name):
+    """The class registered for a blueprint entity name."""
+    cls = ENTITY_TYPES.get(name)
+    if cls is None:
+        cls = next((family for match, family in ENTITY_FAMILIES if match(name)), PassiveEntity)
+    return cls
+
+
 class Entity():
     """Generic Factsim entity.
 
@@ -136,13 +867,12 @@ class Entity():
     """
 
     def __init__(self, dictionary):
-        self.dictionary = dictionary
         self.entity_N = dictionary['entity_number']
-        self.name = dictionary['name']
+        self.name = sys.intern(dictionary['name'])
         self.position = dictionary['position']
         self.tick = 0
-        self.inputs = [[]]
-        self.outputs = [[]]
+        self.inputs = [EMPTY_SIGNALS]
+        self.outputs = [EMPTY_SIGNALS]
 
     def __str__(self):
 
@@ -156,26 +886,81 @@ class Entity():
 class ConnectedEntity(Entity):
     """Any entity that can have connections"""
 
+    SIDES = {1: ('in',)}
+    ACTIVE = True   # simulated every tick
+
     def __init__(self, dictionary, simulation):
         super().__init__(dictionary)
         self.simulation = simulation
-        self.connections = dictionary.get('connections')
-        if self.connections:
-            self.connect1 = self.connections.get(
-                '1') or {'red': [], 'green': []}
-            self.connect2 = self.connections.get(
-                '2') or {'red': [], 'green': []}
+        connections = dictionary.get('connections')
+        if connections:
+            self.connect1 = connections.get('1') or NO_CONNECTIONS
+            self.connect2 = connections.get('2') or NO_CONNECTIONS
         else:
-            self.connect1 = {'red': [], 'green': []}
-            self.connect2 = {'red': [], 'green': []}
-        self.connectIN = None
-        self.connectOUT = None
+            self.connect1 = NO_CONNECTIONS
+            self.connect2 = NO_CONNECTIONS
+        self.input_networks = []  # networks it reads, filled by Factsimcmd.create_networks
+
+    def side_connections(self, side):
+        """The blueprint wires of a circuit connection point, {color: [connection, ...]}."""
+        if side == 1:
+            return self.connect1
+        if side == 2:
+            return self.connect2
+        return NO_CONNECTIONS
+
+    def release_wiring(self):
+        """Drop the wire lists from the blueprint once the networks are built."""
+        self.connect1 = NO_CONNECTIONS
+        self.connect2 = NO_CONNECTIONS
+
+    def make_passive(self, output):
+        """Stop simulating the entity: it outputs output in every tick and keeps no history."""
+        self.ACTIVE = False
+        self.inputs = Unchanging(EMPTY_SIGNALS)
+        self.outputs = Unchanging(output)
 
     def advance(self):
         """Method to generate the output in the current tick with the inputs from the previous one."""
-        print("WARNING!!!: entity {} is not implemented in the simulation".format(
-            self))  # It it is not overriden
-        self.outputs += [[]]
+        raise NotImplementedError
+
+    def gather_input(self, tick):
+        """Get the inputs seen by the entity in desired tick, red and green added together."""
+        return SignalSet.total([nw.value(self.simulation, tick) for nw in self.input_networks])
+
+    def emit(self, output):
+        """Append the output of a new tick, keeping the previous object if it did not change."""
+        if output == self.outputs[-1]:
+            output = self.outputs[-1]
+        self.outputs += [output]
+
+    def rewind(self, tick):
+        """Forget the inputs and outputs from tick on (tick > 0), they are computed again when asked."""
+        if not self.ACTIVE:
+            return
+        del self.inputs[tick:]
+        del self.outputs[tick:]
+        self.tick = len(self.outputs) - 1
+
+    def restart(self):
+        """Go back to the state at load, before tick 1 was computed."""
+        self.rewind(1)
+
+    def configure(self, **changes):
+        """Change fields of the configuration (see Config.replace) and restart the entity."""
+        if getattr(self, 'config', None) is None:
+            raise ValueError('{} has no configuration to edit'.format(self))
+        self.config = self.simulation.intern_config(self.config.replace(**changes))
+        self.restart()
+
+    def produced_signals(self):
+        """Names of the signals the configuration of the entity outputs, or None if it can pass
+        on any signal of its inputs."""
+        return frozenset()
+
+    def changed(self, tick):
+        """Tell if the output in tick is different from the one in the previous tick."""
+        return tick == 0 or self.get_output(tick) is not self.outputs[tick - 1]
 
     def get_output(self, tick):
         """Get the output of an entity in desired tick.
@@ -189,518 +974,1247 @@ class ConnectedEntity(Entity):
 
 
 
+@register_entity('substation', match=lambda name: 'pole' in name.split('-'))
 class ElectricPole(ConnectedEntity):
     """Any pole of any size, is a subclass of ConnectedEntity."""
 
+    SIDES = {1: ('pole',)}
+
     def __init__(self, dictionary, simulation):
         super().__init__(dictionary, simulation)
-        self.inputs = [{'red': [], 'green': []}]
-        self.outputs = [{'red': [], 'green': []}]
+        self.inputs = [{'red': EMPTY_SIGNALS, 'green': EMPTY_SIGNALS}]
+        self.outputs = [{'red': EMPTY_SIGNALS, 'green': EMPTY_SIGNALS}]
+        self.pole_networks = {}
 
     def gather_input(self, tick):
         """Get the inputs seen by the pole in desired tick."""
-        inputs = {'red': [], 'green': []}
-        nwred = self.simulation.get_nw_with_pole(self.entity_N, 'red')
-        nwgreen = self.simulation.get_nw_with_pole(self.entity_N, 'green')
-
-        if nwred:
-            for up in nwred.upstream:
-                inputs['red'] += self.simulation.get_entity(up).get_output(tick)
-        if nwgreen:
-            for up in nwgreen.upstream:
-                inputs['green'] += self.simulation.get_entity(up).get_output(tick)
-
+        inputs = {'red': EMPTY_SIGNALS, 'green': EMPTY_SIGNALS}
+        for color, nw in self.pole_networks.items():
+            inputs[color] = nw.value(self.simulation, tick)
         return inputs
 
     def advance(self):
         self.tick += 1
         self.inputs += [self.gather_input(self.tick)]
-        input_count = {'red': {}, 'green': {}}
-
+        previous = self.outputs[-1]
+        output = {}
         for color in ('red', 'green'):
-            for i in self.inputs[self.tick].get(color):
-                logging.debug("checking .. {} in {} with color {}".format(i, self, color))
-                if isinstance(i, Signal):
-                    if i.name in input_count[color]:
-                        input_count[color][i.name] += i.count
-                    else:
-                        input_count[color][i.name] = i.count
-                    if input_count[color][i.name] == 0:
-                        del (input_count[color][i.name])
-
-        self.outputs += [{'red': [], 'green': []}]
-        for color in ('red', 'green'):
-            self.outputs[self.tick][color] += [
-                Signal({'signal': {'name': name, 'type': 'virtual'}, 'count': count}) for name, count in
-                input_count[color].items()]
-
-
+            signals = SignalSet.from_counts(
+                {name: c for name, c in self.inputs[self.tick][color].items() if c != 0})
+            output[color] = previous[color] if signals == previous[color] else signals
+        if output['red'] is previous['red'] and output['green'] is previous['green']:
+            output = previous
+        self.outputs += [output]
+
+
+def constant_filters(c_behavior):
+    """The signals of a constant combinator as 1.x filters, from the 1.x filters or the enabled 2.0
+    sections, whose signal type is omitted for items. Qualities are ignored."""
+    if 'sections' not in c_behavior:
+        return c_behavior.get('filters', [])
+    return [{'signal': {'name': f.get('name'), 'type': f.get('type', 'item')}, 'count': f.get('count'),
+             'index': f.get('index')}
+            for section in c_behavior['sections'].get('sections', []) if section.get('active', True)
+            for f in section.get('filters', [])]
+
+
+@register_entity('constant-combinator')
 class Constant_Combinator(ConnectedEntity):
     """Constant combinator, outputs constant signal."""
 
+    SIDES = {1: ('out',)}
+
     def __init__(self, dictionary, simulation):
         super().__init__(dictionary, simulation)
-        self.c_behavior = dictionary.get('control_behavior').get('filters')
-        self.is_on = dictionary.get('control_behavior').get('is_on', True)
-        self.connectOUT = self.connect1
+        c_behavior = dictionary.get('control_behavior') or {}
+        self.is_on = c_behavior.get('is_on', True)
+        self.signals = simulation.intern_config(SignalSet(Signal(con) for con in constant_filters(c_behavior)))
         if self.is_on:
-            self.outputs = [[Signal(con) for con in self.c_behavior]]
+            self.outputs = [self.signals]
         else:
-            self.outputs = [[]]
+            self.outputs = [EMPTY_SIGNALS]
+
+    def restart(self):
+        self.tick = 0
+        self.outputs = [self.signals if self.is_on else EMPTY_SIGNALS]
+
+    def configure(self, signals=None, is_on=None):
+        """Change the signals, a {name: count} dictionary, and/or is_on, and restart."""
+        if signals is not None:
+            # as in the blueprint, signals set to 0 are kept
+            kinds = {name: self.signals.kind(name) if name in self.signals else
+                     'virtual' if name.startswith('signal-') else 'item' for name in signals}
+            signalset = SignalSet.from_counts({name: int32(c) for name, c in signals.items()},
+                                              {name: kind for name, kind in kinds.items() if kind != 'virtual'})
+            self.signals = self.simulation.intern_config(signalset if signals else EMPTY_SIGNALS)
+        if is_on is not None:
+            self.is_on = is_on
+        self.restart()
+
+    def produced_signals(self):
+        return frozenset(self.signals.names()) if self.is_on else frozenset()
+
     def advance(self):
         self.tick += 1
         if self.is_on:
-            self.outputs += [[Signal(con) for con in self.c_behavior]]
+            self.outputs += [self.signals]
         else:
-            self.outputs += [[]]
+            self.outputs += [EMPTY_SIGNALS]
 
 
+@register_entity('pushbutton')
 class Pushbutton(Constant_Combinator):
     """Pulses a signal for one tick in tick nr 1"""
 
     def __init__(self, dictionary, simulation):
         super().__init__(dictionary, simulation)
-        self.outputs = [[], [Signal(con) for con in self.c_behavior]]
+        self.outputs = [EMPTY_SIGNALS, self.signals]
+
+    def restart(self):
+        self.tick = 0
+        self.outputs = [EMPTY_SIGNALS, self.signals]
 
     def advance(self):
         self.tick += 1
-        self.outputs += [[]]
+        self.outputs += [EMPTY_SIGNALS]
 
 
+@register_entity(match=lambda name: 'lamp' in name.split('-'))
 class Lamp(ConnectedEntity):
     """Lamp that emits light depending on a condition"""
 
     def __init__(self, dictionary, simulation):
         super().__init__(dictionary, simulation)
-        self.connectIN = self.connect1
-        self.c_behavior = dictionary.get('control_behavior').get('circuit_condition')
-        self.first_signal = self.c_behavior.get('first_signal')
-        self.constant = self.c_behavior.get('constant')
-        self.second_signal = self.c_behavior.get('second_signal')
-        self.comparator = self.c_behavior.get('comparator')
-        if self.comparator == '=':
-            self.comparator = '=='
-        elif self.comparator == '≥':
-            self.comparator = '>='
-        elif self.comparator == '≤':
-            self.comparator = '<='
-        elif self.comparator == '≠':
-            self.comparator = '!='
-        # Initialize, so if there is output in tick 0 we get it
-        self.advance()
-        self.tick -= 1
-        self.inputs = [self.inputs[1]]
-        self.outputs = [self.outputs[1]]
-
-    def gather_input(self, tick):
-        """Get the inputs seen by the Lamp in desired tick."""
-        inputs = []
-        nwred = self.simulation.get_nw_with_downstream(self.entity_N, 'red')
-        nwgreen = self.simulation.get_nw_with_downstream(self.entity_N, 'green')
-
-        if nwred:
-            for up in nwred.upstream:
-                inputs += self.simulation.get_entity(up).get_output(tick)
-        if nwgreen:
-            for up in nwgreen.upstream:
-                inputs += self.simulation.get_entity(up).get_output(tick)
-
-        return inputs
+        c_behavior = dictionary.get('control_behavior') or {}
+        self.config = simulation.intern_config(ConditionConfig.from_dict(c_behavior.get('circuit_condition', {})))
+        self.use_colors = bool(c_behavior.get('use_colors'))
+        if self.use_colors and c_behavior.get('color_mode', 0) != 0:
+            simulation.context.log.warning('Only colour signals are simulated for the colour of {}'.format(self))
+        self.restart()
+
+    def restart(self):
+        # at load the networks do not exist yet, so tick 0 is evaluated without inputs
+        self.tick = 0
+        self.inputs = [EMPTY_SIGNALS]
+        self.outputs = [self.evaluate({})]
 
     def advance(self):
-        self.inputs += [self.gather_input(self.tick)]
+        inputs = self.gather_input(self.tick)
+        unchanged = inputs is self.inputs[self.tick]
+        self.inputs += [inputs]
         self.tick += 1
-        input_count = {}
-        for i in self.inputs[self.tick]:
-            logging.debug("checking .. {} in {}".format(i, self))
-            if isinstance(i, Signal):
-                if i.name in input_count:
-                    input_count[i.name] += i.count
-                    input_count[i.name] = int32(input_count[i.name])
-                else:
-                    input_count[i.name] = i.count
-
-        self.outputs += [{}]
-
-        if not self.first_signal:
-            return
-        if self.constant != None:
-            compare_value = self.constant
-        elif self.second_signal:
-            compare_value = input_count.get(
-                self.second_signal.get('name'), 0)
+        # the same input object gives the same light, large lamp displays mostly stay the same
+        self.emit(self.outputs[self.tick - 1] if unchanged else self.evaluate(inputs))
+
+    def evaluate(self, input_count):
+        """Get the light status for the given input counts, a dictionary or a SignalSet."""
+        config = self.config
+        if not config.first_signal or not config.comparator:
+            return LAMP_UNSET
+        if config.constant != None:
+            compare_value = config.constant
+        elif config.second_signal:
+            compare_value = input_count.get(config.second_signal, 0)
         else:
-            return
-
-        logging.debug(
-            'Evaluating {} {} {} in {}'.format(self.first_signal.get('name'), self.comparator, str(compare_value),
-                                               self))
-        if self.first_signal.get('name') == 'signal-everything':
-
-            result = all([eval(str(c) + self.comparator + str(compare_value)) for c in input_count.values()])
-            if result:
-                self.outputs[self.tick] = {'light': 'ON', 'color': 'white'}       # no colors for now
-            else:
-                self.outputs[self.tick] = {'light': 'OFF', 'color': 'white'}
-
-        elif self.first_signal.get('name') == 'signal-anything':
-
-            result = any([eval(str(c) + self.comparator + str(compare_value)) for c in input_count.values()])
-            if result:
-                self.outputs[self.tick] = {'light': 'ON', 'color': 'white'}  # no colors for now
-            else:
-                self.outputs[self.tick] = {'light': 'OFF', 'color': 'white'}
-
+            return LAMP_UNSET
+        compare = COMPARISONS[config.comparator]
+        if config.first_signal == 'signal-everything':
+            result = all(compare(c, compare_value) for c in input_count.values())
+        elif config.first_signal == 'signal-anything':
+            result = any(compare(c, compare_value) for c in input_count.values())
         else:
-            test_value = input_count.get(self.first_signal.get('name'), 0)
+            result = compare(input_count.get(config.first_signal, 0), compare_value)
+        if not result:
+            return LAMP_OFF
+        if self.use_colors:
+            for color in LAMP_SIGNAL_COLORS:
+                if input_count.get('signal-' + color, 0) > 0:
+                    return LAMP_LIT[color]
+        return LAMP_ON
 
-            condition = str(test_value) + self.comparator + str(compare_value)
 
-            result = eval(condition)
+# outputs of deciders and arithmetic combinators that pass on input signals
+RELAY_OUTPUTS = ('signal-everything', 'signal-anything', 'signal-each')
 
-            logging.debug('Evaluating {} = {}: {} in {}'.format(self.first_signal.get('name'), condition, result, self))
-
-            if result:
-                self.outputs[self.tick] = {'light': 'ON', 'color': 'white'}  # no colors for now
-            else:
-                self.outputs[self.tick] = {'light': 'OFF', 'color': 'white'}
 
 class Combinator(ConnectedEntity):
     """Generic class for combinators with 2 attachments"""
 
+    SIDES = {1: ('in',), 2: ('out',)}
+
     def __init__(self, dictionary, simulation):
         super().__init__(dictionary, simulation)
         self.direction = dictionary.get('direction')
-        self.c_behavior = dictionary.get('control_behavior')
-        self.connectIN = self.connect1
-        self.connectOUT = self.connect2
-
-    def gather_input(self, tick):
-        """Get the inputs seen by the combinator in desired tick."""
-        inputs = []
-        nwred = self.simulation.get_nw_with_downstream(self.entity_N, 'red')
-        nwgreen = self.simulation.get_nw_with_downstream(self.entity_N, 'green')
-
-        if nwred:
-            for up in nwred.upstream:
-                inputs += self.simulation.get_entity(up).get_output(tick)
-        if nwgreen:
-            for up in nwgreen.upstream:
-                inputs += self.simulation.get_entity(up).get_output(tick)
 
-        return inputs
+    def restart(self):
+        # at load the networks do not exist yet, so tick 0 is evaluated without inputs
+        self.tick = 0
+        self.inputs = [EMPTY_SIGNALS]
+        self.outputs = [self.evaluate({})]
 
     def advance(self):
+        self.inputs += [self.gather_input(self.tick)]
+        self.tick += 1
+        input_count = {name: c for name, c in self.inputs[self.tick].items() if c != 0}
+        self.emit(self.evaluate(input_count))
+
+    def evaluate(self, input_count):
+        """Get the output SignalSet for the given input counts (signals with count 0 left out)."""
         raise NotImplementedError
 
+    def produced_signals(self):
+        # a combinator without a config with an output_signal may output anything it reads
+        output = getattr(getattr(self, 'config', None), 'output_signal', RELAY_OUTPUTS[0])
+        if output in RELAY_OUTPUTS:
+            return None
+        return frozenset([output]) if output else frozenset()
 
+
+@register_entity('decider-combinator')
 class Decider(Combinator):
     """Decider combinator, given a condition decides if a signal must output"""
     def __init__(self, dictionary, simulation):
         super().__init__(dictionary, simulation)
-        self.c_behavior = self.c_behavior.get('decider_conditions')
-        self.first_signal = self.c_behavior.get('first_signal')
-        self.constant = self.c_behavior.get('constant')
-        self.second_signal = self.c_behavior.get('second_signal')
-        self.output_signal = self.c_behavior.get('output_signal')
-        self.copy_count = self.c_behavior.get('copy_count_from_input')
-        self.comparator = self.c_behavior.get('comparator')
-        if self.comparator == '=':
-            self.comparator = '=='
-        elif self.comparator == '≥':
-            self.comparator = '>='
-        elif self.comparator == '≤':
-            self.comparator = '<='
-        elif self.comparator == '≠':
-            self.comparator = '!='
+        c_behavior = dictionary.get('control_behavior') or {}
+        conditions = legacy_decider_conditions(c_behavior.get('decider_conditions', {}))
+        if conditions is None:
+            simulation.context.log.warning('{}: only one condition and one output on both wires are simulated, '
+                                           'it outputs nothing'.format(self))
+            conditions = {}
+        self.config = simulation.intern_config(DeciderConfig.from_dict(conditions))
         # Initialize, so if there is output in tick 0 we get it
         self.advance()
         self.tick -= 1
         self.inputs = [self.inputs[1]]
         self.outputs = [self.outputs[1]]
 
-    def advance(self):
-        self.inputs += [self.gather_input(self.tick)]
-        self.tick += 1
-        input_count = {}
-        for i in self.inputs[self.tick]:
-            logging.debug("checking .. {} in {}".format(i, self))
-            if isinstance(i, Signal):
-                if i.name in input_count:
-                    input_count[i.name] += i.count
-                    input_count[i.name] = int32(input_count[i.name])
-                else:
-                    input_count[i.name] = i.count
-                if input_count[i.name] == 0:
-                    del(input_count[i.name])
+    def evaluate(self, input_count):
+        output = {}
 
-        self.outputs += [[]]
+        if not self.config.first_signal or not self.config.output_signal or not self.config.comparator:
+            return EMPTY_SIGNALS
 
-
-        if not self.first_signal or not self.output_signal:
-            return
-
-        if self.constant != None:
-            compare_value = self.constant
-        elif self.second_signal:
+        if self.config.constant != None:
+            compare_value = self.config.constant
+        elif self.config.second_signal:
             compare_value = input_count.get(
-                self.second_signal.get('name'), 0)
+                self.config.second_signal, 0)
         else:
-            return
+            return EMPTY_SIGNALS
 
-        logging.debug(
-            'Evaluating {} {} {} in {}'.format(self.first_signal.get('name'), self.comparator, str(compare_value), self))
+        self.simulation.context.log.debug(
+            'Evaluating {} {} {} in {}'.format(self.config.first_signal, self.config.comparator, str(compare_value), self))
+        compare = COMPARISONS[self.config.comparator]
 
-        if self.first_signal.get('name') == 'signal-everything':
+        if self.config.first_signal == 'signal-everything':
 
-            result = all([eval(str(c) + self.comparator + str(compare_value)) for c in input_count.values()])
+            result = all(compare(c, compare_value) for c in input_count.values())
             if result:
-                if self.output_signal.get('name') == 'signal-everything':
-                    if self.copy_count:
-                        self.outputs[self.tick] += [
-                            Signal({'signal': {'name': name, 'type': 'virtual'}, 'count': count}) for name, count in
-                            input_count.items() if count != 0]
+                if self.config.output_signal == 'signal-everything':
+                    if self.config.copy_count:
+                        for name, count in input_count.items():
+                            if count != 0:
+                                output[name] = count
                     else:
-                        self.outputs[self.tick] += [
-                            Signal({'signal': {'name': name, 'type': 'virtual'}, 'count': 1}) for name in
-                            input_count.keys()]
+                        for name in input_count.keys():
+                            output[name] = 1
                 else:
-                    name = self.output_signal.get('name')
-                    if self.copy_count:
+                    name = self.config.output_signal
+                    if self.config.copy_count:
                         count = input_count.get(name, 0)
                         if count != 0:
-                            self.outputs[self.tick] += [
-                                Signal({'signal': {'name': name, 'type': 'virtual'}, 'count': count})]
+                            output[name] = count
                     else:
-                        self.outputs[self.tick] += [
-                            Signal({'signal': {'name': name, 'type': 'virtual'}, 'count': 1})]
+                        output[name] = 1
 
 
-        elif self.first_signal.get('name') == 'signal-anything':
+        elif self.config.first_signal == 'signal-anything':
 
-            result = any([eval(str(c) + self.comparator + str(compare_value)) for c in input_count.values()])
+            result = any(compare(c, compare_value) for c in input_count.values())
             if result:
-                if self.output_signal.get('name') == 'signal-everything':
-                    if self.copy_count:
-                        self.outputs[self.tick] += [
-                            Signal({'signal': {'name': name, 'type': 'virtual'}, 'count': count}) for name, count in
-                            input_count.items() if count != 0]
+                if self.config.output_signal == 'signal-everything':
+                    if self.config.copy_count:
+                        for name, count in input_count.items():
+                            if count != 0:
+                                output[name] = count
                     else:
-                        self.outputs[self.tick] += [
-                            Signal({'signal': {'name': name, 'type': 'virtual'}, 'count': 1}) for name in
-                            input_count.keys()]
-                elif self.output_signal.get('name') == 'signal-anything':
-                    logging.warning('Using signal-anything in the output with non-vanilla signals can result \
+                        for name in input_count.keys():
+                            output[name] = 1
+                elif self.config.output_signal == 'signal-anything':
+                    self.simulation.context.log.warning('Using signal-anything in the output with non-vanilla signals can result \
                                     in a different output than inside the game as the ordering in-game is not \
                                     exported in the blueprint')
-                    sorted_signals = sorted(input_count.keys(), key=lambda x: sig_sort(x))
+                    sorted_signals = sorted(input_count.keys(), key=self.simulation.context.sig_sort)
                     name = sorted_signals[0]
-                    if self.copy_count:
+                    if self.config.copy_count:
                         count = input_count.get(name, 0)
                     else:
                         count = 1
                     if count != 0:
-                        self.outputs[self.tick] += [
-                            Signal({'signal': {'name': name, 'type': 'virtual'}, 'count': count})]
+                        output[name] = count
 
                 else:
-                    name = self.output_signal.get('name')
-                    if self.copy_count:
+                    name = self.config.output_signal
+                    if self.config.copy_count:
                         count = input_count.get(name, 0)
                     else:
                         count = 1
                     if count != 0:
-                        self.outputs[self.tick] += [
-                            Signal({'signal': {'name': name, 'type': 'virtual'}, 'count': count})]
+                        output[name] = count
 
 
-        elif self.first_signal.get('name') == 'signal-each':
-            if self.output_signal.get('name') == 'signal-each':
+        elif self.config.first_signal == 'signal-each':
+            if self.config.output_signal == 'signal-each':
                 for inp, c in input_count.items():
-                    condition = str(c) + self.comparator + str(compare_value)
-                    result = eval(condition)
+                    result = compare(c, compare_value)
                     if result:
                         name = inp
-                        if self.copy_count:
+                        if self.config.copy_count:
                             count = c
                         else:
                             count = 1
                         if count != 0:
-                            self.outputs[self.tick] += [Signal({'signal': {'name': name, 'type': 'virtual'},
-                                                                'count': count})]
+                            output[name] = count
 
             else:
                 count = 0
                 for inp, c in input_count.items():
-                    condition = str(c) + self.comparator + str(compare_value)
-                    result = eval(condition)
+                    result = compare(c, compare_value)
                     if result:
                         count += c
                         count = int32(count)
-                name = self.output_signal.get('name')
+                name = self.config.output_signal
                 if count != 0:
-                    self.outputs[self.tick] += [Signal({'signal': {'name': name, 'type': 'virtual'}, 'count': count})]
+                    output[name] = count
 
 
 
         else:
-            test_value = input_count.get(self.first_signal.get('name'), 0)
-
-            condition = str(test_value) + self.comparator + str(compare_value)
+            test_value = input_count.get(self.config.first_signal, 0)
 
-            result = eval(condition)
+            result = compare(test_value, compare_value)
 
-            logging.debug('Evaluating {} = {}: {} in {}'.format(self.first_signal.get('name'), condition, result, self))
+            self.simulation.context.log.debug('Evaluating {} = {}: {} in {}'.format(self.config.first_signal, test_value, result, self))
 
             if result:
-                name = self.output_signal.get('name')
-                if self.copy_count:
+                name = self.config.output_signal
+                if self.config.copy_count:
                     count = input_count.get(name, 0)
                 else:
                     count = 1
                 if count != 0:
-                    self.outputs[self.tick] += [Signal({'signal': {'name': name, 'type': 'virtual'}, 'count': count})]
+                    output[name] = count
+
+        return SignalSet.from_counts(output)
 
 
+@register_entity('arithmetic-combinator')
 class Arithmetic(Combinator):
     """Arithmetic combinator, given inputs and operation generates output"""
     
     def __init__(self, dictionary, simulation):
         super().__init__(dictionary, simulation)
-        self.c_behavior = self.c_behavior.get('arithmetic_conditions')
-        self.first_signal = self.c_behavior.get('first_signal')
-        self.second_constant = self.c_behavior.get('second_constant')
-        self.second_signal = self.c_behavior.get('second_signal')
-        self.output_signal = self.c_behavior.get('output_signal')
-        self.operation = self.c_behavior.get('operation')
-        if self.operation == '^':
-            self.operation = '**'
-        elif self.operation == 'AND':
-            self.operation = '&'
-        elif self.operation == 'OR':
-            self.operation = '|'
-        elif self.operation == 'XOR':
-            self.operation = '^'
+        c_behavior = dictionary.get('control_behavior') or {}
+        self.config = simulation.intern_config(ArithmeticConfig.from_dict(c_behavior.get('arithmetic_conditions', {})))
 
-    def advance(self):
-        self.inputs += [self.gather_input(self.tick)]
-        self.tick += 1
-        input_count = {}
-        for i in self.inputs[self.tick]:
-            logging.debug("processing .. {} in {}".format(i, self))
-            if isinstance(i, Signal):
-                if i.name in input_count:
-                    input_count[i.name] += i.count
-                    input_count[i.name] = int32(input_count[i.name])
-                else:
-                    input_count[i.name] = i.count
-                if input_count[i.name] == 0:
-                    del(input_count[i.name])
+    def restart(self):
+        # unlike deciders, arithmetic combinators are not evaluated for tick 0 at load
+        self.tick = 0
+        self.inputs = [EMPTY_SIGNALS]
+        self.outputs = [EMPTY_SIGNALS]
 
-        self.outputs += [[]]
+    def evaluate(self, input_count):
+        output = {}
 
-        if not self.first_signal or not self.output_signal:
-            return
+        if not self.config.first_signal or not self.config.output_signal or not self.config.operation:
+            return EMPTY_SIGNALS
 
-        if self.second_constant != None:
-            second_term = self.second_constant
-        elif self.second_signal:
+        if self.config.second_constant != None:
+            second_term = self.config.second_constant
+        elif self.config.second_signal:
             second_term = input_count.get(
-                self.second_signal.get('name'), 0)
+                self.config.second_signal, 0)
         else:
-            return
+            return EMPTY_SIGNALS
 
-        logging.debug(
-            'Processing {} {} {} in {}'.format(self.first_signal.get('name'), self.operation, str(second_term), self))
+        self.simulation.context.log.debug(
+            'Processing {} {} {} in {}'.format(self.config.first_signal, self.config.operation, str(second_term), self))
+        apply = ARITHMETIC[self.config.operation]
 
-        if self.first_signal.get('name') == 'signal-each':
-            if self.output_signal.get('name') == 'signal-each':
+        if self.config.first_signal == 'signal-each':
+            if self.config.output_signal == 'signal-each':
                 for inp, c in input_count.items():
-                    operation = str(c) + self.operation + str(second_term)
-                    if self.operation == '/' and c == 0:
+                    if self.config.operation == '/' and c == 0:
                         result = 0
                     else:
-                        result = int(eval(operation))
+                        result = apply(c, second_term)
                     if result != 0:
                         result = int32(result)
                         name = inp
-                        self.outputs[self.tick] += [Signal({'signal': {'name': name, 'type': 'virtual'},
-                                                            'count': result})]
+                        output[name] = result
 
             else:
-                name = self.output_signal.get('name')
+                name = self.config.output_signal
                 total = 0
                 for inp, c in input_count.items():
-                    operation = str(c) + self.operation + str(second_term)
-                    if self.operation == '/' and c == 0:
+                    if self.config.operation == '/' and c == 0:
                         result = 0
                     else:
-                        result = int(eval(operation))
+                        result = apply(c, second_term)
                     result = int32(result)
                     total += result
                     total = int32(total)
 
                 if total != 0:
-                    self.outputs[self.tick] += [Signal({'signal': {'name': name, 'type': 'virtual'},
-                                                        'count': total})]
+                    output[name] = total
 
         else:
-            first_term = input_count.get(self.first_signal.get('name'), 0)
-            if self.operation == '/' and first_term == 0:
-                return
-            operation = str(first_term) + self.operation + str(second_term)
-            result = eval(operation)
+            first_term = input_count.get(self.config.first_signal, 0)
+            if self.config.operation == '/' and first_term == 0:
+                return EMPTY_SIGNALS
+            result = apply(first_term, second_term)
             if result != 0:
                 result = int32(result)
-                name = self.output_signal.get('name')
-                self.outputs[self.tick] += [Signal({'signal': {'name': name, 'type': 'virtual'},
-                                                    'count': result})]
+                name = self.config.output_signal
+                output[name] = result
+
+        return SignalSet.from_counts(output)
+
+
+class SelectorConfig(Config):
+    """Selector combinator settings, only the operations 'select' and 'count' are simulated."""
+
+    __slots__ = ('operation', 'select_max', 'index_constant', 'index_signal', 'count_signal')
+    OPERATIONS = ('select', 'count', 'random', 'stack-size', 'rocket-capacity', 'quality-filter', 'quality-transfer')
+
+    @classmethod
+    def from_dict(cls, c_behavior):
+        return cls(operation=c_behavior.get('operation', 'select'),
+                   select_max=c_behavior.get('select_max', True),
+                   index_constant=c_behavior.get('index_constant', 0),
+                   index_signal=signal_name(c_behavior.get('index_signal')),
+                   count_signal=signal_name(c_behavior.get('count_signal')))
+
+
+@register_entity('selector-combinator')
+class Selector(Combinator):
+    """Selector combinator of Factorio 2.0.
+
+    'select' outputs the input signal found at an index once sorted by count, largest first if
+    select_max (ties are broken by the signal order), 'count' outputs how many input signals
+    there are. The other operations depend on items, qualities or chance and output nothing.
+    """
+
+    def __init__(self, dictionary, simulation):
+        super().__init__(dictionary, simulation)
+        c_behavior = dictionary.get('control_behavior') or {}
+        self.config = simulation.intern_config(SelectorConfig.from_dict(c_behavior))
+        if self.config.operation not in ('select', 'count'):
+            simulation.context.log.warning('{}: the operation {} is not simulated'.format(self, self.config.operation))
+        self.restart()
+
+    def evaluate(self, input_count):
+        if self.config.operation == 'count':
+            if not self.config.count_signal or not input_count:
+                return EMPTY_SIGNALS
+            return SignalSet.from_counts({self.config.count_signal: len(input_count)})
+        if self.config.operation != 'select' or not input_count:
+            return EMPTY_SIGNALS
+        if self.config.index_signal:
+            index = input_count.get(self.config.index_signal, 0)
+        else:
+            index = self.config.index_constant or 0
+        if not 0 <= index < len(input_count):
+            return EMPTY_SIGNALS
+        sig_sort = self.simulation.context.sig_sort
+        sign = -1 if self.config.select_max else 1
+        name = sorted(input_count, key=lambda name: (sign * input_count[name], sig_sort(name)))[index]
+        return SignalSet.from_counts({name: input_count[name]})
+
+    def produced_signals(self):
+        if self.config.operation == 'select':
+            return None
+        if self.config.operation == 'count' and self.config.count_signal:
+            return frozenset([self.config.count_signal])
+        return frozenset()
+
+
+ENABLED = MappingProxyType({'enabled': True})
+DISABLED = MappingProxyType({'enabled': False})
+
+
+class ControlledEntity(ConnectedEntity):
+    """Entity that its circuit condition enables or disables, its output is ENABLED or DISABLED.
+
+    Only the condition is simulated. What these entities read into the network (hand or belt
+    contents, trains) depends on items and trains, which FactSim does not simulate, so they add no
+    signals to it. Without an enable condition the entity is passive and always ENABLED.
+    """
+
+    def __init__(self, dictionary, simulation):
+        super().__init__(dictionary, simulation)
+        c_behavior = dictionary.get('control_behavior') or {}
+        enabled_by_circuit = c_behavior.get('circuit_enable_disable', c_behavior.get('circuit_enabled'))
+        if enabled_by_circuit is None and 'circuit_condition' in c_behavior:
+            # inserters of Factorio 1.1 only tell the mode, 0 is enable/disable
+            enabled_by_circuit = c_behavior.get('circuit_mode_of_operation', 0) == 0
+        if not enabled_by_circuit:
+            self.config = None
+            self.make_passive(ENABLED)
+            return
+        self.config = simulation.intern_config(ConditionConfig.from_dict(c_behavior.get('circuit_condition', {})))
+        self.restart()
+
+    def restart(self):
+        if not self.ACTIVE:
+            return
+        self.tick = 0
+        self.inputs = [EMPTY_SIGNALS]
+        self.outputs = [self.evaluate({})]
+
+    def advance(self):
+        self.inputs += [self.gather_input(self.tick)]
+        self.tick += 1
+        self.emit(self.evaluate(dict(self.inputs[self.tick].items())))
+
+    def evaluate(self, input_count):
+        """ENABLED or DISABLED for the given input counts, a condition without signal is false."""
+        config = self.config
+        if not config.first_signal or not config.comparator:
+            return DISABLED
+        compare = COMPARISONS[config.comparator]
+        if config.second_signal:
+            value = input_count.get(config.second_signal, 0)
+        else:
+            value = config.constant or 0
+        if config.first_signal == 'signal-everything':
+            result = all(compare(c, value) for c in input_count.values())
+        elif config.first_signal == 'signal-anything':
+            result = any(compare(c, value) for c in input_count.values())
+        else:
+            result = compare(input_count.get(config.first_signal, 0), value)
+        return ENABLED if result else DISABLED
+
+
+@register_entity(match=lambda name: name.split('-')[-1] == 'inserter')
+class Inserter(ControlledEntity):
+    """Inserter of any kind."""
+
+
+@register_entity(match=lambda name: name.endswith('transport-belt'))
+class Belt(ControlledEntity):
+    """Transport belt of any speed."""
+
+
+@register_entity('train-stop')
+class TrainStop(ControlledEntity):
+    """Train stop, it does not read or send trains as trains are not simulated."""
+
+
+class PassiveEntity(ConnectedEntity):
+    """Entity that FactSim does not simulate. It joins the wires connected to it but never
+    outputs anything, and costs nothing per tick."""
+
+    def __init__(self, dictionary, simulation):
+        super().__init__(dictionary, simulation)
+        self.make_passive(EMPTY_SIGNALS)
+
+
+COMPARISONS = {'<': operator.lt, '>': operator.gt, '=': operator.eq, '==': operator.eq, '≥': operator.ge,
+               '>=': operator.ge, '≤': operator.le, '<=': operator.le, '≠': operator.ne, '!=': operator.ne}
+
+
+def signal_condition(source, signal, comparator, value):
+    """Build a watch condition comparing a signal of an entity output or of a network with a value.
+
+    source is an entity with signal outputs or a Network, comparator any Factorio or python
+    comparison ('>', '≥', '!=', ...) and value an integer. Missing signals count as 0. A network
+    condition keeps the network it reads in its network attribute.
+    """
+    if comparator not in COMPARISONS:
+        raise ValueError('Unknown comparator {!r}'.format(comparator))
+    _checked_int(value, 'The watched value')
+    signal_outputs = isinstance(source, Entity) and isinstance(source.outputs[-1], SignalSet)
+    if not (isinstance(source, Network) or signal_outputs):
+        raise ValueError('Cannot watch {}, it is neither a network nor an entity with signal outputs'.format(source))
+    compare = COMPARISONS[comparator]
+    if isinstance(source, Network):
+        def condition(simulation, tick):
+            return compare(source.value(simulation, tick).get(signal, 0), value)
+        condition.network = source
+    else:
+        def condition(simulation, tick):
+            return compare(source.get_output(tick).get(signal, 0), value)
+    return condition
+
+
+STIMULUS_ACTIONS = ('set', 'pulse', 'ramp', 'on', 'off', 'toggle')
+
+
+class Stimulus():
+    """An input event the simulation applies before computing tick.
+
+    The target is either a constant combinator, entity=N, or a network, network=N, on which the
+    signals are injected as if one more constant combinator were connected to it. The action is
+    'set' signal to value from tick on (0 removes it), 'pulse' it to value for duration ticks and
+    back unless another stimulus changed it meanwhile, 'ramp' it from its current count to value in
+    duration ticks, or for a combinator, switch it 'on', 'off' or 'toggle' it. kind is the signal
+    type, guessed from the name if None.
+    """
+
+    __slots__ = ('tick', 'entity', 'network', 'signal', 'value', 'action', 'duration', 'kind')
+
+    def __init__(self, tick, entity=None, network=None, signal=None, value=0, action='set', duration=1,
+                 kind=None):
+        if (entity is None) == (network is None):
+            raise ValueError('A stimulus needs either an entity or a network')
+        if action not in STIMULUS_ACTIONS:
+            raise ValueError('Unknown stimulus action {}'.format(action))
+        if action in ('on', 'off', 'toggle'):
+            if entity is None:
+                raise ValueError('Only entities can be switched {}'.format(action))
+        elif not signal:
+            raise ValueError('The stimulus action {} needs a signal'.format(action))
+        if duration < 1:
+            raise ValueError('The stimulus duration must be at least 1 tick')
+        self.tick = tick
+        self.entity = entity
+        self.network = network
+        self.signal = signal
+        self.value = value
+        self.action = action
+        self.duration = duration
+        self.kind = kind
+
+    @classmethod
+    def from_dict(cls, dictionary):
+        """Build a Stimulus from a json object or csv row, empty csv fields are left to default."""
+        fields = {key: value for key, value in dictionary.items() if value not in (None, '')}
+        for key in ('tick', 'entity', 'network', 'value', 'duration'):
+            if key in fields:
+                fields[key] = int(fields[key])
+        return cls(**fields)
+
+    def __repr__(self):
+        target = 'entity={}'.format(self.entity) if self.network is None else 'network={}'.format(self.network)
+        return 'Stimulus(tick={}, {}, signal={!r}, value={}, action={!r}, duration={})'.format(
+            self.tick, target, self.signal, self.value, self.action, self.duration)
+
+
+def read_stimuli(filename):
+    """Stream the Stimulus events in a file, one per line: json objects with the Stimulus fields,
+    or csv with a header naming them, e.g. tick,entity,network,signal,value,action,duration.
+
+    The file is read as the events are consumed, so traces longer than memory can be scheduled.
+    """
+    with open(filename, encoding='utf-8', newline='') as file:
+        first = file.readline()
+        if first.lstrip().startswith('{'):
+            for line in chain([first], file):
+                if line.strip():
+                    yield Stimulus.from_dict(json.loads(line))
+        else:
+            for row in csv.DictReader(chain([first], file)):
+                yield Stimulus.from_dict(row)
+
+
+class StimulusSchedule():
+    """The stimuli a simulation still has to apply.
+
+    Every schedule added is an iterable of Stimulus (or dictionaries) in tick order, and is only
+    consumed as the simulation reaches the ticks, so a long trace from read_stimuli is never held
+    in memory. The later changes of pulses and ramps wait in a heap.
+    """
+
+    def __init__(self):
+        self.sources = []  # [next stimulus, iterator] per schedule
+        self.pending = []  # heap of (tick, sequence, change), change(tick) applies it
+        self.stimulated = set()  # numbers of the entities changed by a stimulus
+        self._sequence = count()
+
+    def __bool__(self):
+        return bool(self.sources or self.pending)
+
+    @staticmethod
+    def _next(iterator):
+        stimulus = next(iterator, None)
+        return Stimulus.from_dict(stimulus) if isinstance(stimulus, dict) else stimulus
+
+    def add(self, stimuli):
+        iterator = iter(stimuli)
+        first = self._next(iterator)
+        if first is not None:
+            self.sources += [[first, iterator]]
+
+    def later(self, tick, change):
+        heapq.heappush(self.pending, (tick, next(self._sequence), change))
+
+    def apply(self, simulation, tick):
+        """Apply everything due in tick, before the simulation computes it."""
+        while self.pending and self.pending[0][0] <= tick:
+            heapq.heappop(self.pending)[2](tick)
+        for source in list(self.sources):
+            while source[0] is not None and source[0].tick <= tick:
+                if source[0].tick < tick:
+                    raise ValueError('{} is scheduled before tick {}, which is already being computed. '
+                                     'Stimuli must come in tick order'.format(source[0], tick))
+                self.start(simulation, source[0], tick)
+                source[0] = self._next(source[1])
+            if source[0] is None:
+                self.sources.remove(source)
+
+    def start(self, simulation, stimulus, tick):
+        if stimulus.entity is not None:
+            target = simulation.get_entity(stimulus.entity)
+            if not isinstance(target, Constant_Combinator):
+                raise ValueError('{} is not a constant combinator, it cannot take {}'.format(target, stimulus))
+            if isinstance(target, Pushbutton):
+                raise ValueError('{} only outputs its signals in tick 1, it cannot take {}'.format(target, stimulus))
+            self.stimulated.add(stimulus.entity)
+            if stimulus.action in ('on', 'off', 'toggle'):
+                target.is_on = not target.is_on if stimulus.action == 'toggle' else stimulus.action == 'on'
+                simulation.circuit_index.update_entity(target)
+                return
+
+            def current(tick):
+                return target.signals.get(stimulus.signal)
+
+            def put(tick, value):
+                target.signals = target.signals.with_count(stimulus.signal, value, stimulus.kind)
+                simulation.circuit_index.update_entity(target)
+        else:
+            target = simulation.get_network(stimulus.network)
+            if target is None:
+                raise ValueError('There is no network {} for {}'.format(stimulus.network, stimulus))
+
+            def current(tick):
+                return target.injected(tick).get(stimulus.signal)
+
+            def put(tick, value):
+                target.inject(tick, stimulus.signal, value, stimulus.kind)
+
+        if stimulus.action == 'set':
+            put(tick, stimulus.value)
+        elif stimulus.action == 'pulse':
+            before = current(tick)
+            put(tick, stimulus.value)
+
+            def restore(tick):
+                if current(tick) == int32(stimulus.value):  # else a later stimulus changed it
+                    put(tick, before)
+            self.later(tick + stimulus.duration, restore)
+        else:
+            start = current(tick)
+
+            def ramp(tick, step):
+                put(tick, start + (stimulus.value - start) * step // stimulus.duration)
+                if step < stimulus.duration:
+                    self.later(tick + 1, partial(ramp, step=step + 1))
+            ramp(tick, 1)
+
+
+class Watch():
+    """A condition checked by the simulation after every tick it computes.
+
+    condition is called with (simulation, tick) and returns True on a hit. Hits are counted and the
+    first and last hit ticks kept. action tells what else to do on a hit: 'count' nothing, 'log'
+    log it at INFO on the 'factsim.watch' logger, whatever the loglevel of the simulation, 'stop'
+    halt the running advance_to / run / run_until after that tick.
+    """
+
+    log = logging.getLogger('factsim.watch')
+    log.setLevel(logging.INFO)
+
+    def __init__(self, condition, action='count', name=None):
+        if action not in ('count', 'log', 'stop'):
+            raise ValueError('Unknown watch action {}'.format(action))
+        self.condition = condition
+        self.action = action
+        self.name = name or getattr(condition, '__name__', 'watch')
+        self.hits = 0
+        self.first_hit = None
+        self.last_hit = None
+
+    def check(self, simulation, tick):
+        """Evaluate the condition in tick, return True if it is a hit."""
+        if not self.condition(simulation, tick):
+            return False
+        self.hits += 1
+        if self.first_hit is None:
+            self.first_hit = tick
+        self.last_hit = tick
+        if self.action == 'log':
+            self.log.info('Watch {} hit in tick {}'.format(self.name, tick))
+        return True
+
+    def reset(self):
+        self.hits = 0
+        self.first_hit = None
+        self.last_hit = None
+
+    def __str__(self):
+        return 'Watch {} ({}): {} hits, first {}, last {}'.format(
+            self.name, self.action, self.hits, self.first_hit, self.last_hit)
+
+
+class SignalStats():
+    """Running statistics per (source, signal) collected while the simulation steps, without history.
+
+    Sources are entities with signal outputs ('entity N') and networks ('red network N'). For each
+    signal seen on a source it keeps min, max, mean, the number of value changes and the first and
+    last tick with a non zero value. A missing signal counts as 0. Values are stored in flat arrays
+    and only sources whose output object changed are looked at, so it is cheap enough to keep on.
+    The networks read are listed in self.networks.
+    """
+
+    FIELDS = ('value', 'since', 'total', 'min', 'max', 'changes', 'first_nonzero', 'last_nonzero')
+
+    def __init__(self, simulation, entities=True, networks=True):
+        self.sources = []
+        self.networks = []
+        if entities:
+            for e in simulation.Entities:
+                if isinstance(e.outputs[-1], SignalSet):
+                    self.sources += [('entity {}'.format(e.entity_N), e.get_output)]
+        if networks:
+            for color in ('red', 'green'):
+                for nw in simulation.networks.get(color):
+                    self.sources += [('{} network {}'.format(color, nw.nw_N), partial(nw.value, simulation))]
+                    self.networks += [nw]
+        self.last = [None] * len(self.sources)
+        self.slots = [{} for _ in self.sources]   # signal name -> index in the arrays
+        self.keys = []
+        for field in self.FIELDS:
+            setattr(self, field, array('q'))
+        self.start = simulation.last_tick
+        self.tick = None
+        self.collect(simulation, simulation.last_tick)
+
+    def _new_slot(self, source, name, tick, value):
+        index = len(self.keys)
+        self.slots[source][name] = index
+        self.keys += [(self.sources[source][0], name)]
+        if tick != self.start:
+            value = 0   # it was 0 before it appeared
+        for field, initial in zip(self.FIELDS, (value, self.start, 0, value, value, 0, -1, -1)):
+            getattr(self, field).append(initial)
+        if value != 0:
+            self.first_nonzero[index] = tick
+        return index
+
+    def _set(self, index, value, tick):
+        old = self.value[index]
+        if value == old:
+            return
+        self.total[index] += old * (tick - self.since[index])
+        self.since[index] = tick
+        self.value[index] = value
+        self.changes[index] += 1
+        if value < self.min[index]:
+            self.min[index] = value
+        if value > self.max[index]:
+            self.max[index] = value
+        if value != 0 and self.first_nonzero[index] < 0:
+            self.first_nonzero[index] = tick
+        if old != 0 and value == 0:
+            self.last_nonzero[index] = tick - 1
+
+    def collect(self, simulation, tick):
+        """Update the statistics with tick, called by the simulation after every step."""
+        self.tick = tick
+        for source, (_, get) in enumerate(self.sources):
+            signals = get(tick)
+            if signals is self.last[source]:
+                continue
+            self.last[source] = signals
+            slots = self.slots[source]
+            for name, value in signals.items():
+                index = slots.get(name)
+                if index is None:
+                    index = self._new_slot(source, name, tick, value)
+                self._set(index, value, tick)
+            for name, index in slots.items():
+                if name not in signals:
+                    self._set(index, 0, tick)
+
+    def summary(self):
+        """Return {(source, signal): {'min', 'max', 'mean', 'changes', 'first_nonzero', 'last_nonzero'}}."""
+        ticks = self.tick - self.start + 1
+        result = {}
+        for index, key in enumerate(self.keys):
+            value = self.value[index]
+            total = self.total[index] + value * (self.tick + 1 - self.since[index])
+            last_nonzero = self.tick if value != 0 else self.last_nonzero[index]
+            result[key] = {'min': self.min[index], 'max': self.max[index], 'mean': total / ticks,
+                           'changes': self.changes[index],
+                           'first_nonzero': self.first_nonzero[index] if self.first_nonzero[index] >= 0 else None,
+                           'last_nonzero': last_nonzero if last_nonzero >= 0 else None}
+        return result
+
+    def report(self):
+        """Return the summary as a printable table."""
+        lines = ['Ticks {} to {}'.format(self.start, self.tick),
+                 '{:<20} {:<20} {:>12} {:>12} {:>14} {:>8} {:>8} {:>8}'.format(
+                     'source', 'signal', 'min', 'max', 'mean', 'changes', 'first', 'last')]
+        for (source, signal), s in self.summary().items():
+            lines += ['{:<20} {:<20} {:>12} {:>12} {:>14.3f} {:>8} {:>8} {:>8}'.format(
+                source, signal, s['min'], s['max'], s['mean'], s['changes'], str(s['first_nonzero']),
+                str(s['last_nonzero']))]
+        return '\n'.join(lines)
+
+
+# Pixel colours of the lamps in rendered frames
+LAMP_RGB = {'white': (255, 255, 255), 'red': (255, 40, 40), 'green': (40, 255, 40), 'blue': (40, 90, 255),
+            'yellow': (255, 235, 40), 'pink': (255, 80, 210), 'cyan': (40, 235, 255), 'grey': (128, 128, 128),
+            'black': (0, 0, 0)}
+LAMP_RGB_OFF = (40, 40, 40)
+FRAME_BACKGROUND = (0, 0, 0)    # places without a lamp and lamps without a condition
+
+
+def lamp_rgb(output):
+    """Pixel colour of a lamp output."""
+    if output.get('light') == 'ON':
+        return LAMP_RGB.get(output.get('color'), LAMP_RGB['white'])
+    if output.get('light') == 'OFF':
+        return LAMP_RGB_OFF
+    return FRAME_BACKGROUND
+
+
+class LampFrames():
+    """Render the lamps of a simulation as the pixels of an image while it steps.
+
+    Every lamp is a square of scale x scale pixels at its place in the blueprint. The byte offsets
+    of the lamps are computed once and one RGB buffer is reused: a tick only rewrites the lamps
+    whose output object changed. Frames are written every `every` ticks to out, which can be a
+    binary file (a stream of PPM images, ffmpeg reads it with -f image2pipe), a file name pattern
+    like 'frames/{:05d}.ppm' (one PPM file per frame, formatted with the tick), a file name ending
+    in .gif (an animated gif of fps frames per second written by close(), needs Pillow) or any other
+    file name (a PPM stream). Add it with Factsimcmd.add_collector, or use render_lamps.
+
+    A gif is only written at the end, so its frames are kept in memory until close(): repeated
+    frames are merged into one longer frame, but for long runs with changing lamps stream PPM.
+    """
+
+    def __init__(self, simulation, out, scale=1, every=1, fps=30):
+        self.lamps = [e for e in simulation.Entities if isinstance(e, Lamp)]
+        if not self.lamps:
+            raise ValueError('The blueprint has no lamps')
+        # lamps are 1x1, so their positions differ by whole tiles
+        first = self.lamps[0].position
+        cells = [(round((e.position['x'] - first['x']) / simulation.scale),
+                  round((e.position['y'] - first['y']) / simulation.scale)) for e in self.lamps]
+        left = min(x for x, _ in cells)
+        top = min(y for _, y in cells)
+        self.width = (max(x for x, _ in cells) - left + 1) * scale
+        self.height = (max(y for _, y in cells) - top + 1) * scale
+        self.scale = scale
+        self.offsets = [[((y - top) * scale + row) * self.width * 3 + (x - left) * scale * 3
+                         for row in range(scale)] for x, y in cells]
+        self.pixel = bytearray(FRAME_BACKGROUND) * (self.width * self.height)
+        self.header = 'P6\n{} {}\n255\n'.format(self.width, self.height).encode('ascii')
+        self.colors = {}    # id of a lamp output -> its pixels for one row of a lamp
+        self.last = [None] * len(self.lamps)
+        self.every = every
+        self.fps = fps
+        self.frames = 0
+        self.images = None  # [pixels, frames] of a gif, repeated frames merged
+        self.filename = out
+        self.stream = None
+        self.close_stream = False
+        self.pattern = None
+        if not isinstance(out, str):
+            self.stream = out
+        elif out.lower().endswith('.gif'):
+            try:
+                from PIL import Image
+            except ImportError:
+                raise ValueError('Writing gif files needs Pillow, write PPM frames instead') from None
+            self.images = []
+        elif '{' in out:
+            self.pattern = out
+        else:
+            self.stream = open(out, 'wb')
+            self.close_stream = True
+        self.start = simulation.last_tick
+        self.collect(simulation, simulation.last_tick)
+
+    def render(self, tick):
+        """Update the buffer with the lamps in tick and return it (RGB rows, width x height)."""
+        pixel = self.pixel
+        last = self.last
+        for index, lamp in enumerate(self.lamps):
+            output = lamp.get_output(tick)
+            if output is last[index]:
+                continue
+            last[index] = output
+            row = self.colors.get(id(output))
+            if row is None:
+                # lamp outputs are module constants, their ids never change
+                row = self.colors[id(output)] = bytes(lamp_rgb(output)) * self.scale
+            for offset in self.offsets[index]:
+                pixel[offset:offset + len(row)] = row
+        return pixel
+
+    def frame(self, tick):
+        """The binary PPM image of tick."""
+        return self.header + self.render(tick)
+
+    def collect(self, simulation, tick):
+        """Render tick and write it if it is one of the frames, called by the simulation after every step."""
+        if (tick - self.start) % self.every:
+            return
+        if self.images is not None:
+            pixels = bytes(self.render(tick))
+            if self.images and self.images[-1][0] == pixels:
+                self.images[-1][1] += 1
+            else:
+                self.images += [[pixels, 1]]
+        elif self.pattern:
+            with open(self.pattern.format(tick), 'wb') as f:
+                f.write(self.header)
+                f.write(self.render(tick))
+        else:
+            self.stream.write(self.header)
+            self.stream.write(self.render(tick))
+        self.frames += 1
+
+    def close(self):
+        """Finish the output: write the gif or close the stream opened here."""
+        if self.images:
+            from PIL import Image
+            images = [Image.frombytes('RGB', (self.width, self.height), pixels) for pixels, _ in self.images]
+            images[0].save(self.filename, save_all=True, append_images=images[1:], loop=0,
+                           duration=[round(1000 * frames / self.fps) for _, frames in self.images])
+            self.images = []
+        if self.close_stream:
+            self.stream.close()
+            self.close_stream = False
+
+
+# Diagram colours per kind of entity: (outputting signals, idle)
+ENTITY_COLORS = {'Decider': ('gold', '#F3E6A0'), 'Arithmetic': ('#03ABFE', '#A6DDF8'),
+                 'Selector': ('#B57EDC', '#E3D0F0'), 'Constant_Combinator': ('#F86658', '#F8C3BE'),
+                 'ElectricPole': ('#A9A8AD', '#A9A8AD'), 'other': ('#4FE942', '#B9F0B4')}
+LAMP_COLORS = {'ON': '#FFF45C', 'OFF': '#5A5A5A'}
+PLAY_FPS = 30   # maximum frames per second drawn while playing
+ENTITY_SIZE = 0.8       # side of an entity box in tiles
+DRAW_MARGIN = 60        # space around the diagram, in position units
+LABEL_MIN_PX = 30       # labels are only drawn if the box is at least this big on screen
+WIRE_MIN_PX = 4         # same for the wires
+ZOOM_STEP = 1.25
+MIN_ZOOM = 0.02
+MAX_ZOOM = 8
+SEEK_FOREGROUND_TICKS = 200  # longer seeks run in a background thread
+SEEK_POLL_MS = 50
+# outline (colour, width) of the selected entity and of the ones it depends on and drives
+HIGHLIGHT_OUTLINES = {'selected': ('black', 3), 'in': ('#1E64FF', 3), 'out': ('#FF7A00', 3), None: ('black', 1)}
+
+
+def entity_color(entity, output):
+    """Colour of an entity in the diagram for its output: lamps by light status, the rest by
+    type, paler while they output nothing."""
+    if isinstance(entity, Lamp):
+        if output.get('light') == 'ON' and output.get('color') in LAMP_RGB and output.get('color') != 'white':
+            return '#{:02X}{:02X}{:02X}'.format(*LAMP_RGB[output.get('color')])
+        return LAMP_COLORS.get(output.get('light'), ENTITY_COLORS['other'][1])
+    for cls in (Decider, Arithmetic, Selector, Constant_Combinator, ElectricPole):
+        if isinstance(entity, cls):
+            active, idle = ENTITY_COLORS[cls.__name__]
+            break
+    else:
+        active, idle = ENTITY_COLORS['other']
+    if isinstance(entity, ElectricPole):
+        return active
+    if isinstance(entity, ControlledEntity):
+        return active if output.get('enabled') else idle
+    return active if output else idle
+
+
+class SpatialIndex():
+    """Uniform grid over the entity positions, to find the entities in a rectangle or near a point
+    without looking at all of them."""
+
+    def __init__(self, entities, cell):
+        self.cell = cell
+        self.buckets = {}
+        for e in entities:
+            self.buckets.setdefault(self._key(e.position['x'], e.position['y']), []).append(e)
+
+    def _key(self, x, y):
+        return int(x // self.cell), int(y // self.cell)
+
+    def in_rect(self, x0, y0, x1, y1):
+        """Entities with their position inside the rectangle."""
+        kx0, ky0 = self._key(x0, y0)
+        kx1, ky1 = self._key(x1, y1)
+        if (kx1 - kx0 + 1) * (ky1 - ky0 + 1) > len(self.buckets):
+            keys = [k for k in self.buckets if kx0 <= k[0] <= kx1 and ky0 <= k[1] <= ky1]
+        else:
+            keys = [(kx, ky) for kx in range(kx0, kx1 + 1) for ky in range(ky0, ky1 + 1)]
+        return [e for k in keys for e in self.buckets.get(k, ())
+                if x0 <= e.position['x'] <= x1 and y0 <= e.position['y'] <= y1]
+
+    def at(self, x, y, radius):
+        """The entity nearest to (x, y) within radius in both axes, or None."""
+        candidates = self.in_rect(x - radius, y - radius, x + radius, y + radius)
+        if candidates:
+            return min(candidates, key=lambda e: (e.position['x'] - x) ** 2 + (e.position['y'] - y) ** 2)
+        return None
+
+
+class SeekWorker():
+    """Advance a simulation to a target tick in a background thread.
+
+    Meant for the GUI: the Tk main loop polls progress (a queue.Queue) with root.after while the
+    worker steps. Messages are tuples (kind, tick, target) with kind 'progress', 'done' (target
+    reached or a 'stop' watch hit) or 'cancelled', or ('error', exception, target).
+    completed is the last tick fully computed, it is safe to display while the worker runs as
+    long as nothing else steps the simulation.
+    """
+
+    def __init__(self, simulation, report_interval=0.1):
+        self.simulation = simulation
+        self.report_interval = report_interval
+        self.progress = queue.Queue()
+        self.target = simulation.last_tick
+        self.completed = simulation.last_tick
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, target):
+        """Seek to target. If a seek is already running its target is changed instead."""
+        with self._lock:
+            self.target = target
+            if self.running:
+                return
+            self.completed = self.simulation.last_tick
+            self._cancel.clear()
+            self._thread = threading.Thread(target=self._run, name='factsim-seek', daemon=True)
+            self._thread.start()
+
+    def cancel(self):
+        """Stop the running seek after the tick being computed."""
+        self._cancel.set()
+
+    def join(self, timeout=None):
+        """Wait for the running seek to finish, return True if it did."""
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+            return not thread.is_alive()
+        return True
+
+    def _run(self):
+        sim = self.simulation
+        last_report = time.perf_counter()
+        stepped = False  # halted is left from an earlier run until the first step
+        while True:
+            with self._lock:
+                target = self.target
+                if self._cancel.is_set() or sim.last_tick >= target or stepped and sim.halted:
+                    self._thread = None
+                    kind = 'cancelled' if self._cancel.is_set() else 'done'
+                    self.progress.put((kind, self.completed, target))
+                    return
+            try:
+                self.completed = sim.step()
+                stepped = True
+            except Exception as err:
+                with self._lock:
+                    self._thread = None
+                self.progress.put(('error', err, target))
+                return
+            now = time.perf_counter()
+            if now - last_report >= self.report_interval:
+                last_report = now
+                self.progress.put(('progress', self.completed, target))
+
+
+class SimulationContext():
+    """The state one simulation keeps for itself instead of sharing it through the module: the
+    network numbering, the order used to sort signals, the interned configurations and the logger.
+
+    Everything else a simulation touches at module level is immutable, so independent simulations
+    can be loaded and run concurrently, for example in a thread pool, and number their networks
+    and sort their signals the same whatever runs beside them. A single simulation must still be
+    stepped by one thread at a time.
+    """
+
+    def __init__(self, loglevel=logging.NOTSET):
+        self.network_ids = count(1)
+        self.order = {signal: n for n, signal in enumerate(ORDER)}
+        self.configs = {}
+        # not registered in the logging manager, so it goes away with the simulation
+        self.log = logging.Logger('factsim.simulation', loglevel)
+        self.log.parent = logging.getLogger('factsim')
+
+    def sig_sort(self, signal):
+        """Position of signal in the order, signals not in ORDER are put after the ones seen before."""
+        return self.order.setdefault(signal, len(self.order))
+
+    def intern(self, config):
+        return self.configs.setdefault(config, config)
 
 
 class Factsimcmd():
-    """Class holding all the Factsim simulation."""
+    """Class holding all the Factsim simulation.
+
+    Simulations keep their state in their own SimulationContext, so several can run in threads of
+    the same process. Logging is not configured here: the log records of the simulation go to the
+    'factsim' logger, filtered with loglevel, and the hits of log watches to 'factsim.watch'.
+    """
 
-    def __init__(self, filename=None, loglevel=logging.ERROR, scale=80):
-        logging.basicConfig(level=loglevel)
-        self.blueprint = open_blueprint(filename=filename)
+    def __init__(self, filename=None, loglevel=logging.ERROR, scale=80, data=None, gui=True, history=None):
+        self.context = SimulationContext(loglevel)
         self.Entities = []
-        self.bpEntities = []
         self.sim_tick = 0
+        self.last_tick = 0
+        self.watches = []
+        self.collectors = []
+        self.stimuli = StimulusSchedule()
+        self.halted = None
         self.opened_windows = {}
         self.networks = {'red': [], 'green': []}
-        self.create_entities()
+        self.circuit_index = CircuitIndex()
+        self.wiring = {'red': {}, 'green': {}}  # connection point -> points wired to it
+        self.wires = []
+        # Entities are created while the blueprint is decoded, the json is never kept
+        for kind, item in iter_blueprint_items(filename=filename, data=data):
+            if kind == 'entities':
+                self.create_entities([item])
+            else:
+                self.wires += [item]
+        if not self.Entities:
+            raise ValueError('The blueprint has no entities (blueprint books are not supported)')
         for c in ('red', 'green'):
             self.create_networks(c)
+        for e in self.Entities:
+            e.release_wiring()
+        self.wires = []
+        self.active = [e for e in self.Entities if e.ACTIVE]
+        if history:
+            self.limit_history(history)
         self.normalize_coordinates()
         self.scale_coordinates(scale)
-        self.draw()
-
-
-    def create_entities(self):
-        """Parse the blueprint into objects. Fill the Entities list."""
-        self.bpEntities = self.blueprint['blueprint']['entities']
-        genericentities = [Entity(e) for e in self.bpEntities]
-        for e in genericentities:
-            if 'pole' in e.name.split('-') or e.name == 'substation':
-                self.Entities += [ElectricPole(e.dictionary, self)]
-            elif e.name == 'constant-combinator':
-                self.Entities += [Constant_Combinator(e.dictionary, self)]
-            elif e.name == 'decider-combinator':
-                self.Entities += [Decider(e.dictionary, self)]
-            elif e.name == 'arithmetic-combinator':
-                self.Entities += [Arithmetic(e.dictionary, self)]
-            elif 'lamp' in e.name.split('-'):
-                self.Entities += [Lamp(e.dictionary, self)]
-            elif e.name == 'pushbutton':
-                self.Entities += [Pushbutton(e.dictionary, self)]
-            else:
-                self.Entities += [ConnectedEntity(e.dictionary, self)]
+        if gui:
+            self.draw()
 
-    def get_nw_for_Entity(self, entity, color):
-        """get the network object that has entity as member"""
-        for nw in self.networks.get(color):
-            if entity in nw.members:
-                return nw
+
+    def create_entities(self, entities):
+        """Parse the blueprint entity dictionaries into objects of the classes registered for their
+        names (see register_entity). Fill the Entities list."""
+        for e in entities:
+            self.Entities += [entity_class(e['name'])(e, self)]
+            self.circuit_index.update_entity(self.Entities[-1])
+
+    def intern_config(self, config):
+        """Get the shared instance equal to config, so identical entity setups use one object."""
+        return self.context.intern(config)
 
     def get_nw_with_upstream(self, entityup, color):
 
@@ -718,141 +2232,292 @@ class Factsimcmd():
             if pole in nw.poles:
                 return nw
 
-    def add_network(self, nw):
-        color = nw.color
-        existent_up = None
-        existent_down = None
-        for up in nw.upstream:
-            existent_up = self.get_nw_with_upstream(up, color)
-            if existent_up:
-                for upstream in nw.upstream:
-                    existent_up.include_upstream(upstream)
-                for downstream in nw.downstream:
-                    existent_up.include_downstream(downstream)
-
-        for down in nw.downstream:
-            existent_down = self.get_nw_with_downstream(down, color)
-            if existent_down:
-                for upstream in nw.upstream:
-                    existent_down.include_upstream(upstream)
-                for downstream in nw.downstream:
-                    existent_down.include_downstream(downstream)
-        existent = existent_up or existent_down
-        if not existent:
-            self.networks[color] += [nw]
-
-
     def create_networks(self, color):
-        """Create the networks"""
-        # First we convert the poles
-        done = []
-        for e in self.Entities:
-            if isinstance(e, ElectricPole):
-                if e.connect1.get(color):
-                    nw = self.get_nw_for_Entity(e, color)
-                    if not nw:
-                        nw = Network(poles=[e.entity_N], color=color)
-                        self.networks[color] += [nw]
-                    connections = e.connect1.get(color)
-                    if connections:
-                        for conn in connections:
-                            ent_id = conn.get('entity_id')
-                            side = conn.get('circuit_id')
-                            ent = self.get_entity(ent_id)
-                            if ent_id in done:
-                                continue
-                            if isinstance(ent, ElectricPole):
-                                nw.poles += [ent_id]
-                            elif isinstance(ent, Constant_Combinator):
-                                nw.upstream += [ent_id]
-                            elif side == 1:
-                                nw.downstream += [ent_id]
-                            elif side == 2:
-                                nw.upstream += [ent_id]
-                done += [e.entity_N]
-
+        """Create the networks of one wire color.
+
+        Every circuit connection point (entity_N, circuit_id) is joined with the points its wires
+        reach, and each group of joined points is a network (see add_network).
+        """
+        wiring = self.wiring[color]
+        parent = {}
+
+        def find(point):
+            root = parent.setdefault(point, point)
+            while parent[root] != root:
+                root = parent[root]
+            while parent[point] != root:
+                parent[point], point = root, parent[point]
+            return root
+
+        def join(a, b):
+            wiring.setdefault(a, set()).add(b)
+            wiring.setdefault(b, set()).add(a)
+            a, b = find(a), find(b)
+            if a != b:
+                parent[max(a, b)] = min(a, b)
 
         for e in self.Entities:
-            if e.entity_N in done:
-                continue
-            if isinstance(e, Constant_Combinator):
-                if e.connectOUT.get(color):
-                    nw = self.get_nw_with_upstream(e, color)
-                    if not nw:
-                        nw = Network(upstream=[e.entity_N], color=color)
-                    connections = e.connect1.get(color)
-                    if connections:
-                        for conn in connections:
-                            ent_id = conn.get('entity_id')
-                            side = conn.get('circuit_id')
-                            ent = self.get_entity(ent_id)
-                            if isinstance(ent, Constant_Combinator) or side == 2:
-                                nw.include_upstream(ent_id)
-                            elif side == 1:
-                                nw.include_downstream(ent_id)
-                    self.add_network(nw)
-
-
-            elif isinstance(e, Combinator):
-
-                if e.connectIN.get(color):
-                    nw = self.get_nw_with_downstream(e.entity_N, color)
-                    if not nw:
-                        nw = Network(downstream=[e.entity_N], color=color)
-
-                    for conn_in in e.connectIN.get(color):
-                        ent_id = conn_in.get('entity_id')
-                        side = conn_in.get('circuit_id')
-                        ent = self.get_entity(ent_id)
-                        if isinstance(ent, Constant_Combinator):
-                            nw.include_upstream(ent_id)
-                        elif side == 2:
-                            nw.include_upstream(ent_id)
-                        elif side == 1:
-                            nw.include_downstream(ent_id)
-                    self.add_network(nw)
-
-                if e.connectOUT.get(color):
-                    nw = self.get_nw_with_upstream(e.entity_N, color)
-                    if not nw:
-                        nw = Network(upstream=[e.entity_N], color=color)
-
-                    for conn_out in e.connectOUT.get(color):
-                        ent_id = conn_out.get('entity_id')
-                        side = conn_out.get('circuit_id')
-                        ent = self.get_entity(ent_id)
-                        if isinstance(ent, Constant_Combinator):
-                            nw.include_upstream(ent_id)
-                        elif side == 2:
-                            nw.include_upstream(ent_id)
-                        elif side == 1:
-                            nw.include_downstream(ent_id)
-                    self.add_network(nw)
-
-            elif isinstance(e, Lamp):
-                if e.connectIN.get(color):
-                    nw = self.get_nw_with_downstream(e.entity_N, color)
-                    if not nw:
-                        nw = Network(downstream=[e.entity_N], color=color)
-
-                    for conn_in in e.connectIN.get(color):
-                        ent_id = conn_in.get('entity_id')
-                        side = conn_in.get('circuit_id')
-                        ent = self.get_entity(ent_id)
-                        if isinstance(ent, Constant_Combinator):
-                            nw.include_upstream(ent_id)
-                        elif side == 2:
-                            nw.include_upstream(ent_id)
-                        elif side == 1:
-                            nw.include_downstream(ent_id)
-                    self.add_network(nw)
-
-
+            for side in e.SIDES:
+                for conn in e.side_connections(side).get(color, ()):
+                    join((e.entity_N, side), (conn['entity_id'], conn.get('circuit_id', 1)))
+        for wire in self.wires:
+            first, second = WIRE_CONNECTORS.get(wire[1]), WIRE_CONNECTORS.get(wire[3])
+            if first and second and first[0] == second[0] == color:
+                join((wire[0], first[1]), (wire[2], second[1]))
+
+        # networks are numbered as they always were: the ones with poles first, then in entity order
+        groups = {}
+        for point in sorted(parent, key=lambda point: ('pole' not in self.point_roles(point), point)):
+            groups.setdefault(find(point), []).append(point)
+        for group in groups.values():
+            self.add_network(color, group)
+
+    def point_roles(self, point):
+        """Roles of the entity at a connection point (entity_N, circuit_id), see SIDES."""
+        return self.get_entity(point[0]).SIDES.get(point[1], ())
+
+    def add_network(self, color, points):
+        """Create the network joining the connection points. The entities take part in it with the
+        roles their class declares for each point: 'out' upstream, 'in' downstream and 'pole' as a
+        pole. Return the network, or None if no point has a role."""
+        upstream = [n for n, side in points if 'out' in self.point_roles((n, side))]
+        downstream = [n for n, side in points if 'in' in self.point_roles((n, side))]
+        poles = [n for n, side in points if 'pole' in self.point_roles((n, side))]
+        if not (upstream or downstream or poles):
+            return None
+        nw = Network(next(self.context.network_ids), upstream, downstream, poles, color)
+        nw.points = list(points)
+        for n in downstream:
+            self.get_entity(n).input_networks += [nw]
+        for n in poles:
+            self.get_entity(n).pole_networks[color] = nw
+        self.networks[color] += [nw]
+        self.circuit_index.add_network(nw)
+        return nw
+
+    def remove_network(self, nw):
+        """Take a network out of the simulation and of the entities that read it."""
+        for n in nw.downstream:
+            self.get_entity(n).input_networks.remove(nw)
+        for n in nw.poles:
+            del self.get_entity(n).pole_networks[nw.color]
+        self.networks[nw.color].remove(nw)
+        self.circuit_index.remove_network(nw)
 
     def get_entity(self, n):
-        """Get an entity by number"""
+        """Get an entity by number, IndexError if there is no such entity"""
+        if not 1 <= n <= len(self.Entities):
+            raise IndexError('There is no entity {}'.format(n))
         return self.Entities[n-1]
 
+    def get_network(self, nw_N):
+        """Get a network by number"""
+        for nw in self.networks.get('red') + self.networks.get('green'):
+            if nw.nw_N == nw_N:
+                return nw
+
+    def networks_fed_by(self, entity_N):
+        """Networks the output of an entity is connected to."""
+        return self.circuit_index.networks_fed_by(entity_N)
+
+    def downstream_cone(self, entity_N):
+        """Numbers of the entities whose inputs depend on the output of entity_N, directly or through
+        other entities. It includes entity_N only if it is in a loop."""
+        return self.circuit_index.downstream_cone(entity_N)
+
+    def resimulate(self, changed, readers):
+        """Simulate again up to the last tick the changed entities from tick 0 and readers and the
+        downstream cones of both from tick 1. Return them, changed first."""
+        cone = set(readers)
+        for n in set(changed) | cone:
+            cone |= self.downstream_cone(n)
+        affected = [self.get_entity(n) for n in changed] + \
+                   [self.get_entity(n) for n in sorted(cone - set(changed))]
+        for e in affected[len(changed):]:
+            e.rewind(1)
+        for e in affected:
+            e.get_output(self.last_tick)
+        return affected
+
+    def edit(self, entity_N, **changes):
+        """Change the configuration of an entity in place and simulate again only what it affects.
+
+        Deciders, arithmetic combinators and lamps take fields of their config (constant=10,
+        comparator='<', ...), constant combinators signals={name: count} and is_on. The entity is
+        simulated again from tick 0 as if the blueprint had been loaded that way, its downstream
+        cone from tick 1, and every other entity keeps its history. Watches and collectors are not
+        run again on the ticks already computed. Needs the full history, and constant combinators
+        changed by stimuli cannot be edited: their history is not rebuilt from their setup. Return
+        the entities that were simulated again.
+        """
+        entity = self.get_entity(entity_N)
+        if isinstance(entity.outputs, History):
+            raise ValueError('Editing needs the full history, this simulation only keeps the last ticks')
+        if entity_N in self.stimuli.stimulated:
+            raise ValueError('{} was changed by stimuli, it cannot be edited'.format(entity))
+        entity.configure(**changes)
+        self.circuit_index.update_entity(entity)
+        return self.resimulate([entity_N], ())
+
+    def connect(self, first, second, color, first_side=1, second_side=1):
+        """Add a wire of color between circuit connection points of two entities and simulate again
+        the entities that read the networks changed, see rewire."""
+        return self.rewire(color, (first, first_side), (second, second_side), True)
+
+    def disconnect(self, first, second, color, first_side=1, second_side=1):
+        """Remove the wire of color between circuit connection points of two entities and simulate
+        again the entities that read the networks changed, see rewire."""
+        return self.rewire(color, (first, first_side), (second, second_side), False)
+
+    def rewire(self, color, first, second, connect):
+        """Add (connect) or remove a wire between two connection points (entity_N, circuit_id).
+
+        Only the networks of the two points are replaced, by the ones their points form with the
+        new wiring, and the circuit index is updated for them. The entities reading those networks
+        and their downstream cones are simulated again from tick 1, as if the blueprint had been
+        loaded wired that way. Signals injected by stimuli into the replaced networks are lost.
+        Needs the full history, and no watch or collector (see SignalStats) may read the replaced
+        networks: they are refused with ValueError, unwatch / remove_collector them first. Return the
+        entities that were simulated again.
+        """
+        if self.active and isinstance(self.active[0].outputs, History):
+            raise ValueError('Rewiring needs the full history, this simulation only keeps the last ticks')
+        for n, side in (first, second):
+            if not 1 <= n <= len(self.Entities):
+                raise ValueError('There is no entity {}'.format(n))
+        wiring = self.wiring[color]
+        if not connect and second not in wiring.get(first, ()):
+            raise ValueError('There is no {} wire between {} and {}'.format(color, first, second))
+        old = [nw for nw in {self.circuit_index.network_at(color, *point): None for point in (first, second)}
+               if nw is not None]
+        readers = [w.name for w in self.watches if getattr(w.condition, 'network', None) in old]
+        readers += [type(c).__name__ for c in self.collectors if set(getattr(c, 'networks', ())) & set(old)]
+        if readers:
+            raise ValueError('{} read the networks {} would replace, remove them before rewiring'.format(
+                ', '.join(readers), ', '.join(str(nw.nw_N) for nw in old)))
+        if connect:
+            wiring.setdefault(first, set()).add(second)
+            wiring.setdefault(second, set()).add(first)
+        else:
+            wiring[first].discard(second)
+            wiring[second].discard(first)
+        points = {first, second}.union(*(nw.points for nw in old))
+        readers = {n for nw in old for n in nw.downstream + nw.poles}
+        for nw in old:
+            self.remove_network(nw)
+        while points:
+            group = {min(points)}
+            stack = list(group)
+            while stack:
+                for point in wiring.get(stack.pop(), ()):
+                    if point not in group:
+                        group.add(point)
+                        stack.append(point)
+            points -= group
+            if len(group) == 1 and not wiring.get(min(group)):
+                continue    # a point left without wires has no network, as at load
+            nw = self.add_network(color, sorted(group, key=lambda point: ('pole' not in self.point_roles(point),
+                                                                          point)))
+            if nw is not None:
+                readers.update(nw.downstream + nw.poles)
+        return self.resimulate((), readers)
+
+    def limit_history(self, ticks):
+        """Keep only the last ticks of inputs and outputs of every entity from now on.
+
+        Older ticks can no longer be shown or queried, but memory stays constant on long runs."""
+        for e in self.active:
+            if isinstance(e.outputs, History):
+                e.inputs.set_limit(ticks)
+                e.outputs.set_limit(ticks)
+            else:
+                e.inputs = History(e.inputs, ticks)
+                e.outputs = History(e.outputs, ticks)
+
+    def watch(self, condition, action='count', name=None):
+        """Check condition(simulation, tick) after every tick, see Watch. Return the Watch."""
+        watch = condition if isinstance(condition, Watch) else Watch(condition, action, name)
+        self.watches += [watch]
+        return watch
+
+    def watch_entity(self, entity_N, signal, comparator, value, action='count'):
+        """Watch a signal in the output of an entity, e.g. watch_entity(17, 'signal-A', '>', 100)."""
+        return self.watch(signal_condition(self.get_entity(entity_N), signal, comparator, value), action,
+                          'entity {} {} {} {}'.format(entity_N, signal, comparator, value))
+
+    def watch_network(self, nw_N, signal, comparator, value, action='count'):
+        """Watch a signal in the value of a network."""
+        if self.get_network(nw_N) is None:
+            raise ValueError('There is no network {}'.format(nw_N))
+        return self.watch(signal_condition(self.get_network(nw_N), signal, comparator, value), action,
+                          'network {} {} {} {}'.format(nw_N, signal, comparator, value))
+
+    def unwatch(self, watch):
+        self.watches.remove(watch)
+
+    def schedule(self, stimuli):
+        """Apply the Stimulus events of stimuli, any iterable in tick order such as a list or
+        read_stimuli(filename), when step() reaches their ticks."""
+        self.stimuli.add(stimuli)
+
+    def add_collector(self, collector):
+        """Call collector.collect(simulation, tick) after every step. Return the collector."""
+        self.collectors += [collector]
+        return collector
+
+    def remove_collector(self, collector):
+        self.collectors.remove(collector)
+
+    def collect_stats(self, entities=True, networks=True):
+        """Start collecting SignalStats from the current tick on and return them."""
+        return self.add_collector(SignalStats(self, entities, networks))
+
+    def step(self):
+        """Advance every entity one tick and check the watches, return the new tick.
+
+        If a watch with action 'stop' hits, it is stored in self.halted. The stimuli due are
+        applied before the tick is computed."""
+        if self.stimuli:
+            self.stimuli.apply(self, self.last_tick + 1)
+        self.last_tick += 1
+        self.halted = None
+        for e in self.active:
+            e.get_output(self.last_tick)
+        for collector in self.collectors:
+            collector.collect(self, self.last_tick)
+        for watch in self.watches:
+            if watch.check(self, self.last_tick) and watch.action == 'stop':
+                self.halted = watch
+        return self.last_tick
+
+    def advance_to(self, tick):
+        """Step the simulation until tick has been computed for every entity or a watch stops it.
+
+        Return the last computed tick."""
+        while self.last_tick < tick:
+            self.step()
+            if self.halted:
+                break
+        return self.last_tick
+
+    def run(self, ticks):
+        """Simulate ticks more ticks, return the last computed tick."""
+        return self.advance_to(self.last_tick + ticks)
+
+    def run_until(self, condition, max_ticks):
+        """Step until condition(simulation, tick) is true, for at most max_ticks ticks.
+
+        condition can also be a Watch. Return the tick where it first happened, or None."""
+        watch = condition if isinstance(condition, Watch) else Watch(condition, 'stop')
+        end = self.last_tick + max_ticks
+        while self.last_tick < end:
+            tick = self.step()
+            if watch.check(self, tick):
+                return tick
+            if self.halted:
+                break
+        return None
+
     def print_entities(self):
         """List all entities"""
         for e in self.Entities:
@@ -877,12 +2542,81 @@ class Factsimcmd():
             ent.position['y'] -= ymin
 
     def scale_coordinates(self, factor):
+        self.scale = factor
         for ent in self.Entities:
             ent.position['x'] *= factor
             ent.position['y'] *= factor
 
 
 
+    def entity_info(self, entity, tick):
+        """Text describing the state of entity in tick, as shown in its info window."""
+        output = entity.outputs[tick]
+        if isinstance(entity, ElectricPole):
+            return "{}\nTick nr. {}\n\nSignals passing:\n".format(entity, tick) + \
+                   '\nRed:\n' + '\n'.join([str(i) for i in output['red']]) + \
+                   '\n\nGreen:\n' + '\n'.join([str(i) for i in output['green']])
+
+        elif isinstance(entity, Lamp):
+            firstcond = entity.config.first_signal
+            secondcond = entity.config.comparator
+            if entity.config.second_signal:
+                thirdcond = entity.config.second_signal
+            else:
+                thirdcond = entity.config.constant
+
+            return "{}\nTick nr. {}\n\nConditions: {} {} {}\n\nLight status: {}\nColour: {}".format(
+                entity, tick, firstcond, secondcond, thirdcond, output.get('light'), output.get('color'))
+
+        elif isinstance(entity, ControlledEntity):
+            if entity.config is None:
+                return "{}\nTick nr. {}\n\nNot controlled by the circuit network".format(entity, tick)
+            thirdcond = entity.config.second_signal or entity.config.constant
+            return "{}\nTick nr. {}\n\nConditions: {} {} {}\n\nEnabled: {}".format(
+                entity, tick, entity.config.first_signal, entity.config.comparator, thirdcond,
+                'yes' if output.get('enabled') else 'no')
+
+        elif isinstance(entity, Constant_Combinator):
+            return "{}\nTick nr. {}\n".format(entity, tick) + \
+                   "\n\nOutput signals:\n" + \
+                   '\n'.join([str(i) for i in output])
+
+        # entities that are not simulated have no inputs
+        inp = entity.inputs[tick] if len(entity.inputs) > tick else EMPTY_SIGNALS
+        if isinstance(entity, Decider):
+            firstcond = entity.config.first_signal
+            secondcond = entity.config.comparator
+            if entity.config.second_signal:
+                thirdcond = entity.config.second_signal
+            else:
+                thirdcond = entity.config.constant
+            outputcond = entity.config.output_signal
+        elif isinstance(entity, Arithmetic):
+            firstcond = entity.config.first_signal
+            secondcond = entity.config.operation
+            if entity.config.second_signal:
+                thirdcond = entity.config.second_signal
+            else:
+                thirdcond = entity.config.second_constant
+            outputcond = entity.config.output_signal
+        elif isinstance(entity, Selector):
+            firstcond = entity.config.operation
+            secondcond = 'max' if entity.config.select_max else 'min'
+            thirdcond = entity.config.index_signal or entity.config.index_constant
+            outputcond = entity.config.count_signal or 'selected signal'
+        else:
+            firstcond = "n/a"
+            secondcond = "n/a"
+            thirdcond = "n/a"
+            outputcond = "n/a"
+
+        return "{}\nTick nr. {}\n".format(entity, tick) + \
+               "\nConditions:     {} {} {}  --->  {}\n".format(firstcond, secondcond, thirdcond, outputcond) + \
+               "\nInput signals:\n" + \
+               '\n'.join([str(i) for i in inp]) + \
+               "\n\nOutput signals:\n" + \
+               '\n'.join([str(i) for i in output])
+
     def draw(self):
         """Draw a window with GUI to interact with the simulation"""
         root = tk.Tk()
@@ -893,110 +2627,266 @@ class Factsimcmd():
             root.columnconfigure(i, weight=1)
         root.rowconfigure(1, weight=1)
 
-        def fwd_button_fn():
-            self.sim_tick += 1
+        index = SpatialIndex(self.Entities, self.scale * 4)
+        half = self.scale * ENTITY_SIZE / 2
+        view = {'zoom': 1.0, 'pending': False}
+        items = {}          # visible entity -> (box, label or None, wires)
+        drawn_outputs = {}  # entity -> output object the box colour was set for
+        playing = {'on': False, 'start_time': 0, 'start_tick': 0}
+        worker = SeekWorker(self)
+        selection = {'entity': None, 'in': set(), 'out': set()}  # entity numbers of the fan-in and fan-out
+        wire_ends = {}      # entity -> [(color, x, y)] network centre each of its networks
+        for color in ('red', 'green'):
+            offset = -3 if color == 'red' else 3
+            for nw in self.networks.get(color):
+                members = [self.get_entity(n) for n in set(nw.members)]
+                if len(members) < 2:
+                    continue
+                cx = sum(m.position['x'] for m in members) / len(members) + offset
+                cy = sum(m.position['y'] for m in members) / len(members) + offset
+                for m in members:
+                    wire_ends.setdefault(m, []).append((color, cx, cy))
+
+        def display_tick(tick):
+            self.sim_tick = tick
             current_tick_entry.delete(0, len(current_tick_entry.get()))
             current_tick_entry.insert(0, str(self.sim_tick))
             update_simulation()
 
-        def bck_button_fn():
-            if self.sim_tick > 1:
-                self.sim_tick -= 1
+        def show_tick(tick):
+            """Simulate up to tick (or until a watch stops it) and display it. Long seeks run in
+            the background and the latest completed tick is displayed meanwhile."""
+            if tick > self.last_tick + SEEK_FOREGROUND_TICKS or (worker.running and tick > worker.completed):
+                start_seek(tick)
+            elif worker.running:
+                display_tick(tick)
             else:
-                self.sim_tick = 1
-            current_tick_entry.delete(0, len(current_tick_entry.get()))
-            current_tick_entry.insert(0, str(self.sim_tick))
-            update_simulation()
+                display_tick(min(tick, self.advance_to(tick)))
+
+        def start_seek(tick):
+            polling = worker.running
+            worker.start(tick)
+            seek_status.config(text='seeking {}/{}'.format(worker.completed, tick))
+            cancel_button.config(state=tk.NORMAL)
+            if not polling:
+                root.after(SEEK_POLL_MS, poll_seek)
+
+        def poll_seek():
+            """Show the progress reported by the worker, until the seek ends"""
+            while True:
+                try:
+                    kind, tick, target = worker.progress.get_nowait()
+                except queue.Empty:
+                    root.after(SEEK_POLL_MS, poll_seek)
+                    return
+                if kind == 'error':
+                    self.context.log.error("seek to tick {} failed: {}".format(target, tick))
+                    seek_status.config(text='seek failed: {}'.format(tick))
+                    break
+                display_tick(min(tick, target))
+                if kind == 'progress':
+                    seek_status.config(text='seeking {}/{}'.format(tick, target))
+                    continue
+                if kind == 'cancelled':
+                    seek_status.config(text='seek cancelled')
+                elif self.halted:
+                    seek_status.config(text='stopped by {}'.format(self.halted))
+                else:
+                    seek_status.config(text='')
+                break
+            cancel_button.config(state=tk.DISABLED)
+
+        def fwd_button_fn():
+            show_tick(self.sim_tick + 1)
+
+        def bck_button_fn():
+            show_tick(max(self.sim_tick - 1, 1))
 
         def update_tick_fn(event):
             if current_tick_entry.get().isdigit() and int(current_tick_entry.get()) > 0:
-                self.sim_tick = int(current_tick_entry.get())
+                show_tick(int(current_tick_entry.get()))
             else:
-                current_tick_entry.delete(0, len(current_tick_entry.get()))
-                current_tick_entry.insert(0, str(self.sim_tick))
-            update_simulation()
+                show_tick(self.sim_tick)
 
         def on_close(entity):
-            logging.debug("trying to destroy {} for {}".format(self.opened_windows.get(entity), entity))
+            self.context.log.debug("trying to destroy {} for {}".format(self.opened_windows.get(entity), entity))
             self.opened_windows.get(entity).destroy()
             del self.opened_windows[entity]
 
         def show_entity_info(entity):
-            """Open a window and show the relevant information"""
+            """Open a window with the relevant information, or bring it to front if already open"""
+            if entity in self.opened_windows:
+                self.opened_windows[entity].lift()
+                refresh_entity_info(entity)
+                return
             info_window = tk.Toplevel(root)
             info_window.geometry('400x500')
             info_window.title(str(entity))
             info_window.entity = entity
             # handle window closing
             info_window.protocol('WM_DELETE_WINDOW', partial(on_close, info_window.entity))
-            output = entity.outputs[self.sim_tick]
-            if isinstance(entity, ElectricPole):
-                text = tk.Label(info_window, text="{}\nTick nr. {}\n\nSignals passing:\n".format(entity, self.sim_tick) +
-                                                  '\nRed:\n' + '\n'.join([str(i) for i in output['red']]) +
-                                                  '\n\nGreen:\n' + '\n'.join([str(i) for i in output['green']]), justify=tk.LEFT)
-
-            elif isinstance(entity, Lamp):
-                firstcond = entity.first_signal['name']
-                secondcond = entity.comparator
-                if entity.second_signal:
-                    thirdcond = entity.second_signal.get('name')
-                else:
-                    thirdcond = entity.constant
-
-                text = tk.Label(info_window, text="{}\nTick nr. {}\n\nConditions: {} {} {}\n\nLight status: {}\nColour: {}".format(entity,
-                                self.sim_tick, firstcond, secondcond, thirdcond, output['light'], output['color']))
+            info_window.text = tk.Label(info_window, text=self.entity_info(entity, self.sim_tick), justify=tk.LEFT)
+            info_window.text.pack()
+            self.context.log.debug("adding the window {} to the list of opened windows with {} as key.".format(info_window, entity))
+            self.opened_windows[entity] = info_window
 
-            elif isinstance(entity, Constant_Combinator):
-                text = tk.Label(info_window, text="{}\nTick nr. {}\n".format(entity, self.sim_tick) +
-                                                  "\n\nOutput signals:\n" +
-                                                  '\n'.join([str(i) for i in output]), justify=tk.LEFT)
+        def refresh_entity_info(entity):
+            """Update the text of an open info window in place"""
+            self.opened_windows[entity].text.config(text=self.entity_info(entity, self.sim_tick))
 
+        def update_simulation():
+            for enti in self.opened_windows:
+                refresh_entity_info(enti)
+            for ent, (box, _, _) in items.items():
+                output = ent.outputs[self.sim_tick]
+                if drawn_outputs.get(ent) is not output:
+                    drawn_outputs[ent] = output
+                    display.itemconfig(box, fill=entity_color(ent, output))
+
+        def visible_area():
+            """Rectangle of the diagram in view, in entity position units"""
+            zoom = view['zoom']
+            x0 = display.canvasx(0) / zoom - DRAW_MARGIN
+            y0 = display.canvasy(0) / zoom - DRAW_MARGIN
+            return (x0 - half, y0 - half, x0 + display.winfo_width() / zoom + half,
+                    y0 + display.winfo_height() / zoom + half)
+
+        def draw_entity(ent):
+            zoom = view['zoom']
+            x = (ent.position['x'] + DRAW_MARGIN) * zoom
+            y = (ent.position['y'] + DRAW_MARGIN) * zoom
+            size = half * zoom
+            wires = []
+            if size >= WIRE_MIN_PX:
+                for color, cx, cy in wire_ends.get(ent, ()):
+                    wires += [display.create_line(x, y, (cx + DRAW_MARGIN) * zoom, (cy + DRAW_MARGIN) * zoom,
+                                                  fill=color, width=1, tags='wire')]
+            output = ent.outputs[self.sim_tick]
+            drawn_outputs[ent] = output
+            outline, width = HIGHLIGHT_OUTLINES[highlight(ent)]
+            box = display.create_rectangle(x - size, y - size, x + size, y + size,
+                                           fill=entity_color(ent, output), outline=outline, width=width)
+            label = None
+            if size >= LABEL_MIN_PX:
+                label = display.create_text(x, y, text=ent.label(), width=2 * size, justify=tk.CENTER)
+            items[ent] = (box, label, wires)
+
+        def highlight(ent):
+            if ent is selection['entity']:
+                return 'selected'
+            if ent.entity_N in selection['in']:
+                return 'in'
+            if ent.entity_N in selection['out']:
+                return 'out'
+            return None
+
+        def select(ent):
+            """Highlight the entities ent depends on and the ones it drives, or nothing if ent is None"""
+            if ent is None:
+                selection.update({'entity': None, 'in': set(), 'out': set()})
             else:
-                inp = entity.inputs[self.sim_tick]
-                if isinstance(entity, Decider):
-                    firstcond = entity.first_signal['name']
-                    secondcond = entity.comparator
-                    if entity.second_signal:
-                        thirdcond = entity.second_signal.get('name')
-                    else:
-                        thirdcond = entity.constant
-                    outputcond = entity.output_signal.get('name')
-                elif isinstance(entity, Arithmetic):
-                    firstcond = entity.first_signal['name']
-                    secondcond = entity.operation
-                    if entity.second_signal:
-                        thirdcond = entity.second_signal.get('name')
-                    else:
-                        thirdcond = entity.second_constant
-                    outputcond = entity.output_signal.get('name')
-                else:
-                    firstcond = "n/a"
-                    secondcond = "n/a"
-                    thirdcond = "n/a"
-                    outputcond = "n/a"
-
-                text = tk.Label(info_window, text="{}\nTick nr. {}\n".format(entity, self.sim_tick) +
-                                                  "\nConditions:     {} {} {}  --->  {}\n".format(firstcond, secondcond,
-                                                                                                  thirdcond, outputcond) +
-                                                  "\nInput signals:\n" +
-                                                  '\n'.join([str(i) for i in inp]) +
-                                                  "\n\nOutput signals:\n" +
-                                                  '\n'.join([str(i) for i in output]), justify=tk.LEFT)
-            text.pack()
-            if entity not in self.opened_windows:
-                logging.debug("adding the window {} to the list of opened windows with {} as key.".format(info_window, entity))
-                self.opened_windows[entity] = info_window
+                selection.update({'entity': ent, 'in': self.circuit_index.upstream_cone(ent.entity_N),
+                                  'out': self.circuit_index.downstream_cone(ent.entity_N)})
+            for drawn, (box, _, _) in items.items():
+                outline, width = HIGHLIGHT_OUTLINES[highlight(drawn)]
+                display.itemconfig(box, outline=outline, width=width)
+
+        def erase_entity(ent):
+            box, label, wires = items.pop(ent)
+            for item in [box, label] + wires:
+                if item is not None:
+                    display.delete(item)
+
+        def redraw(everything=False):
+            """Draw the entities in view and remove the ones out of it"""
+            view['pending'] = False
+            if everything:
+                for ent in list(items):
+                    erase_entity(ent)
+            visible = set(index.in_rect(*visible_area()))
+            for ent in [e for e in items if e not in visible]:
+                erase_entity(ent)
+            for ent in visible:
+                if ent not in items:
+                    draw_entity(ent)
+            display.tag_lower('wire')
+
+        def schedule_redraw(*args):
+            if not view['pending']:
+                view['pending'] = True
+                root.after_idle(redraw)
+
+        def set_scrollregion():
+            zoom = view['zoom']
+            width = max(e.position['x'] for e in self.Entities) + 2 * DRAW_MARGIN
+            height = max(e.position['y'] for e in self.Entities) + 2 * DRAW_MARGIN
+            display.config(scrollregion=(0, 0, width * zoom, height * zoom))
+            return width * zoom, height * zoom
+
+        def zoom_at(factor, x, y):
+            """Zoom keeping the point under (x, y) of the canvas window in place"""
+            old = view['zoom']
+            new = min(max(old * factor, MIN_ZOOM), MAX_ZOOM)
+            if new == old:
+                return
+            wx = display.canvasx(x) / old
+            wy = display.canvasy(y) / old
+            view['zoom'] = new
+            width, height = set_scrollregion()
+            display.xview_moveto(max(wx * new - x, 0) / width)
+            display.yview_moveto(max(wy * new - y, 0) / height)
+            redraw(everything=True)
+
+        def on_wheel(event):
+            if getattr(event, 'num', None) == 5 or getattr(event, 'delta', 0) < 0:
+                zoom_at(1 / ZOOM_STEP, event.x, event.y)
             else:
-                self.opened_windows[entity].destroy()
-                self.opened_windows[entity] = info_window
-
-        def update_simulation():
-            for up_ent in self.Entities:
-                up_ent.get_output(int(current_tick_entry.get()))
-            for enti, info_window in self.opened_windows.items():
-                logging.debug("recreating window {} for {}".format(info_window, enti))
-                show_entity_info(enti)
-
+                zoom_at(ZOOM_STEP, event.x, event.y)
+
+        def on_click(event):
+            zoom = view['zoom']
+            ent = index.at(display.canvasx(event.x) / zoom - DRAW_MARGIN,
+                           display.canvasy(event.y) / zoom - DRAW_MARGIN, half)
+            select(ent)
+            if ent:
+                show_entity_info(ent)
+
+        def on_pan_start(event):
+            display.scan_mark(event.x, event.y)
+
+        def on_pan(event):
+            display.scan_dragto(event.x, event.y, gain=1)
+            schedule_redraw()
+
+        def scroll(view_fn, *args):
+            view_fn(*args)
+            schedule_redraw()
+
+        def play_button_fn():
+            if playing['on']:
+                playing['on'] = False
+                play_button.config(text='Play')
+                return
+            playing.update(on=True, start_time=time.perf_counter(), start_tick=self.sim_tick)
+            play_button.config(text='Pause')
+            play_frame()
+
+        def play_frame():
+            """Show the tick that corresponds to the time played. If drawing is slower than the
+            ticks per second, the ticks in between are simulated but not displayed."""
+            if not playing['on']:
+                return
+            try:
+                tps = max(float(tps_entry.get()), 0.1)
+            except ValueError:
+                tps = 60
+            target = playing['start_tick'] + int((time.perf_counter() - playing['start_time']) * tps)
+            if target > self.sim_tick:
+                show_tick(target)
+                if self.halted:
+                    play_button_fn()
+                    return
+            root.after(max(int(1000 / tps), 1000 // PLAY_FPS), play_frame)
 
         fwd_button = tk.Button(root, text='+1 tick', command=fwd_button_fn)
         fwd_button.grid(row=2, column=2, sticky='e')
@@ -1006,36 +2896,894 @@ class Factsimcmd():
         current_tick_entry.grid(row=2, column=1)
         current_tick_entry.bind('<Return>', update_tick_fn)
         current_tick_entry.insert(0, str(self.sim_tick))
+        play_frame_widgets = tk.Frame(root)
+        play_frame_widgets.grid(row=3, column=1)
+        play_button = tk.Button(play_frame_widgets, text='Play', command=play_button_fn)
+        play_button.pack(side=tk.LEFT)
+        tk.Label(play_frame_widgets, text='ticks/s').pack(side=tk.LEFT)
+        tps_entry = tk.Entry(play_frame_widgets, width=5)
+        tps_entry.insert(0, '60')
+        tps_entry.pack(side=tk.LEFT)
+        cancel_button = tk.Button(play_frame_widgets, text='Cancel', command=worker.cancel, state=tk.DISABLED)
+        cancel_button.pack(side=tk.LEFT)
+        seek_status = tk.Label(play_frame_widgets, text='')
+        seek_status.pack(side=tk.LEFT)
         window = tk.Frame(root, width=700, height=500)
-        window.grid(row=1, column=1)
+        window.grid(row=1, column=1, sticky='nsew')
         display = tk.Canvas(window, bg='#FFFFFF', width=700, height=500)
         hbar = tk.Scrollbar(window, orient=tk.HORIZONTAL)
         hbar.pack(side=tk.BOTTOM, fill=tk.X)
-        hbar.config(command=display.xview)
+        hbar.config(command=partial(scroll, display.xview))
         vbar = tk.Scrollbar(window, orient=tk.VERTICAL)
         vbar.pack(side=tk.RIGHT, fill=tk.Y)
-        vbar.config(command=display.yview)
+        vbar.config(command=partial(scroll, display.yview))
         display.config(xscrollcommand=hbar.set, yscrollcommand=vbar.set)
         display.pack(side=tk.LEFT, expand=True, fill=tk.BOTH)
+        display.bind('<Button-1>', on_click)
+        display.bind('<MouseWheel>', on_wheel)
+        display.bind('<Button-4>', on_wheel)
+        display.bind('<Button-5>', on_wheel)
+        for button in ('2', '3'):
+            display.bind('<ButtonPress-{}>'.format(button), on_pan_start)
+            display.bind('<B{}-Motion>'.format(button), on_pan)
+        display.bind('<Configure>', schedule_redraw)
+
+        set_scrollregion()
+        redraw()
+        fwd_button_fn()
+        root.mainloop()
 
-        for ent in self.Entities:
-            x = ent.position['x']
-            y = ent.position['y']
-            if isinstance(ent, Decider):
-                color = 'gold'
-            elif isinstance(ent, Arithmetic):
-                color = '#03ABFE'
-            elif isinstance(ent, Constant_Combinator):
-                color = '#F86658'
-            elif isinstance(ent, ElectricPole):
-                color = '#A9A8AD'
+
+def summarize_outputs(simulation, tick):
+    """Return the outputs in tick of the entities that emit signals and the lamp states."""
+    outputs = {}
+    lamps = {}
+    for e in simulation.Entities:
+        output = e.outputs[tick]
+        if isinstance(e, Lamp):
+            lamps[e.entity_N] = output.get('light')
+        elif isinstance(output, SignalSet) and output:
+            outputs[e.entity_N] = dict(output.items())
+    return outputs, lamps
+
+
+def simulate_blueprint(bpstring, ticks):
+    """Load a blueprint string headless, run it for ticks and summarize the final state.
+
+    Return a json-serializable dictionary with the outputs of the entities that emit signals, the
+    lamp states and the time spent loading and running.
+    """
+    start = time.perf_counter()
+    sim = Factsimcmd(data=bpstring, gui=False)
+    loaded = time.perf_counter()
+    sim.advance_to(ticks)
+    done = time.perf_counter()
+    outputs, lamps = summarize_outputs(sim, ticks)
+    return {'ticks': ticks, 'entities': len(sim.Entities), 'outputs': outputs, 'lamps': lamps,
+            'load_seconds': round(loaded - start, 6), 'run_seconds': round(done - loaded, 6)}
+
+
+def render_lamps(out, ticks, filename=None, data=None, scale=1, every=1, fps=30):
+    """Load a blueprint headless and write its lamps as frames to out (see LampFrames) from tick 0
+    to ticks. Return the LampFrames."""
+    sim = Factsimcmd(filename=filename, data=data, gui=False, history=2)
+    frames = sim.add_collector(LampFrames(sim, out, scale, every, fps))
+    try:
+        sim.advance_to(ticks)
+    finally:
+        frames.close()
+    return frames
+
+
+def _batch_job(job):
+    """Run one batch job in a worker, errors are reported in the result instead of raised."""
+    index, ident, bpstring, ticks = job
+    result = {'index': index}
+    if ident is not None:
+        result['id'] = ident
+    try:
+        result.update(simulate_blueprint(bpstring, ticks))
+        result['ok'] = True
+    except Exception as err:
+        result['ok'] = False
+        result['error'] = '{}: {}'.format(type(err).__name__, err)
+    return result
+
+
+def _batch_jobs(lines, ticks):
+    """Turn input lines into jobs. A line is a blueprint string or a json object with a 'blueprint'
+    key and optionally 'id' and 'ticks'."""
+    for index, line in enumerate(lines):
+        line = line.strip()
+        if not line:
+            continue
+        ident = None
+        job_ticks = ticks
+        if line.startswith('{'):
+            try:
+                request = json.loads(line)
+            except ValueError as err:
+                yield index, None, None, err
+                continue
+            ident = request.get('id')
+            job_ticks = request.get('ticks', ticks)
+            line = request.get('blueprint', '')
+        yield index, ident, line, job_ticks
+
+
+def run_batch(lines, ticks=60, jobs=1, out=None, threads=False):
+    """Simulate a stream of blueprints and write one json result line per blueprint to out.
+
+    lines is any iterable of blueprint strings or json lines (see _batch_jobs), for example an
+    open file or sys.stdin. With jobs > 1 the blueprints are simulated in that many worker
+    processes, or threads if threads is True (lighter, but the simulations share the GIL); at
+    most 2 * jobs blueprints are in flight, so memory stays bounded however long the input is.
+    Results are written in input order. Return the number of failed blueprints.
+    """
+    out = out or sys.stdout
+    failed = 0
+
+    def write(result):
+        nonlocal failed
+        if not result['ok']:
+            failed += 1
+        out.write(json.dumps(result) + '\n')
+        out.flush()
+
+    def bad_line(job):
+        index, ident, _, err = job
+        return {'index': index, 'ok': False, 'error': 'Invalid json line: {}'.format(err)}
+
+    if jobs <= 1:
+        for job in _batch_jobs(lines, ticks):
+            write(_batch_job(job) if job[2] is not None else bad_line(job))
+        return failed
+
+    executor = concurrent.futures.ThreadPoolExecutor if threads else concurrent.futures.ProcessPoolExecutor
+    with executor(max_workers=jobs) as pool:
+        pending = deque()
+        for job in _batch_jobs(lines, ticks):
+            if job[2] is None:
+                pending.append(bad_line(job))
             else:
-                color = '#4FE942'
-            button = tk.Button(display, text=ent.label(), bg=color, command=partial(show_entity_info, ent))
-            display.create_window(x, y, window=button)
+                pending.append(pool.submit(_batch_job, job))
+            while len(pending) > 2 * jobs or (pending and not isinstance(pending[0], concurrent.futures.Future)):
+                first = pending.popleft()
+                write(first.result() if isinstance(first, concurrent.futures.Future) else first)
+        while pending:
+            first = pending.popleft()
+            write(first.result() if isinstance(first, concurrent.futures.Future) else first)
+    return failed
 
-        fwd_button_fn()
-        root.mainloop()
+
+# Differential fuzzing: random circuits are simulated by the reference evaluation and by every
+# engine in FUZZ_ENGINES, and the outputs must be the same in every tick.
+FUZZ_SIGNALS = ('signal-A', 'signal-B', 'signal-C', 'signal-red')
+FUZZ_COUNTS = (0, 1, -1, 2, 3, 10, 255, 2 ** 30, 2 ** 31 - 1, -2 ** 31)  # favour the int32 limits
+FUZZ_COMPARATORS = ('<', '>', '=', '≥', '≤', '≠')
+FUZZ_OPERATIONS = ('*', '/', '+', '-', '%', '^', '<<', '>>', 'AND', 'OR', 'XOR')
+FUZZ_ENTITIES = ('constant-combinator',) * 3 + ('decider-combinator',) * 4 + ('arithmetic-combinator',) * 4 + \
+                ('small-lamp',) * 2 + ('selector-combinator', 'medium-electric-pole')
+FUZZ_SIDES = {'constant-combinator': (1,), 'small-lamp': (1,), 'medium-electric-pole': (1,)}  # the rest 1 and 2
+
+
+def _fuzz_signal(rng, wildcards=()):
+    return {'type': 'virtual', 'name': rng.choice(FUZZ_SIGNALS + wildcards)}
+
+
+def _fuzz_count(rng):
+    return rng.choice(FUZZ_COUNTS) if rng.random() < 0.5 else rng.randint(-100, 100)
+
+
+def _fuzz_second(rng, condition, constant='constant'):
+    if rng.random() < 0.5:
+        condition[constant] = _fuzz_count(rng)
+    else:
+        condition['second_signal'] = _fuzz_signal(rng)
+    return condition
+
+
+def random_control_behavior(name, rng):
+    """A random control_behavior for an entity of the fuzzer, with the settings Factorio allows."""
+    if name == 'constant-combinator':
+        return {'filters': [{'signal': {'type': 'virtual', 'name': signal}, 'count': _fuzz_count(rng), 'index': i + 1}
+                            for i, signal in enumerate(rng.sample(FUZZ_SIGNALS, rng.randint(0, 3)))],
+                'is_on': rng.random() < 0.9}
+    if name == 'decider-combinator':
+        first = _fuzz_signal(rng, ('signal-each', 'signal-anything', 'signal-everything'))
+        outputs = {'signal-each': ('signal-each',), 'signal-anything': ('signal-anything', 'signal-everything')}
+        return {'decider_conditions': _fuzz_second(rng, {
+            'first_signal': first, 'comparator': rng.choice(FUZZ_COMPARATORS),
+            'output_signal': _fuzz_signal(rng, outputs.get(first['name'], ('signal-everything',))),
+            'copy_count_from_input': rng.random() < 0.5})}
+    if name == 'arithmetic-combinator':
+        first = _fuzz_signal(rng, ('signal-each',))
+        condition = {'first_signal': first, 'operation': rng.choice(FUZZ_OPERATIONS),
+                     'output_signal': _fuzz_signal(rng, ('signal-each',) if first['name'] == 'signal-each' else ())}
+        return {'arithmetic_conditions': _fuzz_second(rng, condition, 'second_constant')}
+    if name == 'small-lamp':
+        return {'circuit_condition': _fuzz_second(rng, {
+            'first_signal': _fuzz_signal(rng, ('signal-anything', 'signal-everything')),
+            'comparator': rng.choice(FUZZ_COMPARATORS)}), 'use_colors': rng.random() < 0.5}
+    if name == 'selector-combinator':
+        return {'operation': rng.choice(('select', 'count')), 'select_max': rng.random() < 0.5,
+                'index_constant': rng.randint(0, 3), 'count_signal': _fuzz_signal(rng)}
+    return None
+
+
+def random_circuit(rng, size=8):
+    """A random blueprint dictionary with size entities wired at random (loops included)."""
+    entities = []
+    points = []
+    for n in range(1, size + 1):
+        name = rng.choice(FUZZ_ENTITIES)
+        entity = {'entity_number': n, 'name': name, 'position': {'x': n % 8 * 2 + 0.5, 'y': n // 8 * 3 + 0.5}}
+        behavior = random_control_behavior(name, rng)
+        if behavior is not None:
+            entity['control_behavior'] = behavior
+        entities += [entity]
+        points += [(n, side) for side in FUZZ_SIDES.get(name, (1, 2))]
+    wires = []
+    for _ in range(rng.randint(size // 2, 2 * size)):
+        color = rng.choice(('red', 'green'))
+        (a, side_a), (b, side_b) = rng.choice(points), rng.choice(points)
+        wires += [[a, _wire_connector(color, side_a), b, _wire_connector(color, side_b)]]
+    return {'blueprint': {'item': 'blueprint', 'entities': entities, 'wires': wires}}
+
+
+def _wire_connector(color, side):
+    return next(c for c, point in WIRE_CONNECTORS.items() if point == (color, side))
+
+
+def fuzz_error(run):
+    """Call run() and return the name of the exception it raised, or None."""
+    try:
+        run()
+    except Exception as exc:
+        return type(exc).__name__
+    return None
+
+
+def fuzz_outcome(simulation, ticks, run):
+    """Call run() and return (rows, error): the outputs of all the entities in each tick all of them
+    computed, from tick 0, and the name of the exception raised by run or None."""
+    error = fuzz_error(run)
+    complete = min([len(e.outputs) for e in simulation.active] + [ticks + 1])
+    return [[e.outputs[t] for e in simulation.Entities] for t in range(complete)], error
+
+
+def _fuzz_pick(rng, items, key):
+    """Choose one of items at random by its key, so that shrinking the blueprint keeps the choice
+    while the item is in it."""
+    salt = rng.random()
+    return min(items, key=lambda item: random.Random('{}:{}'.format(salt, key(item))).random())
+
+
+def _fuzz_load(blueprint, history=None):
+    return Factsimcmd(data=encode_blueprint(blueprint), gui=False, history=history)
+
+
+def reference_outcome(blueprint, ticks):
+    """Outputs of the blueprint up to ticks with the plain evaluation: every entity pulls its own
+    history and its inputs when asked for its output, last entity first."""
+    try:
+        simulation = _fuzz_load(blueprint)
+    except Exception as exc:
+        return [], type(exc).__name__
+
+    def run():
+        for e in reversed(simulation.Entities):
+            e.get_output(ticks)
+    return fuzz_outcome(simulation, ticks, run)
+
+
+def stepped_outcome(blueprint, ticks, rng):
+    """Tick by tick, as the GUI, batch mode and server do."""
+    simulation = _fuzz_load(blueprint)
+    return fuzz_outcome(simulation, ticks, partial(simulation.advance_to, ticks))
+
+
+def bounded_outcome(blueprint, ticks, rng):
+    """Tick by tick keeping only the last ticks of history, the outputs are recorded as it steps."""
+    simulation = _fuzz_load(blueprint, history=2)
+    rows = [[e.outputs[0] for e in simulation.Entities]]
+
+    class Recorder():
+        def collect(self, simulation, tick):
+            rows.append([e.outputs[tick] for e in simulation.Entities])
+    simulation.add_collector(Recorder())
+    error = fuzz_error(partial(simulation.advance_to, ticks))
+    return rows, error
+
+
+def edit_outcome(blueprint, ticks, rng):
+    """Load the blueprint with one entity set up at random, step to a random tick and edit the
+    entity back to its setup in the blueprint (see Factsimcmd.edit)."""
+    target = _fuzz_load(blueprint)
+    editable = [e for e in target.Entities if isinstance(e, Constant_Combinator) and not isinstance(e, Pushbutton)
+                or getattr(e, 'config', None) is not None]
+    if not editable:
+        return stepped_outcome(blueprint, ticks, rng)
+    entity = _fuzz_pick(rng, editable, lambda e: (e.position['x'], e.position['y']))
+    if isinstance(entity, Constant_Combinator):
+        changes = {'signals': dict(entity.signals.items()), 'is_on': entity.is_on}
+    else:
+        changes = {field: getattr(entity.config, field) for field in entity.config.__slots__}
+    mutated = copy.deepcopy(blueprint)
+    dictionary = mutated['blueprint']['entities'][entity.entity_N - 1]
+    behavior = random_control_behavior(dictionary['name'], rng)
+    if 'use_colors' in behavior:
+        behavior['use_colors'] = entity.use_colors   # not part of the configuration edit changes
+    dictionary['control_behavior'] = behavior
+    simulation = _fuzz_before_change(mutated, rng.randint(0, ticks))
+
+    def run():
+        simulation.edit(entity.entity_N, **changes)
+        simulation.advance_to(ticks)
+    return fuzz_outcome(simulation, ticks, run)
+
+
+def _fuzz_before_change(mutated, tick):
+    """The mutated blueprint loaded and run to tick, or just loaded if that raises: the circuit
+    before the change can fail by itself."""
+    simulation = _fuzz_load(mutated)
+    if fuzz_error(partial(simulation.advance_to, tick)):
+        simulation = _fuzz_load(mutated)
+    return simulation
+
+
+def rewire_outcome(blueprint, ticks, rng):
+    """Load the blueprint without one of its wires, or with an extra one, step to a random tick
+    and connect or disconnect it (see Factsimcmd.rewire)."""
+    entities = blueprint['blueprint']['entities']
+    wires = blueprint['blueprint'].get('wires', [])
+
+    def place(n, connector):
+        position = entities[n - 1]['position']
+        return position['x'], position['y'], connector
+    extra = not wires or rng.random() < 0.5
+    mutated = copy.deepcopy(blueprint)
+    if extra:
+        ends = [(e['entity_number'], _wire_connector(color, side)) for e in entities
+                for side in FUZZ_SIDES.get(e['name'], (1, 2)) for color in ('red', 'green')]
+        a, connector_a = _fuzz_pick(rng, ends, lambda end: place(*end))
+        # the same two points can only be wired once
+        wired = {frozenset([(w[0], w[1]), (w[2], w[3])]) for w in wires}
+        ends = [end for end in ends if WIRE_CONNECTORS[end[1]][0] == WIRE_CONNECTORS[connector_a][0] and
+                frozenset([(a, connector_a), end]) not in wired]
+        if not ends:
+            return stepped_outcome(blueprint, ticks, rng)
+        b, connector_b = _fuzz_pick(rng, ends, lambda end: place(*end))
+        wire = [a, connector_a, b, connector_b]
+        mutated['blueprint']['wires'] = wires + [wire]
+    else:
+        wire = _fuzz_pick(rng, wires, lambda w: place(w[0], w[1]) + place(w[2], w[3]))
+        mutated['blueprint']['wires'].remove(wire)
+    (color, side_a), (_, side_b) = WIRE_CONNECTORS[wire[1]], WIRE_CONNECTORS[wire[3]]
+    simulation = _fuzz_before_change(mutated, rng.randint(0, ticks))
+
+    def run():
+        if extra:
+            simulation.disconnect(wire[0], wire[2], color, side_a, side_b)
+        else:
+            simulation.connect(wire[0], wire[2], color, side_a, side_b)
+        simulation.advance_to(ticks)
+    return fuzz_outcome(simulation, ticks, run)
+
+
+# engine name -> function(blueprint, ticks, rng) returning (rows, error) as fuzz_outcome
+FUZZ_ENGINES = OrderedDict([('stepped', stepped_outcome), ('bounded', bounded_outcome),
+                            ('edit', edit_outcome), ('rewire', rewire_outcome)])
+
+
+def describe_output(output):
+    """json-serializable copy of an entity output."""
+    if isinstance(output, SignalSet):
+        return dict(output.items())
+    if hasattr(output, 'items'):
+        return {key: describe_output(value) for key, value in output.items()}
+    return output
+
+
+def compare_outcomes(expected, got):
+    """First difference between two outcomes: a dictionary with the tick, the entity and both
+    outputs or errors, or None if they agree. After an error only the ticks computed by both are
+    compared, and which exception was raised does not matter."""
+    (expected_rows, expected_error), (rows, error) = expected, got
+    for tick, (expected_row, row) in enumerate(zip(expected_rows, rows)):
+        if expected_row != row:
+            n = next(n for n, (a, b) in enumerate(zip(expected_row, row)) if a != b)
+            return {'tick': tick, 'entity': n + 1, 'expected': describe_output(expected_row[n]),
+                    'got': describe_output(row[n])}
+    if (expected_error is None) != (error is None) or \
+            (expected_error is None and len(expected_rows) != len(rows)):
+        return {'tick': min(len(expected_rows), len(rows)), 'entity': None,
+                'expected': expected_error, 'got': error}
+    return None
+
+
+def reference_failure(expected):
+    """The error of a reference outcome as a difference (see compare_outcomes), or None. The
+    circuits of random_circuit are all valid, so the reference must simulate them."""
+    rows, error = expected
+    if error is None:
+        return None
+    return {'tick': len(rows), 'entity': None, 'expected': None, 'got': error}
+
+
+def check_engine(blueprint, ticks, engine, seed):
+    """Simulate the blueprint with the reference and with an engine of FUZZ_ENGINES, using
+    random.Random(seed) for the choices of the engine. Return the first difference, see
+    compare_outcomes. The engine 'reference' checks that the reference itself does not fail."""
+    expected = reference_outcome(blueprint, ticks)
+    if engine == 'reference':
+        return reference_failure(expected)
+    return compare_outcomes(expected, FUZZ_ENGINES[engine](blueprint, ticks, random.Random(seed)))
+
+
+def _renumbered(blueprint, keep):
+    """Copy of the blueprint with only the entities numbered in keep, numbered again from 1."""
+    numbers = {n: i + 1 for i, n in enumerate(sorted(keep))}
+    shrunk = copy.deepcopy(blueprint)
+    entities = [e for e in shrunk['blueprint']['entities'] if e['entity_number'] in numbers]
+    for e in entities:
+        e['entity_number'] = numbers[e['entity_number']]
+    shrunk['blueprint']['entities'] = entities
+    shrunk['blueprint']['wires'] = [[numbers[w[0]], w[1], numbers[w[2]], w[3]]
+                                    for w in shrunk['blueprint'].get('wires', [])
+                                    if w[0] in numbers and w[2] in numbers]
+    return shrunk
+
+
+def _shrink_candidates(blueprint):
+    entities = blueprint['blueprint']['entities']
+    numbers = [e['entity_number'] for e in entities]
+    for n in numbers:
+        if len(numbers) > 1:
+            yield _renumbered(blueprint, set(numbers) - {n})
+    for i in range(len(blueprint['blueprint'].get('wires', []))):
+        shrunk = copy.deepcopy(blueprint)
+        del shrunk['blueprint']['wires'][i]
+        yield shrunk
+    for i, e in enumerate(entities):
+        for j in range(len((e.get('control_behavior') or {}).get('filters', []))):
+            shrunk = copy.deepcopy(blueprint)
+            del shrunk['blueprint']['entities'][i]['control_behavior']['filters'][j]
+            yield shrunk
+
+
+def shrink_blueprint(blueprint, ticks, fails):
+    """Make a failing blueprint smaller while fails(blueprint, ticks) stays true, removing entities,
+    wires and constant signals one at a time, then ticks. Return (blueprint, ticks)."""
+    shrinking = True
+    while shrinking:
+        shrinking = False
+        for candidate in _shrink_candidates(blueprint):
+            if fails(candidate, ticks):
+                blueprint = candidate
+                shrinking = True
+                break
+    while ticks > 0 and fails(blueprint, ticks - 1):
+        ticks -= 1
+    return blueprint, ticks
+
+
+def fuzz(runs=100, seed=0, ticks=60, size=8, engines=None, shrink=True):
+    """Simulate runs random circuits with the reference and with the engines (all of FUZZ_ENGINES
+    by default) and yield a report for every difference: the seed of the run, the engine, where
+    they differ and the blueprint string that reproduces it, shrunk unless shrink is false. When
+    the reference fails the engines are not checked, the report is for the engine 'reference'.
+
+    Run number i uses the seed seed + i, so check_engine(blueprint, ticks, engine, seed) repeats
+    the check of a report."""
+    for run in range(runs):
+        run_seed = seed + run
+        blueprint = random_circuit(random.Random(run_seed), size)
+        expected = reference_outcome(blueprint, ticks)
+        for engine in ['reference'] if expected[1] else engines or FUZZ_ENGINES:
+            if engine == 'reference':
+                difference = reference_failure(expected)
+            else:
+                difference = compare_outcomes(expected, FUZZ_ENGINES[engine](blueprint, ticks, random.Random(run_seed)))
+            if difference is None:
+                continue
+            found, found_ticks = blueprint, ticks
+            if shrink:
+                found, found_ticks = shrink_blueprint(blueprint, ticks, lambda candidate, candidate_ticks: check_engine(
+                    candidate, candidate_ticks, engine, run_seed) is not None)
+                difference = check_engine(found, found_ticks, engine, run_seed)
+            difference.update(seed=run_seed, engine=engine, ticks=found_ticks,
+                              entities=len(found['blueprint']['entities']), blueprint=encode_blueprint(found))
+            yield difference
+
+
+def run_fuzz(runs, seed=0, ticks=60, size=8, engines=None, out=None):
+    """Fuzz and write one json line per difference to out (stdout by default), with a summary on
+    stderr. Return the number of differences."""
+    out = out or sys.stdout
+    found = 0
+    start = time.perf_counter()
+    for report in fuzz(runs, seed, ticks, size, engines):
+        found += 1
+        out.write(json.dumps(report) + '\n')
+        out.flush()
+    print('{} circuits, {} differences in {:.1f}s'.format(runs, found, time.perf_counter() - start), file=sys.stderr)
+    return found
+
+
+SERVER_OPS = ('load', 'step', 'seek', 'query', 'watch', 'watches', 'unwatch', 'unload', 'status')
+SERVER_MEMORY_BUDGET = 256 * 2 ** 20
+ENTITY_BYTES = 4096      # rough memory of an entity with its wiring and configuration
+HISTORY_SLOT_BYTES = 64  # rough memory of one tick of inputs or outputs of an entity
+
+
+def estimate_memory(simulation):
+    """Rough estimate in bytes of the memory held by a simulation, used to evict from the pool."""
+    slots = sum(len(e.inputs) + len(e.outputs) for e in simulation.active)
+    return ENTITY_BYTES * len(simulation.Entities) + HISTORY_SLOT_BYTES * slots
+
+
+class ServerError(Exception):
+    """An error answered to the client with an http status."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class PooledSimulation():
+    """A simulation in the server pool with the lock serializing the requests on it."""
+
+    def __init__(self, key, simulation):
+        self.key = key
+        self.simulation = simulation
+        self.lock = asyncio.Lock()
+        self.memory = estimate_memory(simulation)
+        self.watches = OrderedDict()  # number -> Watch added by the clients
+        self.watch_numbers = count()
+
+
+class SimulationServer():
+    """Keep loaded simulations in memory and serve requests on them over http, see start().
+
+    Simulations are keyed by the sha256 of their blueprint string, so clients loading the same
+    blueprint share one simulation and its history. Every request is a POST to /<operation> with a
+    json object as body and gets a json object back:
+
+        load    {blueprint}                                 -> {id, entities, tick}
+        step    {id, ticks=1}                               -> {id, tick, halted}
+        seek    {id, tick}                                  -> {id, tick, halted}
+        query   {id, tick=last, entity | network}           -> {id, tick, signals}
+                {id, tick=last}                             -> {id, tick, outputs, lamps}
+        watch   {id, entity | network, signal, comparator, value, action='count'} -> {id, watch}
+        watches {id}                                        -> {id, watches}
+        unwatch {id, watch}                                 -> {id, watch}
+        unload  {id}                                        -> {id}
+        status  {}                                          -> {simulations, memory, memory_budget}
+
+    Any request can pass the blueprint instead of the id, loading it again if it was evicted.
+    Loading and stepping run in executor (None for the default thread pool) so the event loop
+    keeps serving other clients; the requests on one simulation are serialized by its lock. After
+    every request, the least recently used idle simulations other than the one it used are evicted
+    while the estimated memory of the pool is over memory_budget. The server logs to the 'factsim'
+    logger.
+    """
+
+    log = logging.getLogger('factsim')
+
+    def __init__(self, memory_budget=SERVER_MEMORY_BUDGET, executor=None, history=None):
+        self.memory_budget = memory_budget
+        self.executor = executor
+        self.history = history
+        self.simulations = OrderedDict()  # least recently used first
+        self.loading = {}
+
+    def run(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def load(self, bpstring):
+        """Load a blueprint string unless it is already in the pool, return its id."""
+        key = hashlib.sha256(bpstring.strip().encode('utf-8')).hexdigest()
+        if key in self.simulations:
+            return key
+        task = self.loading.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.run(partial(Factsimcmd, data=bpstring, gui=False,
+                                                          history=self.history)))
+            task.add_done_callback(lambda done: self.loading.pop(key, None))
+            self.loading[key] = task
+        simulation = await asyncio.shield(task)
+        if key not in self.simulations:
+            self.simulations[key] = PooledSimulation(key, simulation)
+        return key
+
+    async def pooled(self, params):
+        """The pooled simulation a request is about, marked as most recently used.
+
+        The id is stored in params, so handle() keeps it when evicting after the request."""
+        key = await self.load(params.pop('blueprint')) if 'blueprint' in params else params.get('id')
+        params['id'] = key
+        if key not in self.simulations:
+            raise ServerError(404, 'Unknown simulation {}, load it again'.format(key))
+        self.simulations.move_to_end(key)
+        return self.simulations[key]
+
+    def evict(self, keep=None):
+        """Drop least recently used idle simulations while the pool is over its memory budget.
+
+        The simulation with id keep, the one the request used, stays even if it is idle."""
+        total = sum(pooled.memory for pooled in self.simulations.values())
+        for key, pooled in list(self.simulations.items()):
+            if total <= self.memory_budget:
+                break
+            if key != keep and not pooled.lock.locked():
+                self.log.info("evicting simulation {}".format(key))
+                total -= pooled.memory
+                del self.simulations[key]
+
+    async def advance(self, pooled, tick=None, ticks=0):
+        """Advance to tick, or ticks past the last tick computed when the lock is acquired."""
+        async with pooled.lock:
+            sim = pooled.simulation
+            if tick is None:
+                tick = sim.last_tick + ticks
+            if tick > sim.last_tick:
+                await self.run(sim.advance_to, tick)
+                pooled.memory = estimate_memory(sim)
+            return {'id': pooled.key, 'tick': sim.last_tick, 'halted': str(sim.halted) if sim.halted else None}
+
+    async def op_load(self, params):
+        pooled = await self.pooled(params)
+        return {'id': pooled.key, 'entities': len(pooled.simulation.Entities), 'tick': pooled.simulation.last_tick}
+
+    async def op_step(self, params):
+        pooled = await self.pooled(params)
+        return await self.advance(pooled, ticks=int(params.get('ticks', 1)))
+
+    async def op_seek(self, params):
+        pooled = await self.pooled(params)
+        return await self.advance(pooled, int(params['tick']))
+
+    async def op_query(self, params):
+        pooled = await self.pooled(params)
+        sim = pooled.simulation
+        tick = int(params.get('tick', sim.last_tick))
+        if tick < 0:
+            raise ServerError(400, 'Ticks start at 0, not {}'.format(tick))
+        await self.advance(pooled, tick)
+        async with pooled.lock:
+            if tick > sim.last_tick:
+                # only ticks already computed are answered: they went through the stimuli and watches
+                raise ServerError(409, 'The simulation halted in tick {} ({}), before tick {}'.format(
+                    sim.last_tick, sim.halted, tick))
+            if 'entity' in params:
+                return {'id': pooled.key, 'tick': tick,
+                        'signals': describe_output(sim.get_entity(int(params['entity'])).outputs[tick])}
+            if 'network' in params:
+                nw = sim.get_network(int(params['network']))
+                if nw is None:
+                    raise ServerError(404, 'Unknown network {}'.format(params['network']))
+                return {'id': pooled.key, 'tick': tick, 'signals': dict(nw.value(sim, tick).items())}
+            outputs, lamps = summarize_outputs(sim, tick)
+            return {'id': pooled.key, 'tick': tick, 'outputs': outputs, 'lamps': lamps}
+
+    async def op_watch(self, params):
+        pooled = await self.pooled(params)
+        sim = pooled.simulation
+        args = (params['signal'], params['comparator'], params['value'], params.get('action', 'count'))
+        async with pooled.lock:
+            if 'entity' in params:
+                watch = sim.watch_entity(int(params['entity']), *args)
+            elif sim.get_network(int(params['network'])) is None:
+                raise ServerError(404, 'Unknown network {}'.format(params['network']))
+            else:
+                watch = sim.watch_network(int(params['network']), *args)
+            number = next(pooled.watch_numbers)
+            pooled.watches[number] = watch
+            return {'id': pooled.key, 'watch': number}
+
+    async def op_watches(self, params):
+        pooled = await self.pooled(params)
+        return {'id': pooled.key, 'watches': [{'watch': number, 'name': w.name, 'action': w.action,
+                                                'hits': w.hits, 'first_hit': w.first_hit, 'last_hit': w.last_hit}
+                                               for number, w in pooled.watches.items()]}
+
+    async def op_unwatch(self, params):
+        pooled = await self.pooled(params)
+        number = int(params['watch'])
+        async with pooled.lock:
+            if number not in pooled.watches:
+                raise ServerError(404, 'Unknown watch {}'.format(number))
+            pooled.simulation.unwatch(pooled.watches.pop(number))
+            return {'id': pooled.key, 'watch': number}
+
+    async def op_unload(self, params):
+        pooled = await self.pooled(params)
+        del self.simulations[pooled.key]
+        return {'id': pooled.key}
+
+    async def op_status(self, params):
+        return {'simulations': [{'id': key, 'entities': len(pooled.simulation.Entities),
+                                 'tick': pooled.simulation.last_tick, 'memory': pooled.memory}
+                                for key, pooled in self.simulations.items()],
+                'memory': sum(pooled.memory for pooled in self.simulations.values()),
+                'memory_budget': self.memory_budget}
+
+    async def handle(self, op, params):
+        """Answer one request, return (http status, the result as json text)."""
+        try:
+            if op not in SERVER_OPS:
+                raise ServerError(404, 'Unknown operation {}'.format(op))
+            if not isinstance(params, dict):
+                raise ServerError(400, 'The request body must be a json object')
+            result = await getattr(self, 'op_' + op)(params)
+        except ServerError as err:
+            status, result = err.status, {'error': str(err)}
+        except (ValueError, KeyError, IndexError, TypeError) as err:
+            status, result = 400, {'error': '{}: {}'.format(type(err).__name__, err)}
+        except Exception as err:
+            self.log.exception("request {} failed".format(op))
+            status, result = 500, {'error': '{}: {}'.format(type(err).__name__, err)}
+        else:
+            try:
+                return 200, json.dumps(result)
+            except (TypeError, ValueError) as err:
+                self.log.exception("request {} failed".format(op))
+                status, result = 500, {'error': '{}: {}'.format(type(err).__name__, err)}
+        finally:
+            self.evict(keep=params.get('id') if isinstance(params, dict) else None)
+        return status, json.dumps(result)
+
+    async def serve_connection(self, reader, writer):
+        """Answer the http requests of one connection until the client closes it."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                _, path, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                try:
+                    params = json.loads(body) if body.strip() else {}
+                except ValueError as err:
+                    status, payload = 400, json.dumps({'error': 'Invalid json: {}'.format(err)})
+                else:
+                    status, payload = await self.handle(path.split('?')[0].strip('/'), params)
+                payload = payload.encode('utf-8')
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(
+                    status, HTTPStatus(status).phrase, len(payload)).encode('latin-1') + payload)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close' or version == 'HTTP/1.0':
+                    break
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError) as err:
+            self.log.debug("connection dropped: {}".format(err))
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=0, path=None):
+        """Listen on host:port, or on the Unix socket path if given. Return the asyncio server."""
+        if path:
+            return await asyncio.start_unix_server(self.serve_connection, path=path)
+        return await asyncio.start_server(self.serve_connection, host, port)
+
+
+class SimulationClient():
+    """Minimal client for SimulationServer, e.g. await SimulationClient(port=8765).call('step', id=key).
+
+    Every call opens its own connection, so one client can be used from concurrent tasks.
+    Error answers are raised as ServerError.
+    """
+
+    def __init__(self, host='127.0.0.1', port=None, path=None):
+        self.host = host
+        self.port = port
+        self.path = path
+
+    async def call(self, op, **params):
+        if self.path:
+            reader, writer = await asyncio.open_unix_connection(self.path)
+        else:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            body = json.dumps(params).encode('utf-8')
+            writer.write('POST /{} HTTP/1.1\r\nHost: {}\r\nContent-Type: application/json\r\n'
+                         'Content-Length: {}\r\nConnection: close\r\n\r\n'.format(op, self.host, len(body))
+                         .encode('latin-1') + body)
+            await writer.drain()
+            status = int((await reader.readline()).split()[1])
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            result = json.loads(await reader.readexactly(int(headers['content-length'])))
+        finally:
+            writer.close()
+        if status != 200:
+            raise ServerError(status, result.get('error'))
+        return result
+
+
+async def serve(address, memory_budget=SERVER_MEMORY_BUDGET):
+    """Run a SimulationServer forever on address: PORT, HOST:PORT or a Unix socket path."""
+    host, _, port = address.rpartition(':')
+    simulation_server = SimulationServer(memory_budget)
+    if port.isdigit():
+        server = await simulation_server.start(host or '127.0.0.1', int(port))
+    else:
+        server = await simulation_server.start(path=address)
+    print('Serving simulations on {}'.format(address), file=sys.stderr)
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    """Command line entry point: open the GUI, simulate blueprints in batch with --batch, serve
+    simulations with --serve, render the lamps of a blueprint with --frames or check the faster
+    engines with --fuzz."""
+    parser = argparse.ArgumentParser(description='FactSim, a simulator for Factorio circuit networks')
+    parser.add_argument('blueprint', nargs='?', help='file with the blueprint string to open in the GUI')
+    parser.add_argument('--batch', metavar='FILE',
+                        help="simulate the blueprints in FILE ('-' for stdin), one blueprint string or json "
+                             "object per line, and write one json result per line to stdout")
+    parser.add_argument('--ticks', type=int, default=60, help='ticks to simulate each blueprint in batch mode')
+    parser.add_argument('--jobs', type=int, default=1, help='blueprints simulated in parallel in batch mode')
+    parser.add_argument('--threads', action='store_true', help='run the batch jobs in threads instead of processes')
+    parser.add_argument('--serve', metavar='ADDRESS',
+                        help='serve simulations over http on PORT, HOST:PORT or a Unix socket path')
+    parser.add_argument('--memory-budget', type=int, default=SERVER_MEMORY_BUDGET // 2 ** 20, metavar='MB',
+                        help='estimated memory above which the server evicts idle simulations')
+    parser.add_argument('--fuzz', type=int, metavar='RUNS',
+                        help='simulate RUNS random circuits with the reference evaluation and the faster engines and '
+                             'write a json line with a shrunk blueprint for every difference')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first random circuit of --fuzz')
+    parser.add_argument('--fuzz-size', type=int, default=8, metavar='ENTITIES', help='entities of the random circuits')
+    parser.add_argument('--engines', nargs='+', choices=list(FUZZ_ENGINES), help='engines checked by --fuzz')
+    parser.add_argument('--frames', metavar='OUT',
+                        help="render the lamps of the blueprint for --ticks ticks without the GUI, to a .gif, "
+                             "one PPM file per frame with a pattern like frames/{:05d}.ppm or a PPM stream "
+                             "in any other file ('-' for stdout)")
+    parser.add_argument('--frame-scale', type=int, default=1, metavar='PIXELS', help='pixels per lamp side')
+    parser.add_argument('--frame-every', type=int, default=1, metavar='TICKS', help='ticks between frames')
+    args = parser.parse_args(argv)
+    logging.basicConfig()
+
+    if args.serve:
+        try:
+            asyncio.run(serve(args.serve, args.memory_budget * 2 ** 20))
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    if args.fuzz:
+        return 1 if run_fuzz(args.fuzz, args.seed, args.ticks, args.fuzz_size, args.engines) else 0
+
+    if args.frames:
+        if not args.blueprint:
+            parser.error('--frames needs a blueprint file')
+        out = sys.stdout.buffer if args.frames == '-' else args.frames
+        frames = render_lamps(out, args.ticks, args.blueprint, scale=args.frame_scale, every=args.frame_every)
+        print('{} frames of {}x{} pixels'.format(frames.frames, frames.width, frames.height), file=sys.stderr)
+        return 0
+
+    if args.batch:
+        if args.batch == '-':
+            return 1 if run_batch(sys.stdin, args.ticks, args.jobs, threads=args.threads) else 0
+        with open(args.batch, encoding='utf-8') as lines:
+            return 1 if run_batch(lines, args.ticks, args.jobs, threads=args.threads) else 0
+
+    Factsimcmd(filename=args.blueprint)
+    # Factsimcmd(loglevel=logging.DEBUG, scale=120)
+    return 0
 
 
 #f = Factsimcmd()
@@ -1043,5 +3791,4 @@ class Factsimcmd():
 
 if __name__ == "__main__":
 
-    f = Factsimcmd()
-    # f = Factsimcmd(loglevel=logging.DEBUG, scale=120)
+    sys.exit(main())
@@ -1,7 +1,29 @@
+import asyncio
+import base64
+import io
+import json
+import logging
+import operator
+import os
+import tempfile
 import unittest
+import zlib
+from unittest import mock
 import FactSim
 
 
+def load_headless(path):
+    """Load a blueprint without opening the GUI"""
+    return FactSim.Factsimcmd(filename=path, gui=False)
+
+
+encode_blueprint = FactSim.encode_blueprint
+
+
+def virtual(name):
+    return {'type': 'virtual', 'name': name}
+
+
 class TestFactsim(unittest.TestCase):
       
     def test_opbenBp(self):
@@ -10,5 +32,810 @@ class TestFactsim(unittest.TestCase):
         #print(f.Entities)
         self.assertEqual(len(f.Entities), 4)
 
+
+class TestSignalSet(unittest.TestCase):
+
+    def test_equality_and_hash(self):
+        a = FactSim.SignalSet.from_counts({'signal-A': 1, 'signal-B': 2})
+        b = FactSim.SignalSet.from_counts({'signal-B': 2, 'signal-A': 1})
+        self.assertEqual(a, b)
+        self.assertEqual(hash(a), hash(b))
+        self.assertNotEqual(a, FactSim.SignalSet.from_counts({'signal-A': 1}))
+        self.assertEqual([str(s) for s in a], ['signal-A = 1', 'signal-B = 2'])
+
+    def test_total(self):
+        a = FactSim.SignalSet.from_counts({'signal-A': 2 ** 31 - 1})
+        b = FactSim.SignalSet.from_counts({'signal-A': 1, 'signal-B': 3})
+        self.assertIs(FactSim.SignalSet.total([FactSim.EMPTY_SIGNALS, a]), a)
+        self.assertEqual(dict(FactSim.SignalSet.total([a, b]).items()), {'signal-A': -2 ** 31, 'signal-B': 3})
+
+    def test_unchanged_outputs_are_shared(self):
+        f = load_headless("./tests/02-Decider-signal-each.bp")
+        constant = f.get_entity(6)
+        self.assertIs(constant.get_output(5), constant.get_output(6))
+        self.assertFalse(constant.changed(6))
+        # entity 2 is a counter, the rest settle down
+        for n in (3, 4, 5, 6):
+            e = f.get_entity(n)
+            self.assertIs(e.get_output(20), e.get_output(19))
+        self.assertTrue(f.get_entity(2).changed(20))
+
+
+class TestConfig(unittest.TestCase):
+
+    def test_configs_are_interned(self):
+        f = load_headless("./tests/02-Decider-signal-each.bp")
+        conditions = {'first_signal': {'type': 'virtual', 'name': 'signal-each'},
+                      'second_signal': {'type': 'virtual', 'name': 'signal-B'}, 'comparator': '≥',
+                      'output_signal': {'type': 'virtual', 'name': 'signal-each'}, 'copy_count_from_input': True}
+        config = f.intern_config(FactSim.DeciderConfig.from_dict(conditions))
+        self.assertIs(f.intern_config(FactSim.DeciderConfig.from_dict(dict(conditions))), config)
+        self.assertEqual(config.comparator, '>=')
+        with self.assertRaises(AttributeError):
+            config.constant = 3
+
+    def test_replace_keeps_operations(self):
+        config = FactSim.ArithmeticConfig(operation='^', second_constant=2)
+        self.assertEqual(config.replace(operation=config.operation).operation, '^')
+        self.assertEqual(config.replace(operation='XOR').operation, '^')
+        self.assertEqual(config.replace(operation='**').operation, '**')
+        with self.assertRaises(ValueError):
+            config.replace(operation='; import os')
+
+    def test_blueprint_is_released(self):
+        f = load_headless("./tests/01-test2.bp")
+        self.assertFalse(hasattr(f.get_entity(6), 'dictionary'))
+        self.assertEqual(f.get_entity(6).config.output_signal, 'signal-A')
+
+
+class TestBlueprintDecoding(unittest.TestCase):
+
+    def test_streamed_entities_match_full_decode(self):
+        with open("./tests/01-test2.bp", encoding='utf-8') as file:
+            bpstring = file.read()
+        expected = FactSim.open_blueprint(data=bpstring)['blueprint']['entities']
+        for size in (1, 5, 64):
+            chunks = [bpstring[i:i + size] for i in range(0, len(bpstring), size)]
+            self.assertEqual(list(FactSim.iter_json_array(FactSim.decode_blueprint_chunks(chunks),
+                                                          ('blueprint', 'entities'))), expected)
+        self.assertEqual(list(FactSim.iter_blueprint_entities(data=bpstring.encode())), expected)
+        with mock.patch('sys.stdin', io.StringIO(bpstring)):
+            self.assertEqual(list(FactSim.iter_blueprint_entities(filename='-')), expected)
+
+    def test_only_the_blueprint_entities_are_yielded(self):
+        text = json.dumps({'blueprint': {'label': 'entities', 'icons': [{'entities': [1]}],
+                                         'entities': [{'entity_number': 1, 'x': -1.5e3}, {'entity_number': 2}],
+                                         'version': 1}})
+        items = FactSim.iter_json_array([text[i:i + 3] for i in range(0, len(text), 3)], ('blueprint', 'entities'))
+        self.assertEqual(list(items), [{'entity_number': 1, 'x': -1.5e3}, {'entity_number': 2}])
+
+    def test_simulation_from_data(self):
+        with open("./tests/00-basic_test.bp", encoding='utf-8') as file:
+            bpstring = file.read()
+        f = FactSim.Factsimcmd(data=bpstring, gui=False)
+        self.assertEqual(len(f.Entities), 4)
+
+
+class TestWatch(unittest.TestCase):
+
+    def test_run_until_and_counters(self):
+        reference = load_headless("./tests/02-Decider-signal-each.bp")
+        reference.advance_to(100)
+        values = [reference.get_entity(2).outputs[t].get('signal-A') for t in range(101)]
+
+        f = FactSim.Factsimcmd(filename="./tests/02-Decider-signal-each.bp", gui=False, history=2)
+        counter = f.watch_entity(2, 'signal-A', '≥', 20)
+        tick = f.run_until(FactSim.signal_condition(f.get_entity(2), 'signal-A', '=', 18), 100)
+        self.assertEqual(tick, values.index(18))
+        f.advance_to(100)
+        hits = [t for t in range(1, 101) if values[t] >= 20]
+        self.assertEqual((counter.hits, counter.first_hit, counter.last_hit), (len(hits), hits[0], hits[-1]))
+        with self.assertRaises(IndexError):
+            f.get_entity(2).get_output(50)
+
+    def test_stop_watch_halts(self):
+        f = load_headless("./tests/00-basic_test.bp")
+        nw = f.get_nw_with_downstream(4, 'red')
+        watch = f.watch_network(nw.nw_N, 'signal-A', '>', 10, action='stop')
+        tick = f.advance_to(1000)
+        self.assertIs(f.halted, watch)
+        self.assertEqual(watch.first_hit, tick)
+        self.assertGreater(nw.value(f, tick).get('signal-A'), 10)
+        self.assertLessEqual(nw.value(f, tick - 1).get('signal-A'), 10)
+
+    def test_unknown_sources(self):
+        f = load_headless("./tests/00-basic_test.bp")
+        for source in (None, f.get_entity(1)):
+            with self.assertRaises(ValueError):
+                FactSim.signal_condition(source, 'signal-A', '>', 10)
+        with self.assertRaises(ValueError):
+            f.watch_network(99, 'signal-A', '>', 10)
+        self.assertEqual(f.watches, [])
+        f.advance_to(3)
+
+    def test_log_watch(self):
+        f = load_headless("./tests/02-Decider-signal-each.bp")
+        watch = f.watch_entity(2, 'signal-A', '>', 5, action='log')
+        with self.assertLogs('factsim') as logs, mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            f.advance_to(20)
+        self.assertEqual(len(logs.records), watch.hits)
+        self.assertEqual({(r.name, r.levelname) for r in logs.records}, {('factsim.watch', 'INFO')})
+        self.assertIn('hit in tick {}'.format(watch.first_hit), logs.output[0])
+        self.assertEqual(stderr.getvalue(), '')
+
+
+class TestStimulus(unittest.TestCase):
+
+    EVENTS = [{'tick': 10, 'entity': 4, 'signal': 'signal-B', 'value': 5},
+              {'tick': 20, 'entity': 4, 'action': 'off'},
+              {'tick': 30, 'entity': 4, 'action': 'toggle'},
+              {'tick': 40, 'entity': 4, 'signal': 'signal-B', 'value': 0, 'action': 'pulse', 'duration': 3},
+              {'tick': 50, 'entity': 4, 'signal': 'signal-B', 'value': 25, 'action': 'ramp', 'duration': 4}]
+
+    def run_schedule(self, stimuli):
+        f = load_headless("./tests/01-test2.bp")
+        f.schedule(stimuli)
+        f.advance_to(60)
+        return [f.get_entity(4).outputs[t].get('signal-B') for t in range(61)]
+
+    def test_entity_stimuli(self):
+        expected = [25] * 10 + [5] * 10 + [0] * 10 + [5] * 10 + [0] * 3 + [5] * 7 + [10, 15, 20] + [25] * 8
+        self.assertEqual(self.run_schedule(FactSim.Stimulus(**event) for event in self.EVENTS), expected)
+        self.assertEqual(self.run_schedule(self.EVENTS), expected)
+        with tempfile.TemporaryDirectory() as directory:
+            jsonl = os.path.join(directory, 'stimuli.jsonl')
+            with open(jsonl, 'w') as file:
+                file.write(''.join(json.dumps(event) + '\n' for event in self.EVENTS))
+            self.assertEqual(self.run_schedule(FactSim.read_stimuli(jsonl)), expected)
+            fields = ['tick', 'entity', 'network', 'signal', 'value', 'action', 'duration']
+            csvfile = os.path.join(directory, 'stimuli.csv')
+            with open(csvfile, 'w') as file:
+                file.write(','.join(fields) + '\n')
+                file.write(''.join(','.join(str(event.get(k, '')) for k in fields) + '\n' for event in self.EVENTS))
+            self.assertEqual(self.run_schedule(FactSim.read_stimuli(csvfile)), expected)
+
+    def test_network_injection(self):
+        f = load_headless("./tests/01-test2.bp")
+        nw = f.get_network(2)
+        self.assertEqual(nw.upstream, [4])
+        f.schedule([FactSim.Stimulus(5, network=2, signal='signal-B', value=-20)])
+        f.advance_to(10)
+        self.assertEqual([nw.value(f, t).get('signal-B') for t in (4, 5, 10)], [25, 5, 5])
+        self.assertEqual(f.get_entity(7).outputs[5].get('signal-blue'), 1)
+        self.assertEqual(f.get_entity(7).outputs[6].get('signal-blue'), 0)
+
+    def test_set_during_pulse(self):
+        for target in ({'entity': 4}, {'network': 2}):
+            f = load_headless("./tests/01-test2.bp")
+            f.schedule([dict(target, tick=5, signal='signal-B', value=50, action='pulse', duration=4),
+                        dict(target, tick=7, signal='signal-B', value=3)])
+            f.advance_to(12)
+            values = [f.get_network(2).value(f, t).get('signal-B') for t in range(4, 13)]
+            offset = 0 if 'entity' in target else 25
+            self.assertEqual(values, [25, 50 + offset, 50 + offset] + [3 + offset] * 6, target)
+
+    def test_index_follows_stimuli(self):
+        f = load_headless("./tests/01-test2.bp")
+        f.schedule([{'tick': 2, 'entity': 4, 'signal': 'signal-Z', 'value': 1},
+                    {'tick': 4, 'entity': 4, 'action': 'off'},
+                    {'tick': 6, 'entity': 4, 'action': 'toggle'},
+                    {'tick': 8, 'entity': 4, 'signal': 'signal-Y', 'value': 3, 'action': 'pulse', 'duration': 2}])
+        producers = []
+        for tick in range(1, 12):
+            f.advance_to(tick)
+            producers += [{name for name in ('signal-Y', 'signal-Z') if 4 in f.circuit_index.signal_producers(name)}]
+        self.assertEqual(producers, [set()] + [{'signal-Z'}] * 2 + [set()] * 2 + [{'signal-Z'}] * 2
+                         + [{'signal-Y', 'signal-Z'}] * 2 + [{'signal-Z'}] * 2)
+
+    def test_out_of_order(self):
+        f = load_headless("./tests/01-test2.bp")
+        f.advance_to(10)
+        f.schedule([{'tick': 5, 'entity': 4, 'action': 'off'}])
+        with self.assertRaises(ValueError):
+            f.step()
+        with self.assertRaises(ValueError):
+            FactSim.Stimulus(1, entity=4, network=2, signal='signal-A')
+
+    def test_pushbutton_is_refused(self):
+        for stimulus in ({'signal': 'signal-A', 'value': 5}, {'action': 'off'}):
+            f = FactSim.Factsimcmd(data=encode_blueprint({'blueprint': {'entities': [
+                {'entity_number': 1, 'name': 'pushbutton', 'position': {'x': 0, 'y': 0}}]}}), gui=False)
+            self.assertIsInstance(f.get_entity(1), FactSim.Pushbutton)
+            f.schedule([dict(stimulus, tick=1, entity=1)])
+            with self.assertRaises(ValueError):
+                f.step()
+
+
+class TestEdit(unittest.TestCase):
+
+    @staticmethod
+    def edited_blueprint(path, edit):
+        with open(path) as bp:
+            blueprint = json.loads(zlib.decompress(base64.b64decode(bp.read().strip()[1:])))
+        for entity in blueprint['blueprint']['entities']:
+            edit(entity)
+        return encode_blueprint(blueprint)
+
+    def test_edit_matches_reload(self):
+        def edit(entity):
+            behavior = entity.get('control_behavior', {})
+            if entity['entity_number'] == 7:
+                behavior['decider_conditions']['constant'] = 30
+            elif entity['entity_number'] == 6:
+                behavior['decider_conditions']['comparator'] = '≥'
+                behavior['decider_conditions']['constant'] = 80
+            elif entity['entity_number'] == 4:
+                behavior['filters'] = [{'signal': {'type': 'virtual', 'name': 'signal-A'}, 'count': 3, 'index': 1}]
+        reference = FactSim.Factsimcmd(data=self.edited_blueprint("./tests/01-test2.bp", edit), gui=False)
+        reference.advance_to(80)
+
+        f = load_headless("./tests/01-test2.bp")
+        f.advance_to(60)
+        kept = [f.get_entity(n).outputs for n in (4, 5, 6)]
+        self.assertEqual([e.entity_N for e in f.edit(7, constant=30)], [7, 3])
+        self.assertEqual([f.get_entity(n).outputs for n in (4, 5, 6)], kept)
+        self.assertTrue(all(a is b for a, b in zip(f.get_entity(4).outputs, kept[0])))
+        f.edit(6, comparator='≥', constant=80)
+        f.edit(4, signals={'signal-A': 3})
+        f.advance_to(80)
+        for n in range(4, 8):
+            self.assertEqual(f.get_entity(n).outputs, reference.get_entity(n).outputs, n)
+
+        with self.assertRaises(ValueError):
+            f.edit(7, comparator='; import os')
+        bounded = FactSim.Factsimcmd(filename="./tests/01-test2.bp", gui=False, history=10)
+        with self.assertRaises(ValueError):
+            bounded.edit(7, constant=30)
+
+    def test_edit_after_stimuli(self):
+        f = load_headless("./tests/01-test2.bp")
+        f.schedule([{'tick': 10, 'entity': 4, 'signal': 'signal-B', 'value': 5}])
+        f.advance_to(20)
+        with self.assertRaises(ValueError):
+            f.edit(4, is_on=True)
+        self.assertEqual([f.get_entity(4).outputs[t].get('signal-B') for t in (5, 15)], [25, 5])
+        f.edit(7, constant=30)
+
+    def test_edit_keeps_zero_counts(self):
+        f = load_headless("./tests/01-test2.bp")
+        f.advance_to(10)
+        f.edit(4, signals={'signal-A': 0})
+        self.assertEqual(dict(f.get_entity(4).signals.items()), {'signal-A': 0})
+
+
+class TestEntityTypes(unittest.TestCase):
+
+    def test_registry(self):
+        self.assertIs(FactSim.entity_class('medium-electric-pole'), FactSim.ElectricPole)
+        self.assertIs(FactSim.entity_class('small-lamp'), FactSim.Lamp)
+        self.assertIs(FactSim.entity_class('fast-inserter'), FactSim.Inserter)
+        self.assertIs(FactSim.entity_class('express-transport-belt'), FactSim.Belt)
+        self.assertIs(FactSim.entity_class('iron-chest'), FactSim.PassiveEntity)
+
+        @FactSim.register_entity('test-doubler')
+        class Doubler(FactSim.Combinator):
+            def __init__(self, dictionary, simulation):
+                super().__init__(dictionary, simulation)
+                self.restart()
+
+            def evaluate(self, input_count):
+                return FactSim.SignalSet.from_counts({name: 2 * c for name, c in input_count.items()})
+        try:
+            self.assertIs(FactSim.entity_class('test-doubler'), Doubler)
+            f = FactSim.Factsimcmd(data=encode_blueprint({'blueprint': {'entities': [
+                {'entity_number': 1, 'name': 'constant-combinator', 'position': {'x': 0, 'y': 0},
+                 'control_behavior': {'filters': [{'signal': virtual('signal-A'), 'count': 5, 'index': 1}]}},
+                {'entity_number': 2, 'name': 'test-doubler', 'position': {'x': 1, 'y': 0}},
+                {'entity_number': 3, 'name': 'small-lamp', 'position': {'x': 2, 'y': 0}}],
+                'wires': [[1, 1, 2, 1], [2, 3, 3, 1]]}}), gui=False)
+            f.advance_to(3)
+            self.assertEqual(dict(f.get_entity(2).outputs[2].items()), {'signal-A': 10})
+            self.assertIsNone(f.get_entity(2).produced_signals())
+            self.assertEqual(f.circuit_index.signal_producers('signal-A'), {1, 2})
+        finally:
+            del FactSim.ENTITY_TYPES['test-doubler']
+
+    def test_division_truncates(self):
+        divide, modulo = FactSim.ARITHMETIC['/'], FactSim.ARITHMETIC['%']
+        for a, b, quotient, remainder in ((7, 2, 3, 1), (-7, 2, -3, -1), (7, -2, -3, 1), (-7, -2, 3, -1),
+                                          (-7, 0, 0, 0)):
+            self.assertEqual((divide(a, b), modulo(a, b)), (quotient, remainder), (a, b))
+
+    def test_passive_and_inserter(self):
+        bpstring = encode_blueprint({'blueprint': {'entities': [
+            {'entity_number': 1, 'name': 'constant-combinator', 'position': {'x': 0, 'y': 0},
+             'control_behavior': {'filters': [{'signal': virtual('signal-A'), 'count': 5, 'index': 1}]},
+             'connections': {'1': {'red': [{'entity_id': 2}], 'green': [{'entity_id': 3}]}}},
+            {'entity_number': 2, 'name': 'inserter', 'position': {'x': 1, 'y': 0},
+             'control_behavior': {'circuit_condition': {'first_signal': virtual('signal-A'), 'constant': 3,
+                                                        'comparator': '>'}},
+             'connections': {'1': {'red': [{'entity_id': 1}]}}},
+            {'entity_number': 3, 'name': 'iron-chest', 'position': {'x': 2, 'y': 0},
+             'connections': {'1': {'green': [{'entity_id': 1}]}}},
+            {'entity_number': 4, 'name': 'fast-inserter', 'position': {'x': 3, 'y': 0}}]}})
+        with mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            f = FactSim.Factsimcmd(data=bpstring, gui=False)
+            f.advance_to(100)
+        self.assertEqual(stderr.getvalue(), '')
+        self.assertEqual([e.entity_N for e in f.active], [1, 2])
+        self.assertEqual([f.get_entity(2).outputs[t]['enabled'] for t in (0, 1, 2)], [False, True, True])
+        self.assertEqual(f.get_entity(3).get_output(100), FactSim.EMPTY_SIGNALS)
+        self.assertEqual(f.get_entity(4).outputs[50], FactSim.ENABLED)
+        self.assertEqual(f.get_nw_with_downstream(3, 'green').upstream, [1])
+
+    def test_selector_with_wires(self):
+        bpstring = encode_blueprint({'blueprint': {'entities': [
+            {'entity_number': 1, 'name': 'constant-combinator', 'position': {'x': 0, 'y': 0},
+             'control_behavior': {'sections': {'sections': [{'index': 1, 'filters': [
+                 {'index': i, 'type': 'virtual', 'name': name, 'quality': 'normal', 'comparator': '=', 'count': c}
+                 for i, (name, c) in enumerate([('signal-A', 5), ('signal-B', 9), ('signal-C', 2)], 1)]}]}}},
+            {'entity_number': 2, 'name': 'selector-combinator', 'position': {'x': 1, 'y': 0},
+             'control_behavior': {'operation': 'select', 'select_max': True, 'index_constant': 1}},
+            {'entity_number': 3, 'name': 'selector-combinator', 'position': {'x': 2, 'y': 0},
+             'control_behavior': {'operation': 'count', 'count_signal': virtual('signal-N')}},
+            {'entity_number': 4, 'name': 'selector-combinator', 'position': {'x': 3, 'y': 0},
+             'control_behavior': {'operation': 'select', 'select_max': False, 'index_constant': 0}}],
+            'wires': [[1, 1, 2, 1], [1, 2, 3, 2], [2, 3, 4, 1]]}})
+        f = FactSim.Factsimcmd(data=bpstring, gui=False)
+        f.advance_to(3)
+        self.assertEqual(dict(f.get_entity(2).outputs[1].items()), {'signal-A': 5})
+        self.assertEqual(dict(f.get_entity(3).outputs[1].items()), {'signal-N': 3})
+        self.assertEqual(dict(f.get_entity(4).outputs[2].items()), {'signal-A': 5})
+        self.assertEqual(len(f.networks['red']) + len(f.networks['green']), 3)
+        f.edit(3, operation='select', select_max=True, index_constant=1)
+        f.advance_to(4)
+        self.assertEqual(dict(f.get_entity(3).outputs[4].items()), {'signal-A': 5})
+        with self.assertRaises(ValueError):
+            f.edit(3, operation='+')
+
+    def test_2_0_control_behavior(self):
+        def decider(number, conditions, outputs):
+            return {'entity_number': number, 'name': 'decider-combinator', 'position': {'x': number, 'y': 0},
+                    'control_behavior': {'decider_conditions': {'conditions': conditions, 'outputs': outputs}}}
+        condition = {'first_signal': virtual('signal-A'), 'constant': 4, 'comparator': '>'}
+        bpstring = encode_blueprint({'blueprint': {'entities': [
+            {'entity_number': 1, 'name': 'constant-combinator', 'position': {'x': 0, 'y': 0},
+             'control_behavior': {'sections': {'sections': [
+                 {'index': 1, 'filters': [{'index': 1, 'type': 'virtual', 'name': 'signal-A', 'quality': 'normal',
+                                           'comparator': '=', 'count': 5},
+                                          {'index': 2, 'name': 'iron-plate', 'quality': 'normal',
+                                           'comparator': '=', 'count': 2}]},
+                 {'index': 2, 'filters': [{'index': 1, 'type': 'virtual', 'name': 'signal-A', 'quality': 'normal',
+                                           'comparator': '=', 'count': 1}]},
+                 {'index': 3, 'active': False, 'filters': [{'index': 1, 'type': 'virtual', 'name': 'signal-B',
+                                                            'quality': 'normal', 'comparator': '=', 'count': 1}]}]}}},
+            decider(2, [condition], [{'signal': virtual('signal-A')}]),
+            decider(3, [condition], [{'signal': virtual('signal-D'), 'copy_count_from_input': False}]),
+            decider(4, [condition, dict(condition, compare_type='and')], [{'signal': virtual('signal-E')}])],
+            'wires': [[1, 1, n, 1] for n in (2, 3, 4)]}})
+        with self.assertLogs('factsim', 'WARNING') as logs:
+            f = FactSim.Factsimcmd(data=bpstring, gui=False, loglevel=logging.WARNING)
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn('Entity nr 004', logs.output[0])
+        f.advance_to(3)
+        self.assertEqual(dict(f.get_entity(1).outputs[1].items()), {'signal-A': 6, 'iron-plate': 2})
+        self.assertEqual(f.get_entity(1).signals.kind('iron-plate'), 'item')
+        self.assertEqual([dict(f.get_entity(n).outputs[2].items()) for n in (2, 3, 4)],
+                         [{'signal-A': 6}, {'signal-D': 1}, {}])
+
+
+def network_members(f):
+    return sorted((nw.color, sorted(nw.upstream), sorted(nw.downstream), sorted(nw.poles))
+                  for color in ('red', 'green') for nw in f.networks[color])
+
+
+def index_state(f):
+    index = f.circuit_index
+    return ([(index.consumers(n), index.producers_of(n)) for n in range(1, len(f.Entities) + 1)],
+            {name: producers for name, producers in index.producers.items() if producers}, index.relays)
+
+
+class TestCircuitIndex(unittest.TestCase):
+
+    def test_queries(self):
+        f = load_headless("./tests/01-test2.bp")
+        index = f.circuit_index
+        self.assertEqual(index.consumers(4), {6, 7})
+        self.assertEqual(index.producers_of(5), {6})
+        self.assertEqual(index.upstream_cone(2), {4, 5, 6})
+        self.assertEqual(index.downstream_cone(4), {2, 3, 5, 6, 7})
+        self.assertEqual(index.signal_producers('signal-A'), {4, 5, 6})
+        self.assertEqual(index.signal_producers('signal-A', 7), {4})
+        self.assertEqual(index.signal_producers('signal-blue', 3), {7})
+        self.assertEqual(index.network_at('green', 6, 2).downstream, [5])
+
+        # decider 7 passing everything on can output what reaches it
+        f.edit(7, output_signal='signal-everything')
+        self.assertEqual(index.signal_producers('signal-B'), {4, 7})
+        reference = FactSim.Factsimcmd(data=TestEdit.edited_blueprint(
+            "./tests/01-test2.bp", lambda e: e['entity_number'] == 7 and e['control_behavior']['decider_conditions']
+            .update(output_signal=virtual('signal-everything'))), gui=False)
+        self.assertEqual(index_state(f), index_state(reference))
+
+    def test_rewire_matches_reload(self):
+        def add_wire(entity):
+            if entity['entity_number'] == 4:
+                entity['connections']['1']['red'] += [{'entity_id': 5, 'circuit_id': 1}]
+        reference = FactSim.Factsimcmd(data=TestEdit.edited_blueprint("./tests/01-test2.bp", add_wire), gui=False)
+        reference.advance_to(80)
+        original = load_headless("./tests/01-test2.bp")
+        original.advance_to(80)
+
+        f = load_headless("./tests/01-test2.bp")
+        f.advance_to(60)
+        self.assertEqual(sorted(e.entity_N for e in f.connect(4, 5, 'red')), [2, 3, 5, 7])
+        f.advance_to(80)
+        self.assertEqual(network_members(f), network_members(reference))
+        self.assertEqual(index_state(f), index_state(reference))
+        for n in range(1, 8):
+            self.assertEqual(f.get_entity(n).outputs, reference.get_entity(n).outputs, n)
+
+        f.disconnect(5, 4, 'red')
+        self.assertEqual(network_members(f), network_members(original))
+        self.assertEqual(index_state(f), index_state(original))
+        for n in range(1, 8):
+            self.assertEqual(f.get_entity(n).outputs, original.get_entity(n).outputs, n)
+        with self.assertRaises(ValueError):
+            f.disconnect(4, 5, 'red')
+
+    def test_rewire_refuses_network_readers(self):
+        f = load_headless("./tests/01-test2.bp")
+        f.advance_to(10)
+        wiring = {point: set(others) for point, others in f.wiring['red'].items()}
+        for reader, remove in ((f.watch_network(2, 'signal-B', '>', 0), f.unwatch),
+                               (f.collect_stats(entities=False), f.remove_collector)):
+            with self.assertRaises(ValueError):
+                f.connect(4, 5, 'red')
+            self.assertEqual(f.wiring['red'], wiring)
+            remove(reader)
+        f.connect(4, 5, 'red')
+        self.assertIn((5, 1), f.wiring['red'][(4, 1)])
+
+
+class TestFuzz(unittest.TestCase):
+
+    def test_engines_agree(self):
+        self.assertEqual(list(FactSim.fuzz(runs=20, seed=0, ticks=20, size=6)), [])
+
+    def test_reference_failures(self):
+        with mock.patch.dict(FactSim.ARITHMETIC, {'/': operator.floordiv, '%': operator.mod}):
+            reports = list(FactSim.fuzz(runs=20, seed=0, ticks=20, engines=['stepped']))
+        self.assertTrue(reports)
+        for report in reports:
+            self.assertEqual((report['engine'], report['got'], report['entities']),
+                             ('reference', 'ZeroDivisionError', 1))
+            self.assertIsNone(FactSim.check_engine(FactSim.open_blueprint(data=report['blueprint']), report['ticks'],
+                                                   'reference', report['seed']))
+
+    def test_shrink(self):
+        def broken(blueprint, ticks, rng):
+            rows, error = FactSim.stepped_outcome(blueprint, ticks, rng)
+            names = [e['name'] for e in blueprint['blueprint']['entities']]
+            return rows, 'broken' if 'arithmetic-combinator' in names else error
+        with mock.patch.dict(FactSim.FUZZ_ENGINES, {'broken': broken}):
+            reports = list(FactSim.fuzz(runs=3, seed=0, ticks=20, engines=['broken']))
+            self.assertTrue(reports)
+            for report in reports:
+                self.assertEqual((report['entities'], report['ticks']), (1, 0))
+                blueprint = FactSim.open_blueprint(data=report['blueprint'])
+                self.assertEqual(blueprint['blueprint']['wires'], [])
+                self.assertIsNotNone(FactSim.check_engine(blueprint, 0, 'broken', report['seed']))
+
+
+class TestSignalStats(unittest.TestCase):
+
+    def test_stats_match_history(self):
+        reference = load_headless("./tests/02-Decider-signal-each.bp")
+        reference.advance_to(200)
+        values = [reference.get_entity(2).outputs[t].get('signal-A', 0) for t in range(201)]
+        nonzero = [t for t in range(201) if values[t]]
+
+        f = FactSim.Factsimcmd(filename="./tests/02-Decider-signal-each.bp", gui=False, history=2)
+        stats = f.collect_stats()
+        f.advance_to(200)
+        self.assertEqual(stats.summary()[('entity 2', 'signal-A')], {
+            'min': min(values), 'max': max(values), 'mean': sum(values) / 201,
+            'changes': sum(1 for a, b in zip(values, values[1:]) if a != b),
+            'first_nonzero': nonzero[0], 'last_nonzero': nonzero[-1]})
+        self.assertIn('entity 6', stats.report())
+
+
+class TestDisplay(unittest.TestCase):
+
+    def test_entity_info_and_color(self):
+        f = load_headless("./tests/00-basic_test.bp")
+        f.advance_to(3)
+        self.assertIn('Conditions:     signal-A < 50  --->  signal-A', f.entity_info(f.get_entity(4), 3))
+        self.assertIn('Red:\nsignal-A = 4', f.entity_info(f.get_entity(1), 3))
+        decider = f.get_entity(4)
+        self.assertEqual(FactSim.entity_color(decider, decider.outputs[3]), 'gold')
+        self.assertEqual(FactSim.entity_color(decider, FactSim.EMPTY_SIGNALS), FactSim.ENTITY_COLORS['Decider'][1])
+
+
+def lamp(n, x, y, constant, use_colors=False):
+    return {'entity_number': n, 'name': 'small-lamp', 'position': {'x': x, 'y': y},
+            'control_behavior': {'circuit_condition': {'first_signal': virtual('signal-T'), 'constant': constant,
+                                                       'comparator': '>'}, 'use_colors': use_colors},
+            'connections': {'1': {'red': [{'entity_id': 1}]}}}
+
+
+class TestLampFrames(unittest.TestCase):
+    # a clock counting signal-T from 1, with signal-red, and 3 lamps lit from different ticks
+    bpstring = encode_blueprint({'blueprint': {'entities': [
+        {'entity_number': 1, 'name': 'decider-combinator', 'position': {'x': 0, 'y': -3},
+         'control_behavior': {'decider_conditions': {'first_signal': virtual('signal-T'), 'constant': 100,
+                                                     'comparator': '<', 'output_signal': virtual('signal-T'),
+                                                     'copy_count_from_input': True}},
+         'connections': {'1': {'red': [{'entity_id': 1, 'circuit_id': 2}]},
+                         '2': {'red': [{'entity_id': 1, 'circuit_id': 1}, {'entity_id': 2}]}}},
+        {'entity_number': 2, 'name': 'constant-combinator', 'position': {'x': 2, 'y': -3},
+         'control_behavior': {'filters': [{'signal': virtual('signal-T'), 'count': 1, 'index': 1},
+                                          {'signal': virtual('signal-red'), 'count': 1, 'index': 2}]},
+         'connections': {'1': {'red': [{'entity_id': 1, 'circuit_id': 1}]}}},
+        lamp(3, 10.5, 20.5, 2), lamp(4, 12.5, 20.5, 7, use_colors=True), lamp(5, 10.5, 21.5, 1000)]}})
+
+    def pixel(self, frame, width, x, y):
+        header = len('P6\n{} 2\n255\n'.format(width))
+        return tuple(frame[header + (y * width + x) * 3:][:3])
+
+    def test_stream(self):
+        out = io.BytesIO()
+        frames = FactSim.render_lamps(out, 10, data=self.bpstring, scale=2, every=5)
+        self.assertEqual((frames.frames, frames.width, frames.height), (3, 6, 4))
+        size = len(b'P6\n6 4\n255\n') + 6 * 4 * 3
+        stream = out.getvalue()
+        self.assertEqual(len(stream), 3 * size)
+        tick5, tick10 = stream[size:2 * size], stream[2 * size:]
+        self.assertTrue(tick5.startswith(b'P6\n6 4\n255\n'))
+        off, black = FactSim.LAMP_RGB_OFF, FactSim.FRAME_BACKGROUND
+        # lamps see the clock of the tick before plus the constant: 5 in tick 5, 10 in tick 10
+        self.assertEqual([self.pixel(tick5, 6, x, 0) for x in range(6)], [FactSim.LAMP_RGB['white']] * 2 +
+                         [black] * 2 + [off] * 2)
+        self.assertEqual(self.pixel(tick10, 6, 5, 1), FactSim.LAMP_RGB['red'])
+        self.assertEqual(self.pixel(tick10, 6, 1, 3), off)
+        self.assertEqual(self.pixel(tick10, 6, 3, 3), black)
+
+    def test_stdout(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'lamps.bp')
+            with open(path, 'w') as bp:
+                bp.write(self.bpstring)
+            stdout = io.TextIOWrapper(io.BytesIO(), write_through=True)
+            with mock.patch('sys.stdout', stdout), mock.patch('sys.stderr', new_callable=io.StringIO):
+                FactSim.main([path, '--frames', '-', '--ticks', '2'])
+        self.assertTrue(stdout.buffer.getvalue().startswith(b'P6\n'))
+
+    def test_frame_files_and_gif(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            FactSim.render_lamps(os.path.join(tmp, 'f{:03d}.ppm'), 4, data=self.bpstring)
+            self.assertEqual(sorted(os.listdir(tmp)), ['f{:03d}.ppm'.format(t) for t in range(5)])
+            with mock.patch.dict('sys.modules', {'PIL': None}):
+                with self.assertRaises(ValueError):
+                    FactSim.render_lamps(os.path.join(tmp, 'lamps.gif'), 4, data=self.bpstring)
+
+
+class TestSpatialIndex(unittest.TestCase):
+
+    def test_queries_match_brute_force(self):
+        f = load_headless("./tests/01-test2.bp")
+        index = FactSim.SpatialIndex(f.Entities, 100)
+        for rect in [(0, 0, 100, 100), (50, -10, 500, 170), (-1000, -1000, 10000, 10000)]:
+            x0, y0, x1, y1 = rect
+            expected = [e for e in f.Entities if x0 <= e.position['x'] <= x1 and y0 <= e.position['y'] <= y1]
+            self.assertCountEqual(index.in_rect(*rect), expected)
+        target = f.get_entity(5)
+        self.assertIs(index.at(target.position['x'] + 10, target.position['y'] - 10, 30), target)
+        self.assertIsNone(index.at(-500, -500, 30))
+
+
+class TestSimulationContext(unittest.TestCase):
+
+    @staticmethod
+    def run_blueprint(path):
+        f = load_headless(path)
+        f.advance_to(50)
+        networks = sorted((nw.nw_N, nw.color, sorted(nw.members)) for c in ('red', 'green') for nw in f.networks[c])
+        return networks, [f.get_entity(n).outputs[50] for n in range(1, len(f.Entities) + 1)]
+
+    def test_threads_match_sequential(self):
+        paths = ["./tests/00-basic_test.bp", "./tests/01-test2.bp", "./tests/02-Decider-signal-each.bp"]
+        expected = {path: self.run_blueprint(path) for path in paths}
+        self.assertEqual(expected[paths[1]][0][0][0], 1)
+        jobs = paths * 4
+        with FactSim.concurrent.futures.ThreadPoolExecutor(max_workers=6) as pool:
+            for path, result in zip(jobs, pool.map(self.run_blueprint, jobs)):
+                self.assertEqual(result, expected[path])
+
+    def test_signal_order_is_per_simulation(self):
+        first = FactSim.SimulationContext()
+        self.assertEqual(first.sig_sort('signal-1'), 1)
+        self.assertEqual(first.sig_sort('iron-plate'), len(FactSim.ORDER))
+        self.assertEqual(first.sig_sort('copper-plate'), len(FactSim.ORDER) + 1)
+        self.assertEqual(FactSim.SimulationContext().sig_sort('copper-plate'), len(FactSim.ORDER))
+
+
+class TestSeekWorker(unittest.TestCase):
+
+    def test_seek_matches_foreground(self):
+        reference = load_headless("./tests/02-Decider-signal-each.bp")
+        reference.advance_to(500)
+        f = load_headless("./tests/02-Decider-signal-each.bp")
+        worker = FactSim.SeekWorker(f, report_interval=0)
+        worker.start(500)
+        messages = []
+        while not messages or messages[-1][0] == 'progress':
+            messages.append(worker.progress.get(timeout=30))
+        self.assertEqual(messages[-1], ('done', 500, 500))
+        self.assertFalse(worker.running)
+        self.assertEqual([t for _, t, _ in messages], sorted(t for _, t, _ in messages))
+        for n in range(3, 7):
+            self.assertEqual(f.get_entity(n).outputs[500], reference.get_entity(n).outputs[500])
+
+    def test_cancel(self):
+        f = FactSim.Factsimcmd(filename="./tests/02-Decider-signal-each.bp", gui=False, history=2)
+        worker = FactSim.SeekWorker(f, report_interval=0)
+        worker.start(10 ** 9)
+        self.assertEqual(worker.progress.get(timeout=30)[0], 'progress')
+        worker.cancel()
+        self.assertTrue(worker.join(30))
+        messages = []
+        while not messages or messages[-1][0] == 'progress':
+            messages.append(worker.progress.get(timeout=30))
+        self.assertEqual(messages[-1][0], 'cancelled')
+        self.assertEqual(messages[-1][1], f.last_tick)
+        self.assertLess(f.last_tick, 10 ** 9)
+
+    def test_seek_after_halt(self):
+        f = load_headless("./tests/02-Decider-signal-each.bp")
+        watch = f.watch_entity(2, 'signal-A', '>', 5, action='stop')
+        worker = FactSim.SeekWorker(f, report_interval=10)
+        worker.start(500)
+        self.assertEqual(worker.progress.get(timeout=30), ('done', watch.first_hit, 500))
+        f.unwatch(watch)
+        f.advance_to(f.last_tick + 10)
+        worker.start(500)
+        self.assertGreaterEqual(worker.completed, watch.first_hit + 10)
+        self.assertEqual(worker.progress.get(timeout=30), ('done', 500, 500))
+
+
+class TestBatch(unittest.TestCase):
+
+    def test_run_batch(self):
+        with open("./tests/00-basic_test.bp", encoding='utf-8') as file:
+            bpstring = file.read().strip()
+        lines = io.StringIO('\n'.join([bpstring, json.dumps({'id': 'b', 'blueprint': bpstring, 'ticks': 3}),
+                                        'not a blueprint']))
+        for jobs, threads in ((1, False), (2, False), (2, True)):
+            lines.seek(0)
+            out = io.StringIO()
+            self.assertEqual(FactSim.run_batch(lines, ticks=10, jobs=jobs, out=out, threads=threads), 1)
+            results = [json.loads(line) for line in out.getvalue().splitlines()]
+            self.assertEqual([r['index'] for r in results], [0, 1, 2])
+            self.assertEqual(results[0]['outputs'], {'2': {'signal-A': 1}, '3': {'signal-A': 18}, '4': {'signal-A': 10}})
+            self.assertEqual((results[1]['id'], results[1]['ticks']), ('b', 3))
+            self.assertFalse(results[2]['ok'])
+
+
+class TestServer(unittest.TestCase):
+
+    def test_requests(self):
+        with open("./tests/02-Decider-signal-each.bp") as bp:
+            bpstring = bp.read()
+        reference = load_headless("./tests/02-Decider-signal-each.bp")
+        reference.advance_to(200)
+
+        async def session():
+            server = await FactSim.SimulationServer().start()
+            client = FactSim.SimulationClient(port=server.sockets[0].getsockname()[1])
+            async with server:
+                loaded = await client.call('load', blueprint=bpstring)
+                again = await client.call('load', blueprint=bpstring + '\n')
+                self.assertEqual(loaded['id'], again['id'])
+                await client.call('watch', id=loaded['id'], entity=2, signal='signal-A', comparator='>', value=5)
+                steps = await asyncio.gather(*[client.call('step', id=loaded['id'], ticks=40) for _ in range(5)])
+                self.assertEqual(sorted(step['tick'] for step in steps), [40, 80, 120, 160, 200])
+                query = await client.call('query', id=loaded['id'], entity=3, tick=150)
+                self.assertEqual(query['signals'], dict(reference.get_entity(3).outputs[150].items()))
+                watches = await client.call('watches', id=loaded['id'])
+                hits = sum(1 for t in range(1, 201) if reference.get_entity(2).outputs[t].get('signal-A') > 5)
+                self.assertEqual(watches['watches'][0]['hits'], hits)
+                with self.assertRaises(FactSim.ServerError) as error:
+                    await client.call('query', id='nope')
+                self.assertEqual(error.exception.status, 404)
+                for bad in ({'value': '5'}, {'comparator': '=>'}):
+                    with self.assertRaises(FactSim.ServerError) as error:
+                        await client.call('watch', **dict({'id': loaded['id'], 'entity': 2, 'signal': 'signal-A',
+                                                           'comparator': '>', 'value': 5}, **bad))
+                    self.assertEqual(error.exception.status, 400)
+                self.assertEqual(len(watches['watches']), 1)
+                await client.call('unwatch', id=loaded['id'], watch=watches['watches'][0]['watch'])
+                self.assertEqual((await client.call('watches', id=loaded['id']))['watches'], [])
+                self.assertEqual((await client.call('step', id=loaded['id']))['tick'], 201)
+                with self.assertRaises(FactSim.ServerError) as error:
+                    await client.call('unwatch', id=loaded['id'], watch=0)
+                self.assertEqual(error.exception.status, 404)
+
+        asyncio.run(session())
+
+    def test_eviction(self):
+        bpstrings = []
+        for name in ("00-basic_test.bp", "01-test2.bp"):
+            with open("./tests/" + name) as bp:
+                bpstrings += [bp.read()]
+
+        async def session():
+            server = FactSim.SimulationServer(memory_budget=1)
+            first = json.loads((await server.handle('load', {'blueprint': bpstrings[0]}))[1])['id']
+            self.assertEqual(list(server.simulations), [first])
+            second = json.loads((await server.handle('load', {'blueprint': bpstrings[1]}))[1])['id']
+            self.assertEqual(list(server.simulations), [second])
+            status, result = await server.handle('step', {'id': second})
+            self.assertEqual((status, json.loads(result)['tick']), (200, 1))
+            status, result = await server.handle('step', {'id': first})
+            self.assertEqual(status, 404)
+            server.memory_budget = 10 ** 9
+            status, result = await server.handle('step', {'blueprint': bpstrings[0], 'ticks': 3})
+            self.assertEqual((status, json.loads(result)['id'], json.loads(result)['tick']), (200, first, 3))
+
+        asyncio.run(session())
+
+    def test_queries(self):
+        with open("./tests/02-Decider-signal-each.bp") as bp:
+            bpstring = bp.read()
+        reference = load_headless("./tests/02-Decider-signal-each.bp")
+        reference.advance_to(20)
+
+        async def session():
+            server = FactSim.SimulationServer()
+            key = json.loads((await server.handle('load', {'blueprint': bpstring}))[1])['id']
+            status, result = await server.handle('query', {'id': key, 'entity': 1, 'tick': 20})
+            self.assertEqual((status, json.loads(result)['signals']),
+                             (200, FactSim.describe_output(reference.get_entity(1).outputs[20])))
+            for bad in ({'entity': 0}, {'entity': 7}, {'tick': -1}):
+                status, result = await server.handle('query', dict({'id': key, 'entity': 2}, **bad))
+                self.assertEqual(status, 400, bad)
+            await server.handle('watch', {'id': key, 'entity': 2, 'signal': 'signal-A', 'comparator': '>',
+                                          'value': -1, 'action': 'stop'})
+            status, result = await server.handle('step', {'id': key, 'ticks': 30})
+            halted = json.loads(result)['tick']
+            self.assertLess(halted, 30)
+            status, result = await server.handle('query', {'id': key, 'entity': 2, 'tick': 30})
+            self.assertEqual(status, 409)
+            self.assertIn('halted in tick {}'.format(server.simulations[key].simulation.last_tick),
+                          json.loads(result)['error'])
+
+        asyncio.run(session())
+
+    def test_untrusted_blueprints(self):
+        def arithmetic(operation, constant):
+            return encode_blueprint({'blueprint': {'entities': [
+                {'entity_number': 1, 'name': 'constant-combinator', 'position': {'x': 0, 'y': 0},
+                 'control_behavior': {'filters': [{'signal': virtual('signal-A'), 'count': -3, 'index': 1}]},
+                 'connections': {'1': {'red': [{'entity_id': 2}]}}},
+                {'entity_number': 2, 'name': 'arithmetic-combinator', 'position': {'x': 1, 'y': 0},
+                 'control_behavior': {'arithmetic_conditions': {
+                     'first_signal': virtual('signal-A'), 'operation': operation, 'second_constant': constant,
+                     'output_signal': virtual('signal-B')}},
+                 'connections': {'1': {'red': [{'entity_id': 1}]}}}]}})
+
+        async def session():
+            server = FactSim.SimulationServer()
+            with tempfile.TemporaryDirectory() as tmp:
+                flag = os.path.join(tmp, 'pwned')
+                status, result = await server.handle('step', {'blueprint': arithmetic(
+                    "+__import__('os').system('touch {}')+".format(flag), 1)})
+                self.assertEqual(status, 400)
+                self.assertFalse(os.path.exists(flag))
+            status, result = await server.handle('step', {'blueprint': arithmetic('^', 10 ** 12), 'ticks': 3})
+            result = json.loads(result)
+            self.assertEqual((status, result['tick']), (200, 3))
+            status, result = await server.handle('query', {'id': result['id'], 'entity': 2, 'tick': 3})
+            self.assertEqual(json.loads(result)['signals'], {'signal-B': -1412218879})  # (-3) ** 10 ** 12 in 32 bits
+            status, result = await server.handle('step', {'blueprint': arithmetic('<<', 2 ** 40 + 1)})
+            self.assertEqual(status, 200)
+
+        asyncio.run(session())
+
+
 if __name__ == '__main__':
     unittest.main()